@@ -0,0 +1,212 @@
+"""Benchmark the compression codecs of the processed TFRecords: the size of the
+processed files against the cost of writing and decoding them, for training,
+which reads whole files, and for the inference Lambda, which either downloads a
+whole file or fetches some of its records with ranged GETs.
+
+The default shard is the sample of real data used by the tests, repeated to get a
+file of a useful size. The synthetic shards of synthetic_data.py are random noise,
+which doesn't compress, so they would understate what compression gains.
+"""
+
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import numpy as np
+import tensorflow as tf
+import typer
+from rich.console import Console
+from rich.logging import RichHandler
+from rich.table import Table
+from rich.traceback import install
+from typing_extensions import Annotated
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from training.airflow.includes.parse_data import (  # noqa: E402 pylint: disable=C0413
+    keylist_processed,
+    process_one_dataset,
+    read_processed_tfrecord,
+)
+from training.airflow.includes.record_compression import (  # noqa: E402 pylint: disable=C0413
+    COMPRESSION_TYPES,
+)
+from training.airflow.includes.record_index import (  # noqa: E402 pylint: disable=C0413
+    file_fetcher,
+    load_index,
+    read_indexed_records,
+)
+
+# Sets up the logger to work with rich
+logger = logging.getLogger(__name__)
+logger.addHandler(RichHandler(rich_tracebacks=True, markup=True))
+logger.setLevel("INFO")
+# Setup rich to get nice tracebacks
+install()
+
+SAMPLE_SHARD = os.path.join(
+    os.path.dirname(__file__),
+    "../tests/integration_test_inference_pipeline/sample_data/28_07_24/part-r-00012",
+)
+# All the bands and derived features, without the uuid
+ALL_FEATURES = keylist_processed[:-1]
+# The same as RANGE_MAX_GAP in the inference Lambda
+RANGE_MAX_GAP = 1 << 20
+
+
+def decode_seconds(file_name: str) -> float:
+    """Time the parsing of every record of a processed file.
+
+    Args:
+        file_name (str): The processed file
+
+    Returns:
+        float: The duration in seconds
+    """
+    dataset = read_processed_tfrecord(file_name, keylist=ALL_FEATURES)
+    start = time.perf_counter()
+    dataset.reduce(tf.constant(0, tf.int64), lambda count, _: count + 1)
+    return time.perf_counter() - start
+
+
+def lookup(file_name: str, num_ids: int, seed: int = 0) -> Dict:
+    """Fetch some random records of a processed file by id, as the inference Lambda
+    does, and measure the bytes fetched.
+
+    Args:
+        file_name (str): The processed file
+        num_ids (int): The number of records to fetch
+        seed (int, optional): Seed of the random generator. Defaults to 0.
+
+    Returns:
+        Dict: The number of fetches, the bytes fetched and the duration in seconds
+    """
+    index = load_index(file_name)
+    rng = np.random.default_rng(seed)
+    positions = rng.choice(len(index["offsets"]), num_ids, replace=False).tolist()
+    fetch_file = file_fetcher(file_name)
+    fetched = []
+
+    def fetch(start: int, end: int) -> bytes:
+        fetched.append(end - start)
+        return fetch_file(start, end)
+
+    start = time.perf_counter()
+    read_indexed_records(fetch, index, positions, max_gap=RANGE_MAX_GAP)
+    return {
+        "lookup_fetches": len(fetched),
+        "lookup_bytes": sum(fetched),
+        "lookup_seconds": time.perf_counter() - start,
+    }
+
+
+def main(
+    shard: Annotated[
+        str, typer.Option(help="The raw shard, the sample of real data by default")
+    ] = SAMPLE_SHARD,
+    repeat: Annotated[
+        int, typer.Option(help="Number of copies of the shard to concatenate")
+    ] = 20,
+    lookups: Annotated[
+        int, typer.Option(help="Number of records fetched by id per file")
+    ] = 16,
+    bandwidth: Annotated[
+        float, typer.Option(help="S3 download bandwidth in MB/s, to estimate transfers")
+    ] = 80.0,
+    output: Annotated[
+        str, typer.Option(help="The JSON file in which to write the results")
+    ] = "benchmark_compression.json",
+) -> None:
+    """Write the same processed data with every codec and report the size, the
+    write and decode throughput, and the cost of reading the files from S3.
+
+    Args:
+        shard (str): The raw shard
+        repeat (int): Number of copies of the shard to concatenate
+        lookups (int): Number of records fetched by id per file
+        bandwidth (float): S3 download bandwidth in MB/s
+        output (str): The JSON file in which to write the results
+    """
+    results: List[Dict] = []
+    with tempfile.TemporaryDirectory() as workdir:
+        # TFRecord files can be concatenated byte-wise
+        raw = os.path.join(workdir, "part-r-00000")
+        with open(raw, "wb") as fw:
+            for _ in range(repeat):
+                with open(shard, "rb") as fp:
+                    shutil.copyfileobj(fp, fw)
+        # Warm up TensorFlow, so that its initialization isn't measured
+        decode_seconds(process_one_dataset(raw, output_prefix="warmup"))
+
+        for compression in COMPRESSION_TYPES:
+            codec = compression or "none"
+            logger.info(f"Writing and reading the processed file with {codec}")
+            start = time.perf_counter()
+            out_name = process_one_dataset(
+                raw,
+                output_prefix=f"processed_{codec}",
+                assign_id=True,
+                compression=compression,
+            )
+            write_seconds = time.perf_counter() - start
+            size_mb = os.path.getsize(out_name) / 1e6
+            num_records = len(load_index(out_name)["offsets"])
+            seconds = decode_seconds(out_name)
+            results.append(
+                {
+                    "codec": codec,
+                    "records": num_records,
+                    "size_mb": size_mb,
+                    "write_seconds": write_seconds,
+                    "decode_seconds": seconds,
+                    "decode_records_per_s": num_records / seconds,
+                    # A Lambda scoring a whole file downloads it, then decodes it
+                    "s3_file_seconds": size_mb / bandwidth + seconds,
+                    **lookup(out_name, min(lookups, num_records)),
+                }
+            )
+
+    reference = results[0]
+    table = Table(title=f"Processed file compression ({reference['records']} records)")
+    for column in [
+        "Codec",
+        "Size (MB)",
+        "Ratio",
+        "Write (s)",
+        "Decode (rec/s)",
+        "S3 + decode (s)",
+        f"{lookups} ids: fetched (MB)",
+        f"{lookups} ids: time (ms)",
+    ]:
+        table.add_column(column, justify="left" if column == "Codec" else "right")
+    for r in results:
+        table.add_row(
+            r["codec"],
+            f"{r['size_mb']:.1f}",
+            f"{r['size_mb'] / reference['size_mb']:.2f}",
+            f"{r['write_seconds']:.2f}",
+            f"{r['decode_records_per_s']:.0f}",
+            f"{r['s3_file_seconds']:.2f}",
+            f"{r['lookup_bytes'] / 1e6:.1f}",
+            f"{r['lookup_seconds'] * 1e3:.0f}",
+        )
+    Console().print(table)
+
+    report = {
+        "tensorflow": tf.__version__,
+        "cpu_count": os.cpu_count(),
+        "bandwidth_mb_per_s": bandwidth,
+        "results": results,
+    }
+    with open(output, "w", encoding="utf-8") as fw:
+        json.dump(report, fw, indent=4)
+    logger.info(f"Wrote the results to {output}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,168 @@
+"""Benchmark the input pipeline of training on synthetic processed files: the
+serial reading train.get_dataset used to do, against the parallel, prefetching
+pipeline of input_pipeline.py with its settings varied one at a time.
+
+Every configuration reads the files for a number of epochs, so that the cached
+configurations show both the epoch which fills the cache and the ones reading it.
+The parallel settings only pay off with several cores, so the results depend on
+the machine much more than those of the other benchmarks.
+"""
+
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import tensorflow as tf
+import typer
+from rich.console import Console
+from rich.logging import RichHandler
+from rich.table import Table
+from rich.traceback import install
+from synthetic_data import write_synthetic_shard
+from typing_extensions import Annotated
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from training.airflow.includes.input_pipeline import (  # noqa: E402 pylint: disable=C0413
+    AUTOTUNE,
+    MEMORY_CACHE,
+    build_input_pipeline,
+)
+from training.airflow.includes.parse_data import (  # noqa: E402 pylint: disable=C0413
+    process_one_dataset,
+    read_processed_tfrecord,
+)
+
+# Sets up the logger to work with rich
+logger = logging.getLogger(__name__)
+logger.addHandler(RichHandler(rich_tracebacks=True, markup=True))
+logger.setLevel("INFO")
+# Setup rich to get nice tracebacks
+install()
+
+# The features of the default model configuration
+KEYLIST = ["B2", "B3", "B4"]
+BUFFER_SIZE = 500
+# The settings of every configuration, on top of the defaults of
+# build_input_pipeline. None stands for the serial pipeline.
+CONFIGURATIONS: Dict[str, Dict | None] = {
+    "serial": None,
+    "parallel": {},
+    "parallel, deterministic": {"deterministic": True},
+    "parallel, no prefetch": {"prefetch": 0},
+    "parallel, one file at a time": {"cycle_length": 1},
+    "parallel, memory cache": {"cache": MEMORY_CACHE},
+}
+
+
+def serial_pipeline(filelist: List[str], batch_size: int) -> tf.data.Dataset:
+    """The pipeline train.get_dataset built before input_pipeline.py existed."""
+    dataset = read_processed_tfrecord(filelist, keylist=KEYLIST)
+    return dataset.shuffle(BUFFER_SIZE).batch(batch_size)
+
+
+def time_epochs(dataset: tf.data.Dataset, epochs: int) -> List[float]:
+    """Iterate over a dataset for some epochs, and time every one of them.
+
+    Args:
+        dataset (tf.data.Dataset): The dataset of batches
+        epochs (int): The number of epochs
+
+    Returns:
+        List[float]: The duration of every epoch in seconds
+    """
+    seconds = []
+    for _ in range(epochs):
+        start = time.perf_counter()
+        for _ in dataset:
+            pass
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def main(
+    files: Annotated[int, typer.Option(help="Number of processed files")] = 8,
+    records: Annotated[int, typer.Option(help="Number of records per file")] = 500,
+    batch_size: Annotated[int, typer.Option(help="The batch size")] = 64,
+    epochs: Annotated[int, typer.Option(help="Number of epochs to time")] = 3,
+    output: Annotated[
+        str, typer.Option(help="The JSON file in which to write the results")
+    ] = "benchmark_input_pipeline.json",
+) -> None:
+    """Read synthetic processed files with every configuration of the input
+    pipeline, report the records/s of the first and the later epochs, and write
+    the results to a JSON file.
+
+    Args:
+        files (int): Number of processed files
+        records (int): Number of records per file
+        batch_size (int): The batch size
+        epochs (int): Number of epochs to time
+        output (str): The JSON file in which to write the results
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        filelist = []
+        for k in range(files):
+            shard = os.path.join(workdir, f"part-r-{k:05d}")
+            write_synthetic_shard(shard, records, seed=k)
+            filelist.append(process_one_dataset(shard))
+            os.remove(shard)
+        num_records = sum(1 for _ in read_processed_tfrecord(filelist, KEYLIST))
+        # Warm up TensorFlow, so that its initialization isn't measured
+        time_epochs(serial_pipeline(filelist[:1], batch_size), 1)
+
+        for name, settings in CONFIGURATIONS.items():
+            logger.info(f"Timing the {name} pipeline")
+            if settings is None:
+                dataset = serial_pipeline(filelist, batch_size)
+            else:
+                dataset = build_input_pipeline(
+                    filelist, batch_size, BUFFER_SIZE, KEYLIST, **settings
+                )
+            cpu_start = time.process_time()
+            seconds = time_epochs(dataset, epochs)
+            later = seconds[1:] or seconds
+            results.append(
+                {
+                    "configuration": name,
+                    "settings": settings,
+                    "first_epoch_records_per_s": num_records / seconds[0],
+                    "later_epochs_records_per_s": num_records * len(later) / sum(later),
+                    "cpu_seconds_per_epoch": (time.process_time() - cpu_start) / epochs,
+                }
+            )
+
+    reference = results[0]["later_epochs_records_per_s"]
+    table = Table(title=f"Input pipeline ({num_records} records, {files} files)")
+    for column in ["Configuration", "Epoch 1 (rec/s)", "Later (rec/s)", "Speedup"]:
+        table.add_column(
+            column, justify="left" if column == "Configuration" else "right"
+        )
+    for r in results:
+        table.add_row(
+            r["configuration"],
+            f"{r['first_epoch_records_per_s']:.0f}",
+            f"{r['later_epochs_records_per_s']:.0f}",
+            f"{r['later_epochs_records_per_s'] / reference:.2f}",
+        )
+    Console().print(table)
+
+    report = {
+        "tensorflow": tf.__version__,
+        "cpu_count": os.cpu_count(),
+        "autotune": AUTOTUNE,
+        "num_records": num_records,
+        "results": results,
+    }
+    with open(output, "w", encoding="utf-8") as fw:
+        json.dump(report, fw, indent=4)
+    logger.info(f"Wrote the results to {output}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
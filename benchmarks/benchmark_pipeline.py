@@ -0,0 +1,338 @@
+"""Benchmark the throughput of every stage of the parse_data pipeline on synthetic
+shards of several sizes, and write the results to a JSON file so that runs can be
+compared across commits.
+
+Every stage is run in a fresh process, so that its peak RSS is not hidden by the
+memory used by the stages before it. The stages are cumulative: each one includes
+the reading and decoding needed to produce its input, so the cost of a stage is
+the difference with the stage it builds on. Every stage is first run on a small
+shard, so that the one-off initialization of TensorFlow isn't measured, but the
+tracing of the tf.data functions, which happens for every shard, is.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess as sp
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Tuple
+
+import tensorflow as tf
+import typer
+from rich.console import Console
+from rich.logging import RichHandler
+from rich.table import Table
+from rich.traceback import install
+from synthetic_data import write_synthetic_shard
+from typing_extensions import Annotated
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from training.airflow.includes.parse_data import (  # noqa: E402 pylint: disable=C0413
+    RAW_BATCH_SIZE,
+    count_records,
+    derived_keylist,
+    keylist_processed,
+    parse_raw_tfrecord,
+    parse_raw_tfrecord_batch,
+    process_one_dataset,
+    raw_keylist,
+    read_processed_tfrecord,
+    read_raw_tfrecord,
+    serialize_data,
+)
+
+# Sets up the logger to work with rich
+logger = logging.getLogger(__name__)
+logger.addHandler(RichHandler(rich_tracebacks=True, markup=True))
+logger.setLevel("INFO")
+# Setup rich to get nice tracebacks
+install()
+
+# All the bands and derived features, without the uuid
+ALL_FEATURES = keylist_processed[:-1]
+# Number of records of the shard used to warm up every stage
+WARMUP_SIZE = 2 * RAW_BATCH_SIZE
+
+
+def count_elements(dataset: tf.data.Dataset, batched: bool = False) -> int:
+    """Run a dataset to the end inside the graph, and count its records.
+
+    Args:
+        dataset (tf.data.Dataset): The dataset, whose elements are (features, label)
+        batched (bool, optional): If True, every element is a batch of records.
+            Defaults to False.
+
+    Returns:
+        int: The number of records
+    """
+    if batched:
+        return int(
+            dataset.reduce(
+                tf.constant(0, tf.int64),
+                lambda count, element: count + tf.shape(element[1], tf.int64)[0],
+            )
+        )
+    return int(dataset.reduce(tf.constant(0, tf.int64), lambda count, _: count + 1))
+
+
+def stage_parse_raw(shard: str, processed: str) -> Tuple[int, int]:
+    """parse_raw_tfrecord, one record at a time."""
+    dataset = tf.data.TFRecordDataset(shard).map(
+        lambda x: parse_raw_tfrecord(x, raw_keylist)
+    )
+    return count_elements(dataset), os.path.getsize(shard)
+
+
+def stage_parse_raw_batch(shard: str, processed: str) -> Tuple[int, int]:
+    """parse_raw_tfrecord_batch, on batches of RAW_BATCH_SIZE records."""
+    dataset = (
+        tf.data.TFRecordDataset(shard)
+        .batch(RAW_BATCH_SIZE)
+        .map(lambda x: parse_raw_tfrecord_batch(x, raw_keylist))
+    )
+    return count_elements(dataset, batched=True), os.path.getsize(shard)
+
+
+def stage_veto(shard: str, processed: str) -> Tuple[int, int]:
+    """read_raw_tfrecord: parsing and the blank veto on the uint8 bands, one record
+    at a time."""
+    return count_elements(read_raw_tfrecord(shard)), os.path.getsize(shard)
+
+
+def stage_veto_batch(shard: str, processed: str) -> Tuple[int, int]:
+    """read_raw_tfrecord: parsing and the blank veto on the uint8 bands, on batches
+    of records, as in process_one_dataset."""
+    dataset = read_raw_tfrecord(shard, batch_size=RAW_BATCH_SIZE, unbatch=False)
+    return count_elements(dataset, batched=True), os.path.getsize(shard)
+
+
+def stage_derived(shard: str, processed: str) -> Tuple[int, int]:
+    """Parsing, veto and the derived features, on batches of records."""
+    dataset = read_raw_tfrecord(
+        shard,
+        batch_size=RAW_BATCH_SIZE,
+        unbatch=False,
+        derived_features=derived_keylist,
+    )
+    return count_elements(dataset, batched=True), os.path.getsize(shard)
+
+
+def stage_serialize_data(shard: str, processed: str) -> Tuple[int, int]:
+    """Parsing, veto, derived features and the eager serialize_data."""
+    dataset = read_raw_tfrecord(
+        shard, batch_size=RAW_BATCH_SIZE, derived_features=derived_keylist
+    )
+    num_records = 0
+    for element in dataset:
+        serialize_data(element)
+        num_records += 1
+    return num_records, os.path.getsize(shard)
+
+
+def stage_write_processed(shard: str, processed: str) -> Tuple[int, int]:
+    """The whole processing of a shard, as done by process_one_dataset."""
+    out_name = process_one_dataset(shard, output_prefix="benchmark")
+    num_records = count_records(out_name)
+    os.remove(out_name)
+    return num_records, os.path.getsize(shard)
+
+
+def stage_parse_processed(shard: str, processed: str) -> Tuple[int, int]:
+    """parse_tf_record, reading every band and derived feature."""
+    dataset = read_processed_tfrecord(processed, keylist=ALL_FEATURES)
+    return count_elements(dataset), os.path.getsize(processed)
+
+
+STAGES: Dict[str, Callable[[str, str], Tuple[int, int]]] = {
+    "parse_raw_tfrecord": stage_parse_raw,
+    "parse_raw_tfrecord_batch": stage_parse_raw_batch,
+    "read_raw_tfrecord": stage_veto,
+    "read_raw_tfrecord_batch": stage_veto_batch,
+    "add_derived_features": stage_derived,
+    "serialize_data": stage_serialize_data,
+    "write_processed_output": stage_write_processed,
+    "parse_tf_record": stage_parse_processed,
+}
+
+
+def _read_status_mb(field: str) -> float | None:
+    """Read a memory field of /proc/self/status, in MB. Only works on Linux."""
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as fp:
+            for line in fp:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) * 1024 / 1e6
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss() -> None:
+    """Reset the peak resident set size of this process, where supported.
+
+    The peak measured by getrusage is inherited from the parent process, even
+    across exec, so it has to be reset for the measurement of a stage to be its own.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="utf-8") as fw:
+            fw.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_mb() -> float:
+    """Peak resident set size of this process, in MB."""
+    peak = _read_status_mb("VmHWM")
+    if peak is not None:
+        return peak
+    # ru_maxrss is in kB on Linux, but in bytes on macOS
+    scale = 1 if platform.system() == "Darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6
+
+
+def run_stage(
+    name: str, shard: str, processed: str, warmup_shard: str, warmup_processed: str
+) -> Dict:
+    """Run a stage and measure it. Meant to be run in a fresh process.
+
+    Args:
+        name (str): The name of the stage, a key of STAGES
+        shard (str): The raw shard
+        processed (str): The processed version of the shard
+        warmup_shard (str): A small raw shard, used to warm up
+        warmup_processed (str): The processed version of the small shard
+
+    Returns:
+        Dict: The number of records, the bytes read, the duration, the records/s,
+            the MB/s, the peak RSS and the RSS before the stage started
+    """
+    STAGES[name](warmup_shard, warmup_processed)
+    rss_before = _read_status_mb("VmRSS") or _peak_rss_mb()
+    _reset_peak_rss()
+    start = time.perf_counter()
+    num_records, num_bytes = STAGES[name](shard, processed)
+    elapsed = time.perf_counter() - start
+    return {
+        "records": num_records,
+        "bytes": num_bytes,
+        "seconds": elapsed,
+        "records_per_s": num_records / elapsed,
+        "mb_per_s": num_bytes / 1e6 / elapsed,
+        "peak_rss_mb": _peak_rss_mb(),
+        "rss_before_mb": rss_before,
+    }
+
+
+def _git_commit() -> str | None:
+    """The current git commit, if any."""
+    try:
+        return sp.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=sp.DEVNULL,
+            text=True,
+        ).strip()
+    except (sp.CalledProcessError, FileNotFoundError):
+        return None
+
+
+def main(
+    sizes: Annotated[
+        List[int], typer.Option(help="Numbers of records of the synthetic shards")
+    ] = [1000, 4000],
+    stages: Annotated[
+        List[str], typer.Option(help="The stages to run, all of them by default")
+    ] = list(STAGES),
+    output: Annotated[
+        str, typer.Option(help="The JSON file in which to write the results")
+    ] = "benchmark_results.json",
+    baseline: Annotated[
+        str, typer.Option(help="A previous results file to compare with")
+    ] = "",
+) -> None:
+    """Run every stage of the pipeline on synthetic shards, report records/s, MB/s
+    and peak RSS, and write the results to a JSON file.
+
+    Args:
+        sizes (List[int]): Numbers of records of the synthetic shards
+        stages (List[str]): The stages to run
+        output (str): The JSON file in which to write the results
+        baseline (str): A previous results file to compare with
+    """
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise typer.BadParameter(f"Unknown stages {sorted(unknown)}")
+    previous = {}
+    if baseline:
+        with open(baseline, "r", encoding="utf-8") as fp:
+            previous = {(r["stage"], r["size"]): r for r in json.load(fp)["results"]}
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as workdir:
+        warmup_shard = os.path.join(workdir, "part-r-warmup")
+        write_synthetic_shard(warmup_shard, WARMUP_SIZE, seed=1)
+        warmup_processed = process_one_dataset(warmup_shard)
+        for size in sizes:
+            shard = os.path.join(workdir, f"part-r-{size}")
+            write_synthetic_shard(shard, size)
+            processed = process_one_dataset(shard)
+            for name in stages:
+                logger.info(f"Running {name} on {size} records")
+                # A fresh process per stage, so the peak RSS is the stage's own
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as ex:
+                    result = ex.submit(
+                        run_stage,
+                        name,
+                        shard,
+                        processed,
+                        warmup_shard,
+                        warmup_processed,
+                    ).result()
+                results.append({"stage": name, "size": size, **result})
+            os.remove(shard)
+            os.remove(processed)
+
+    table = Table(title="parse_data pipeline stages")
+    for column in ["Stage", "Records", "Records/s", "MB/s", "Peak RSS (MB)"]:
+        table.add_column(column, justify="left" if column == "Stage" else "right")
+    if previous:
+        table.add_column("Records/s vs baseline", justify="right")
+    for r in results:
+        row = [
+            r["stage"],
+            str(r["size"]),
+            f"{r['records_per_s']:.0f}",
+            f"{r['mb_per_s']:.1f}",
+            f"{r['peak_rss_mb']:.0f}",
+        ]
+        if previous:
+            old = previous.get((r["stage"], r["size"]))
+            row.append(
+                f"{r['records_per_s'] / old['records_per_s']:.2f}x" if old else "-"
+            )
+        table.add_row(*row)
+    Console().print(table)
+
+    report = {
+        "commit": _git_commit(),
+        "date": datetime.now(timezone.utc).isoformat(),
+        "tensorflow": tf.__version__,
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    with open(output, "w", encoding="utf-8") as fw:
+        json.dump(report, fw, indent=4)
+    logger.info(f"Wrote the results to {output}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,90 @@
+"""Benchmark the versions of the processed data format against each other,
+comparing the size on disk and the throughput of read_processed_tfrecord.
+"""
+
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import typer
+from rich.console import Console
+from rich.logging import RichHandler
+from rich.table import Table
+from rich.traceback import install
+from typing_extensions import Annotated
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from training.airflow.includes.parse_data import (  # noqa: E402 pylint: disable=C0413
+    RAW_BATCH_SIZE,
+    add_derived_features,
+    keylist_processed,
+    read_processed_tfrecord,
+    read_raw_tfrecord,
+    write_processed_output,
+)
+
+# Sets up the logger to work with rich
+logger = logging.getLogger(__name__)
+logger.addHandler(RichHandler(rich_tracebacks=True, markup=True))
+logger.setLevel("INFO")
+# Setup rich to get nice tracebacks
+install()
+
+SAMPLE_SHARD = os.path.join(
+    os.path.dirname(__file__),
+    "../tests/integration_test_inference_pipeline/sample_data/28_07_24/part-r-00012",
+)
+# All the bands and derived features, without the uuid
+ALL_FEATURES = keylist_processed[:-1]
+
+
+def main(
+    shard: Annotated[str, typer.Option(help="The raw part-r-* shard to use")] = (
+        SAMPLE_SHARD
+    ),
+    repeat: Annotated[
+        int, typer.Option(help="Number of times to read the processed shard")
+    ] = 20,
+) -> None:
+    """Process the shard into every version of the processed format, and report the
+    size of the output and the records/s when reading it back.
+
+    Args:
+        shard (str): The raw shard to process
+        repeat (int): Number of times to read the processed shard, to get stable
+            timings
+    """
+    raw_size = os.path.getsize(shard)
+    dataset = read_raw_tfrecord(shard, batch_size=RAW_BATCH_SIZE).map(
+        add_derived_features
+    )
+    table = Table(title=f"Processed format comparison for {os.path.basename(shard)}")
+    table.add_column("Version")
+    table.add_column("Size (MB)", justify="right")
+    table.add_column("Size / raw size", justify="right")
+    table.add_column("Read records/s", justify="right")
+    table.add_column("Read MB/s", justify="right")
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        for version in [1, 2]:
+            out_name = os.path.join(tmpdirname, f"processed_v{version}")
+            write_processed_output(dataset, out_name, format_version=version)
+            size = os.path.getsize(out_name)
+            reader = read_processed_tfrecord([out_name] * repeat, keylist=ALL_FEATURES)
+            start = time.perf_counter()
+            num_records = int(reader.reduce(0, lambda count, _: count + 1))
+            elapsed = time.perf_counter() - start
+            table.add_row(
+                str(version),
+                f"{size / 1e6:.2f}",
+                f"{size / raw_size:.2f}",
+                f"{num_records / elapsed:.0f}",
+                f"{size * repeat / 1e6 / elapsed:.1f}",
+            )
+    Console().print(table)
+
+
+if __name__ == "__main__":
+    typer.run(main)
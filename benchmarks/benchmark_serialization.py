@@ -0,0 +1,101 @@
+"""Benchmark the serialization of processed data, comparing the eager
+per-record serialization (serialize_data) with the graph-mode batched
+serialization used by write_processed_output.
+"""
+
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import tensorflow as tf
+import typer
+from rich.console import Console
+from rich.logging import RichHandler
+from rich.table import Table
+from rich.traceback import install
+from typing_extensions import Annotated
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from training.airflow.includes.parse_data import (  # noqa: E402 pylint: disable=C0413
+    RAW_BATCH_SIZE,
+    add_derived_features,
+    read_raw_tfrecord,
+    serialize_data,
+    write_processed_output,
+)
+
+# Sets up the logger to work with rich
+logger = logging.getLogger(__name__)
+logger.addHandler(RichHandler(rich_tracebacks=True, markup=True))
+logger.setLevel("INFO")
+# Setup rich to get nice tracebacks
+install()
+
+SAMPLE_SHARD = os.path.join(
+    os.path.dirname(__file__),
+    "../tests/integration_test_inference_pipeline/sample_data/28_07_24/part-r-00012",
+)
+
+
+def write_eager(dataset, out_name: str) -> None:
+    """Write the dataset by serializing every element eagerly, as was done
+    before the serialization moved into the graph.
+
+    Args:
+        dataset (Dataset): The processed dataset
+        out_name (str): The name of the output file
+    """
+    with tf.io.TFRecordWriter(out_name) as file_writer:
+        for element in dataset:
+            file_writer.write(serialize_data(element))
+
+
+def main(
+    shard: Annotated[str, typer.Option(help="The raw part-r-* shard to use")] = (
+        SAMPLE_SHARD
+    ),
+    repeat: Annotated[
+        int, typer.Option(help="Number of times to repeat the shard")
+    ] = 50,
+) -> None:
+    """Measure the records/s of writing processed output with both the eager and
+    the graph-mode serialization.
+
+    Args:
+        shard (str): The raw shard to process
+        repeat (int): Number of times to repeat the shard, to get stable timings
+    """
+    files = [shard] * repeat
+    # Decode once into memory, so that only the serialization is timed
+    dataset = (
+        read_raw_tfrecord(files, batch_size=RAW_BATCH_SIZE)
+        .map(add_derived_features)
+        .cache()
+    )
+    num_records = int(dataset.reduce(0, lambda count, _: count + 1))
+    logger.info(f"Serializing {num_records} records from {shard}")
+
+    writers = {
+        "eager (serialize_data)": write_eager,
+        "graph (write_processed_output)": write_processed_output,
+    }
+    table = Table(title="Serialization throughput")
+    table.add_column("Method")
+    table.add_column("Time (s)", justify="right")
+    table.add_column("Records/s", justify="right")
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        for name, writer in writers.items():
+            # Warm up, so that tracing the graph is not part of the timing
+            writer(dataset.take(1), os.path.join(tmpdirname, "warmup"))
+            start = time.perf_counter()
+            writer(dataset, os.path.join(tmpdirname, "processed"))
+            elapsed = time.perf_counter() - start
+            table.add_row(name, f"{elapsed:.2f}", f"{num_records / elapsed:.0f}")
+    Console().print(table)
+
+
+if __name__ == "__main__":
+    typer.run(main)
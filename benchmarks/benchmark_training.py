@@ -0,0 +1,171 @@
+"""Benchmark the numerical settings of the baseline model: XLA compilation and
+mixed bfloat16 precision, against the float32 baseline.
+
+Every configuration trains the same model from the same initial weights on the
+same synthetic images, whose class sets the brightness of a square at a random
+place, so that the accuracies can be compared too. The first epoch, which
+includes the compilation, is reported separately from the later ones.
+"""
+
+import json
+import logging
+import os
+import sys
+import time
+from typing import Dict, Tuple
+
+import keras
+import numpy as np
+import omegaconf
+import tensorflow as tf
+import typer
+from rich.console import Console
+from rich.logging import RichHandler
+from rich.table import Table
+from rich.traceback import install
+from typing_extensions import Annotated
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from training.airflow.includes.model import (  # noqa: E402 pylint: disable=C0413
+    construct_baseline_model,
+)
+from training.airflow.includes.parse_data import (  # noqa: E402 pylint: disable=C0413
+    IMG_DIM,
+    NUM_CLASSES,
+)
+
+# Sets up the logger to work with rich
+logger = logging.getLogger(__name__)
+logger.addHandler(RichHandler(rich_tracebacks=True, markup=True))
+logger.setLevel("INFO")
+# Setup rich to get nice tracebacks
+install()
+
+# The features of the default model configuration
+KEYLIST = ["B2", "B3", "B4"]
+# The settings of every configuration
+CONFIGURATIONS: Dict[str, Dict] = {
+    "float32": {"jit_compile": False, "precision": "float32"},
+    "float32, XLA": {"jit_compile": True, "precision": "float32"},
+    "mixed_bfloat16": {"jit_compile": False, "precision": "mixed_bfloat16"},
+    "mixed_bfloat16, XLA": {"jit_compile": True, "precision": "mixed_bfloat16"},
+}
+# Side of the square whose brightness gives the class
+SQUARE_SIZE = 16
+
+
+def synthetic_images(num_records: int, seed: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Noisy images with a square of a brightness set by the class, at a random
+    place.
+
+    Args:
+        num_records (int): The number of images
+        seed (int): Seed of the random generator
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The images and the one-hot encoded labels
+    """
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, NUM_CLASSES, num_records)
+    images = rng.random((num_records, IMG_DIM, IMG_DIM, len(KEYLIST)), np.float32)
+    images *= 0.5
+    corners = rng.integers(0, IMG_DIM - SQUARE_SIZE, (num_records, 2))
+    for image, label, (row, col) in zip(images, labels, corners):
+        image[row : row + SQUARE_SIZE, col : col + SQUARE_SIZE] += 0.15 * label
+    return images, keras.utils.to_categorical(labels, NUM_CLASSES)
+
+
+def main(
+    records: Annotated[int, typer.Option(help="Number of training records")] = 4096,
+    epochs: Annotated[int, typer.Option(help="Number of epochs")] = 4,
+    batch_size: Annotated[int, typer.Option(help="The batch size")] = 64,
+    output: Annotated[
+        str, typer.Option(help="The JSON file in which to write the results")
+    ] = "benchmark_training.json",
+) -> None:
+    """Train the baseline model with every configuration, report the records/s
+    and the validation accuracy, and write the results to a JSON file.
+
+    Args:
+        records (int): Number of training records
+        epochs (int): Number of epochs
+        batch_size (int): The batch size
+        output (str): The JSON file in which to write the results
+    """
+    images, labels = synthetic_images(records, seed=0)
+    val_images, val_labels = synthetic_images(records // 4, seed=1)
+    initial_weights = None
+    results = []
+    for name, settings in CONFIGURATIONS.items():
+        logger.info(f"Training with {name}")
+        cfg = omegaconf.OmegaConf.create(
+            {
+                "features": {"list": KEYLIST},
+                "model": {"learning_rate": 0.0005, **settings},
+            }
+        )
+        keras.utils.set_random_seed(0)
+        model = construct_baseline_model(cfg)
+        if initial_weights is None:
+            initial_weights = model.get_weights()
+        model.set_weights(initial_weights)
+        seconds, cpu_seconds = [], []
+        for _ in range(epochs):
+            start, cpu_start = time.perf_counter(), time.process_time()
+            model.fit(images, labels, batch_size=batch_size, shuffle=False, verbose=0)
+            seconds.append(time.perf_counter() - start)
+            cpu_seconds.append(time.process_time() - cpu_start)
+        loss, _, accuracy = model.evaluate(
+            val_images, val_labels, batch_size=batch_size, verbose=0
+        )
+        results.append(
+            {
+                "configuration": name,
+                **settings,
+                "first_epoch_seconds": seconds[0],
+                "records_per_s": records * (epochs - 1) / sum(seconds[1:]),
+                "cpu_seconds_per_epoch": float(np.mean(cpu_seconds[1:])),
+                "val_loss": loss,
+                "val_accuracy": accuracy,
+            }
+        )
+    keras.mixed_precision.set_global_policy("float32")
+
+    reference = results[0]["records_per_s"]
+    table = Table(title=f"Baseline model training ({records} records, {epochs} epochs)")
+    for column in [
+        "Configuration",
+        "Epoch 1 (s)",
+        "Later (rec/s)",
+        "Speedup",
+        "Val loss",
+        "Val accuracy",
+    ]:
+        table.add_column(
+            column, justify="left" if column == "Configuration" else "right"
+        )
+    for r in results:
+        table.add_row(
+            r["configuration"],
+            f"{r['first_epoch_seconds']:.1f}",
+            f"{r['records_per_s']:.0f}",
+            f"{r['records_per_s'] / reference:.2f}",
+            f"{r['val_loss']:.3f}",
+            f"{r['val_accuracy']:.3f}",
+        )
+    Console().print(table)
+
+    report = {
+        "tensorflow": tf.__version__,
+        "keras": keras.__version__,
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    with open(output, "w", encoding="utf-8") as fw:
+        json.dump(report, fw, indent=4)
+    logger.info(f"Wrote the results to {output}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
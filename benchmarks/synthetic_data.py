@@ -0,0 +1,94 @@
+"""Generate synthetic shards with the schema of the raw droughtwatch TFRecords,
+so that the pipeline can be benchmarked at any dataset size.
+"""
+
+import logging
+import os
+import sys
+
+import numpy as np
+import tensorflow as tf
+import typer
+from rich.logging import RichHandler
+from rich.traceback import install
+from typing_extensions import Annotated
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from training.airflow.includes.parse_data import (  # noqa: E402 pylint: disable=C0413
+    IMG_DIM,
+    NUM_CLASSES,
+    raw_keylist,
+)
+
+# Sets up the logger to work with rich
+logger = logging.getLogger(__name__)
+logger.addHandler(RichHandler(rich_tracebacks=True, markup=True))
+logger.setLevel("INFO")
+# Setup rich to get nice tracebacks
+install()
+
+
+def write_synthetic_shard(
+    out_name: str, num_records: int, blank_fraction: float = 0.05, seed: int = 0
+) -> int:
+    """Write a raw shard of random images. Every band is stored as IMG_DIM**2
+    uint8 bytes and the label as an int64, as in the raw data.
+
+    Args:
+        out_name (str): The name of the output file
+        num_records (int): The number of records to write
+        blank_fraction (float, optional): The fraction of blank images, which the
+            processing vetoes. Defaults to 0.05.
+        seed (int, optional): Seed of the random generator. Defaults to 0.
+
+    Returns:
+        int: The size of the shard in bytes
+    """
+    rng = np.random.default_rng(seed)
+    with tf.io.TFRecordWriter(out_name) as file_writer:
+        for _ in range(num_records):
+            if rng.random() < blank_fraction:
+                image = np.zeros((len(raw_keylist), IMG_DIM, IMG_DIM), np.uint8)
+            else:
+                image = rng.integers(
+                    0, 256, (len(raw_keylist), IMG_DIM, IMG_DIM), np.uint8
+                )
+            feature = {
+                key: tf.train.Feature(
+                    bytes_list=tf.train.BytesList(value=[band.tobytes()])
+                )
+                for key, band in zip(raw_keylist, image)
+            }
+            feature["label"] = tf.train.Feature(
+                int64_list=tf.train.Int64List(value=[rng.integers(NUM_CLASSES)])
+            )
+            example = tf.train.Example(features=tf.train.Features(feature=feature))
+            file_writer.write(example.SerializeToString())
+    return os.path.getsize(out_name)
+
+
+def main(
+    out_name: Annotated[str, typer.Argument(help="The name of the output file")],
+    num_records: Annotated[
+        int, typer.Option(help="The number of records to write")
+    ] = 1000,
+    blank_fraction: Annotated[
+        float, typer.Option(help="The fraction of blank images")
+    ] = 0.05,
+    seed: Annotated[int, typer.Option(help="Seed of the random generator")] = 0,
+) -> None:
+    """Write a synthetic raw shard.
+
+    Args:
+        out_name (str): The name of the output file
+        num_records (int): The number of records to write
+        blank_fraction (float): The fraction of blank images
+        seed (int): Seed of the random generator
+    """
+    size = write_synthetic_shard(out_name, num_records, blank_fraction, seed)
+    logger.info(f"Wrote {num_records} records ({size / 1e6:.1f} MB) to {out_name}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
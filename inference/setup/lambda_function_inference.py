@@ -2,18 +2,19 @@
 This module contains the code that performs inference on processed data.
 """
 
+import hashlib
 import json
 import os
 import tempfile
 import traceback
-from typing import Any, Dict, List, Tuple
+from functools import partial
+from typing import Any, Callable, Dict, List, Tuple
 
 import awswrangler as wr
 import boto3
 import numpy as np
 import onnxruntime as rt
 import pandas as pd
-import parse_data
 import psycopg
 import tensorflow as tf
 from db_helper import (
@@ -23,10 +24,16 @@ from db_helper import (
     get_db_connection_string,
     update_table,
 )
+from includes import parse_data, record_index
 from omegaconf import DictConfig, OmegaConf
 
 # In case we are running on localstack
 AWS_ENDPOINT_URL = os.getenv("aws_endpoint_url")
+# Records of a processed file separated by fewer bytes than this are fetched from
+# S3 with a single ranged GET
+RANGE_MAX_GAP = 1 << 20
+# The copy of the model with an optimized graph, next to model.onnx
+OPTIMIZED_MODEL_NAME = "model.optimized.onnx"
 
 
 # A list of all possible features that can appear in a processed dataset
@@ -84,16 +91,82 @@ def get_dataset(
     return dataset
 
 
-def get_model(s3, path: str) -> Tuple[bytes, DictConfig]:
+def s3_fetcher(s3, bucket_name: str, key: str) -> Callable[[int, int], bytes]:
+    """Make a function reading a range of bytes of an S3 object with a ranged GET,
+    for use with record_index.read_indexed_records.
+
+    Args:
+        s3 (s3 client): The s3 client
+        bucket_name (str): The bucket of the object
+        key (str): The key of the object
+
+    Returns:
+        Callable[[int, int], bytes]: Returns the bytes from start to end (exclusive)
+    """
+
+    def fetch(start: int, end: int) -> bytes:
+        response = s3.get_object(
+            Bucket=bucket_name, Key=key, Range=f"bytes={start}-{end - 1}"
+        )
+        return response["Body"].read()
+
+    return fetch
+
+
+def get_records_by_id(
+    s3,
+    bucket_name: str,
+    key: str,
+    ids: List[str],
+    batch_size: int,
+    feature_list: List[str] | None = None,
+    features: Dict[str, tf.io.FixedLenFeature] | None = None,
+):
+    """Return a batched dataset of some records of a processed file on S3. Only the
+    index of the file and the requested records are downloaded.
+
+    Args:
+        s3 (s3 client): The s3 client
+        bucket_name (str): The bucket of the processed file
+        key (str): The key of the processed file
+        ids (List[str]): The ids of the records
+        batch_size (int): The batch size
+        feature_list (List[str] | None, optional): The list of features to return.
+        features (Dict[str, tf.io.FixedLenFeature] | None, optional): Mapping of each
+            feature inside the file. Defaults to None.
+
+    Returns:
+        tf.Dataset: The records, in the order of ids
+    """
+    if features is None:
+        features = features_inference
+    response = s3.get_object(Bucket=bucket_name, Key=record_index.index_name(key))
+    index = json.loads(response["Body"].read())
+    records = record_index.read_indexed_records(
+        s3_fetcher(s3, bucket_name, key),
+        index,
+        record_index.find_records(index, ids),
+        max_gap=RANGE_MAX_GAP,
+    )
+    dataset = tf.data.Dataset.from_tensor_slices(tf.constant(records, tf.string))
+    dataset = dataset.map(
+        partial(parse_data.parse_tf_record, keylist=feature_list, features=features)
+    )
+    return dataset.batch(batch_size)
+
+
+def get_model(s3, path: str) -> Tuple[bytes, rt.SessionOptions, DictConfig]:
     """Give the path to the model, get the model and its
-    configuration
+    configuration. The copy of the model with an optimized graph is preferred, if
+    it was optimized from this model by the version of ONNX Runtime of this Lambda.
 
     Args:
         s3 (s3 client): The s3 client
         path (str): The path to the model
 
     Returns:
-        Tuple[bytes, DictConfig]: Serialized model, model config
+        Tuple[bytes, rt.SessionOptions, DictConfig]: Serialized model, the options
+            of its session, model config
     """
     # Load model
     registry_bucket_name = os.environ.get("model_registry_s3_bucket")
@@ -102,28 +175,58 @@ def get_model(s3, path: str) -> Tuple[bytes, DictConfig]:
     )
     # The model at this point is a binary object
     model = response["Body"].read()
+    options = rt.SessionOptions()
+    try:
+        response = s3.get_object(
+            Bucket=registry_bucket_name, Key=os.path.join(path, OPTIMIZED_MODEL_NAME)
+        )
+        metadata = response["Metadata"]
+        # An optimized model left over from an older model.onnx is ignored
+        if (
+            metadata.get("onnxruntime-version") == rt.__version__
+            and metadata.get("source-sha256") == hashlib.sha256(model).hexdigest()
+        ):
+            model = response["Body"].read()
+            if metadata.get("optimization-level") == "all":
+                # The graph is fully optimized for this CPU already
+                options.graph_optimization_level = (
+                    rt.GraphOptimizationLevel.ORT_DISABLE_ALL
+                )
+    except s3.exceptions.NoSuchKey:
+        pass
     # Load config
     response = s3.get_object(
         Bucket=registry_bucket_name, Key=os.path.join(path, "config.yaml")
     )
     content = response["Body"].read()
     config = OmegaConf.create(content.decode("utf-8"))
-    return model, config
+    return model, options, config
 
 
-def run_inference(model: bytes, dset) -> Tuple[np.ndarray, np.ndarray]:
-    """Run the model on the data
+def create_session(model: bytes, options: rt.SessionOptions) -> rt.InferenceSession:
+    """Initialize the ONNX run-time for a model, once for all the files it runs on.
 
     Args:
         model (bytes): The serialized ONNX model in memory
+        options (rt.SessionOptions): The options of the session
+
+    Returns:
+        rt.InferenceSession: The session
+    """
+    providers = ["CPUExecutionProvider"]
+    return rt.InferenceSession(model, options, providers=providers)
+
+
+def run_inference(m: rt.InferenceSession, dset) -> Tuple[np.ndarray, np.ndarray]:
+    """Run the model on the data
+
+    Args:
+        m (rt.InferenceSession): The session of the ONNX model
         dset (TFRecordsDataset): The dataset
 
     Returns:
         Tuple[np.ndarray, np.ndarray]: The predictions and associated IDs
     """
-    providers = ["CPUExecutionProvider"]
-    # Initialize the ONNX run-time.
-    m = rt.InferenceSession(model, providers=providers)
     input_name = m.get_inputs()[0].name
     all_onnx_preds = []
     all_ids = []
@@ -214,6 +317,10 @@ def lambda_handler(event, context) -> Dict[str, Any]:  # pylint: disable=unused-
     - Updates the ledger table to indicate which files have been
     processed
 
+    If the event has "ids", a mapping from processed files to lists of record ids,
+    only these records are fetched and scored instead, and the predictions are
+    returned in the response.
+
     Args:
         event
         context
@@ -232,7 +339,27 @@ def lambda_handler(event, context) -> Dict[str, Any]:  # pylint: disable=unused-
             wr.config.s3_endpoint_url = AWS_ENDPOINT_URL
         else:
             s3 = boto3.client("s3")
-        model, config = get_model(s3, s3_model_path)
+        model, options, config = get_model(s3, s3_model_path)
+        session = create_session(model, options)
+
+        if "ids" in ev:
+            # Score only the requested records, fetched with ranged GETs
+            predictions = []
+            for key, ids in ev["ids"].items():
+                dset = get_records_by_id(
+                    s3,
+                    data_bucket_name,
+                    key,
+                    ids,
+                    batch_size=64,
+                    feature_list=config.features.list,
+                )
+                predictions.append(package_predictions(*run_inference(session, dset)))
+            df = pd.concat(predictions, ignore_index=True)
+            return {
+                "statusCode": 200,
+                "body": {**ev, "predictions": df.to_dict(orient="records")},
+            }
 
         # Get new cases from ledger database
         db_config = get_credentials(endpoint_url=AWS_ENDPOINT_URL)
@@ -257,7 +384,7 @@ def lambda_handler(event, context) -> Dict[str, Any]:  # pylint: disable=unused-
                     shuffle=False,
                 )
                 # Get the results and write them back to s3
-                inf_res, ids = run_inference(model, dset)
+                inf_res, ids = run_inference(session, dset)
                 predictions_path = os.path.join(base_dir, "predictions.parquet")
                 wr.s3.to_parquet(
                     df=package_predictions(inf_res, ids),
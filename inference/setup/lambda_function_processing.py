@@ -21,9 +21,13 @@ from db_helper import (
     prep_db,
     update_table,
 )
-from parse_data import process_one_dataset
+from includes.band_statistics import stats_name
+from includes.parse_data import process_one_dataset
+from includes.record_index import index_name
 
 AWS_ENDPOINT_URL = os.getenv("aws_endpoint_url")
+# The compression codec of the processed files (GZIP or ZLIB), uncompressed if unset
+PROCESSED_COMPRESSION = os.getenv("processed_compression") or None
 
 
 CREATE_TABLE_STATEMENT = """
@@ -99,7 +103,7 @@ def lambda_handler(event, context):  # pylint: disable=unused-argument
     - Creates the ledger table, if it doesn't exist
     - Finds all raw files that don't have corresponding processed files
     - Loops over them and processes them
-    - Saves the processed files back to S3
+    - Saves the processed files and their indices back to S3
     - Updates the ledger table to indicate which files have been
     processed
 
@@ -136,17 +140,23 @@ def lambda_handler(event, context):  # pylint: disable=unused-argument
                     s3.download_fileobj(bucket_name, key, f)
 
                 # This will create a processed file inside the temp directory
-                processed_file = process_one_dataset(tmp_file, assign_id=True)
+                processed_file = process_one_dataset(
+                    tmp_file, assign_id=True, compression=PROCESSED_COMPRESSION
+                )
                 processed_path = os.path.join(
                     base_dir, os.path.basename(processed_file)
                 )
-                # Save the processed file to the S3 bucket
+                # Save the processed file, its index and statistics to the S3 bucket
                 with open(processed_file, "rb") as f:
                     s3.upload_fileobj(
                         f,
                         bucket_name,
                         processed_path,
                     )
+                with open(index_name(processed_file), "rb") as f:
+                    s3.upload_fileobj(f, bucket_name, index_name(processed_path))
+                with open(stats_name(processed_file), "rb") as f:
+                    s3.upload_fileobj(f, bucket_name, stats_name(processed_path))
 
             # We managed to process things, let's update the ledger for corresponding item
             u = SqlUpdate("processed_path", processed_path)
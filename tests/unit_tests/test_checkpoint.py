@@ -0,0 +1,188 @@
+"""
+This module contains tests of the checkpointing and resuming of trainings.
+"""
+
+import json
+import os
+
+import keras
+import numpy as np
+import omegaconf
+import pytest
+
+from training.airflow.includes.checkpoint import (  # pylint: disable=no-name-in-module
+    CHECKPOINT_NAME,
+    checkpoint_dir,
+    restore_checkpoint,
+    training_callbacks,
+)
+
+
+def _config(directory: str, **model) -> omegaconf.DictConfig:
+    return omegaconf.OmegaConf.create(
+        {
+            "model": {"name": "test", "learning_rate": 0.01, **model},
+            "data": {
+                "train_data": os.path.join(directory, "train"),
+                "val_data": os.path.join(directory, "val"),
+            },
+            "logging": {"style": "mlflow"},
+            "callbacks": {
+                "checkpoint": {"enabled": True, "dir": directory, "every_epochs": 1},
+                "early_stopping": {
+                    "enabled": True,
+                    "monitor": "loss",
+                    "patience": 10,
+                    "min_delta": 0.0,
+                    "restore_best_weights": False,
+                },
+                "reduce_lr": {
+                    "enabled": True,
+                    "monitor": "loss",
+                    "factor": 0.5,
+                    "patience": 1,
+                    "min_lr": 0.0,
+                },
+            },
+        }
+    )
+
+
+def _model() -> keras.Model:
+    keras.utils.set_random_seed(0)
+    model = keras.Sequential(
+        [
+            keras.Input(shape=(4,)),
+            keras.layers.Dense(8, activation="relu"),
+            keras.layers.BatchNormalization(),
+            keras.layers.Dense(2),
+        ]
+    )
+    model.compile(loss="mse", optimizer=keras.optimizers.Adam(0.01))
+    return model
+
+
+def test_checkpoint_dir(tmp_path):
+    """
+    Test that the checkpoints of a training are found again with the same
+    settings, and not with others
+    """
+    cfg = _config(str(tmp_path))
+    assert checkpoint_dir(cfg) == checkpoint_dir(_config(str(tmp_path)))
+    assert checkpoint_dir(cfg).startswith(os.path.join(str(tmp_path), "test-"))
+    assert checkpoint_dir(cfg) != checkpoint_dir(_config(str(tmp_path), epochs=3))
+    # The logging and the callbacks don't change what is trained
+    cfg.logging.style = "wandb"
+    cfg.callbacks.reduce_lr.patience = 3
+    assert checkpoint_dir(cfg) == checkpoint_dir(_config(str(tmp_path)))
+    # A training on other data doesn't resume from the checkpoint of this one
+    previous = checkpoint_dir(cfg)
+    os.makedirs(cfg.data.train_data)
+    with open(
+        os.path.join(cfg.data.train_data, "data_hashes.json"), "w", encoding="utf-8"
+    ) as fp:
+        json.dump({"part-r-00000": {"fingerprint": "new"}}, fp)
+    assert checkpoint_dir(cfg) != previous
+
+
+def test_resume_training(tmp_path):
+    """
+    Test that a training resumed from a checkpoint ends with the same weights,
+    optimizer state and learning rate as an uninterrupted one
+    """
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(64, 4)).astype("float32")
+    y = rng.normal(size=(64, 2)).astype("float32")
+    cfg = _config(str(tmp_path))
+
+    def fit(model, epochs, initial_epoch=0, state=None):
+        model.fit(
+            x,
+            y,
+            batch_size=16,
+            epochs=epochs,
+            initial_epoch=initial_epoch,
+            shuffle=False,
+            verbose=0,
+            callbacks=training_callbacks(cfg, state),
+        )
+
+    uninterrupted = _model()
+    fit(uninterrupted, 6)
+    # Nothing was resumed, but every epoch was checkpointed
+    assert os.path.isfile(os.path.join(checkpoint_dir(cfg), CHECKPOINT_NAME))
+
+    interrupted = _model()
+    fit(interrupted, 3)
+    resumed = _model()
+    state = restore_checkpoint(resumed, checkpoint_dir(cfg))
+    assert state["epoch"] == 3
+    assert [c.keys() for c in state["callbacks"]] == [
+        {"wait", "best", "best_epoch"},
+        {"wait", "best", "cooldown_counter"},
+    ]
+    fit(resumed, 6, state["epoch"], state)
+
+    assert int(resumed.optimizer.iterations) == 6 * 4
+    # The learning rate was reduced on a plateau
+    assert float(resumed.optimizer.learning_rate) < 0.01
+    for expected, variable in zip(
+        uninterrupted.optimizer.variables + uninterrupted.weights,
+        resumed.optimizer.variables + resumed.weights,
+    ):
+        assert np.allclose(np.asarray(expected), np.asarray(variable), atol=1e-6)
+
+    other = keras.Sequential([keras.Input(shape=(4,)), keras.layers.Dense(2)])
+    other.compile(loss="mse", optimizer="adam")
+    with pytest.raises(ValueError):
+        restore_checkpoint(other, checkpoint_dir(cfg))
+    assert restore_checkpoint(resumed, str(tmp_path / "missing")) is None
+
+
+def test_resume_then_stop_early(tmp_path):
+    """
+    Test that a resumed training which stops early restores the best weights
+    from before it was interrupted, like an uninterrupted one
+    """
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(64, 4)).astype("float32")
+    y = rng.normal(size=(64, 2)).astype("float32")
+    cfg = _config(str(tmp_path))
+    cfg.callbacks.early_stopping.patience = 2
+    # Only the second epoch improves the loss by this much
+    cfg.callbacks.early_stopping.min_delta = 0.5
+    cfg.callbacks.early_stopping.restore_best_weights = True
+    cfg.callbacks.reduce_lr.enabled = False
+
+    def fit(model, epochs, initial_epoch=0, state=None):
+        model.fit(
+            x,
+            y,
+            batch_size=16,
+            epochs=epochs,
+            initial_epoch=initial_epoch,
+            shuffle=False,
+            verbose=0,
+            callbacks=training_callbacks(cfg, state),
+        )
+
+    def sgd_model():
+        model = _model()
+        model.compile(loss="mse", optimizer=keras.optimizers.SGD(0.5))
+        return model
+
+    uninterrupted = sgd_model()
+    fit(uninterrupted, 10)
+    # It stopped after the fourth epoch
+    assert int(uninterrupted.optimizer.iterations) == 4 * 4
+
+    interrupted = sgd_model()
+    fit(interrupted, 3)
+    resumed = sgd_model()
+    state = restore_checkpoint(resumed, checkpoint_dir(cfg))
+    assert len(state["callbacks"][0]["best_weights"]) == len(resumed.weights)
+    fit(resumed, 10, state["epoch"], state)
+
+    assert int(resumed.optimizer.iterations) == int(uninterrupted.optimizer.iterations)
+    for expected, weight in zip(uninterrupted.get_weights(), resumed.get_weights()):
+        assert np.allclose(expected, weight, atol=1e-6)
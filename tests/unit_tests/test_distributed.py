@@ -0,0 +1,194 @@
+"""
+This module contains tests of the distributed training across several worker
+processes, and of the sharding of the data between the workers.
+"""
+
+import os
+import time
+
+import keras
+import numpy as np
+import omegaconf
+import pytest
+import tensorflow as tf
+
+from training.airflow.includes.distributed import (  # pylint: disable=no-name-in-module
+    _record_loss_fn,
+    fit,
+    get_strategy,
+    launch_workers,
+    steps_per_epoch,
+    worker_info,
+)
+from training.airflow.includes.input_pipeline import (  # pylint: disable=no-name-in-module
+    build_input_pipeline,
+)
+from training.airflow.includes.parse_data import (  # pylint: disable=no-name-in-module
+    add_derived_features,
+    num_processed_records,
+    read_raw_tfrecord,
+    write_processed_output,
+)
+
+mpath = os.path.dirname(__file__)
+
+raw_record = os.path.join(
+    mpath, "../integration_test_inference_pipeline/sample_data/28_07_24/part-r-00012"
+)
+
+KEYLIST = ["B4", "NDVI"]
+BATCH_SIZE = 8
+
+
+def _write_files(tmp_path, num_files: int) -> list:
+    dataset = read_raw_tfrecord(raw_record).map(add_derived_features)
+    num_records = int(dataset.reduce(0, lambda count, _: count + 1))
+    size = -(-num_records // num_files)
+    filelist = []
+    for k in range(num_files):
+        filelist.append(str(tmp_path / f"processed_part-r-{k:05d}"))
+        write_processed_output(dataset.skip(size * k).take(size), filelist[-1])
+    return filelist
+
+
+def _train_worker(filelist: list, output_dir: str) -> None:
+    """Train a small model on this worker's shard, and save its final weights."""
+    strategy = get_strategy(
+        omegaconf.OmegaConf.create({"enabled": True, "communication": "RING"})
+    )
+    num_workers, index = worker_info()
+    dataset = build_input_pipeline(
+        filelist,
+        BATCH_SIZE,
+        16,
+        KEYLIST,
+        seed=index,
+        num_shards=num_workers,
+        shard_index=index,
+    )
+    with strategy.scope():
+        keras.utils.set_random_seed(0)
+        model = keras.Sequential(
+            [
+                keras.Input(shape=(65, 65, len(KEYLIST))),
+                keras.layers.Conv2D(4, 3, strides=4, activation="relu"),
+                keras.layers.GlobalAveragePooling2D(),
+                keras.layers.Dense(4, activation="softmax"),
+            ]
+        )
+        model.compile(
+            loss="categorical_crossentropy", optimizer="adam", metrics=["accuracy"]
+        )
+    num_records = sum(num_processed_records(f) for f in filelist)
+    history = fit(
+        model,
+        strategy,
+        dataset.repeat(),
+        epochs=2,
+        steps_per_epoch=steps_per_epoch(num_records, BATCH_SIZE, num_workers),
+        validation_data=dataset.repeat(),
+        validation_steps=2,
+    )
+    np.savez(
+        os.path.join(output_dir, f"history-{index}.npz"),
+        **{key: np.asarray(value) for key, value in history.history.items()},
+    )
+    np.savez(os.path.join(output_dir, f"worker-{index}.npz"), *model.get_weights())
+
+
+def test_keras_internals_of_fit():
+    """
+    Test the parts of Keras which distributed.fit relies on beyond its public
+    API, so that a Keras upgrade which moves them fails here rather than in a
+    training: the loss tracker and the compiled metrics in model.metrics, the
+    loss of every record, and the logs of get_metrics_result
+    """
+    model = keras.Sequential(
+        [keras.Input(shape=(3,)), keras.layers.Dense(4, activation="softmax")]
+    )
+    model.compile(
+        loss="categorical_crossentropy", optimizer="adam", metrics=["accuracy"]
+    )
+    metrics = {metric.name: metric for metric in model.metrics}
+    assert sorted(metrics) == ["compile_metrics", "loss"]
+
+    x = np.ones((5, 3), "float32")
+    y = keras.utils.to_categorical([0, 1, 2, 3, 0], 4)
+    assert keras.utils.unpack_x_y_sample_weight((x, y))[2] is None
+    y_pred = model(x)
+    losses = _record_loss_fn(model)(y, y_pred)
+    assert tuple(losses.shape) == (5,)
+    metrics["loss"].update_state(tf.reduce_mean(losses), 5.0)
+    metrics["compile_metrics"].update_state(y, y_pred, None)
+    logs = model.get_metrics_result()
+    assert sorted(logs) == ["accuracy", "loss"]
+    assert np.isclose(float(logs["loss"]), float(tf.reduce_mean(losses)))
+
+
+def test_shards_partition_records(tmp_path):
+    """
+    Test that the shards of the workers hold every record exactly once, whether
+    they read their own files or share fewer files than workers
+    """
+    filelist = _write_files(tmp_path, 3)
+    for files in [filelist, filelist[:1]]:
+        expected = [b[0].numpy() for b in build_input_pipeline(files, 8, 1, KEYLIST)]
+        expected = np.concatenate(expected)
+        shards = []
+        for i in range(2):
+            pipeline = build_input_pipeline(
+                files, 8, 16, KEYLIST, num_shards=2, shard_index=i
+            )
+            shards.append(np.concatenate([b[0].numpy() for b in pipeline]))
+        assert len(shards[0]) + len(shards[1]) == len(expected)
+        merged = {image.tobytes() for shard in shards for image in shard}
+        assert merged == {image.tobytes() for image in expected}
+    assert steps_per_epoch(100, 8, 2) == 6
+    assert steps_per_epoch(10, 8, 2) == 1
+
+
+def _hang_or_fail() -> None:
+    """The chief hangs, like in a collective op, and the other worker fails."""
+    _, index = worker_info()
+    if index == 0:
+        time.sleep(600)
+    raise SystemExit(1)
+
+
+def test_multi_worker_training(tmp_path):
+    """
+    Test that two local worker processes train the same model on their own shards,
+    and end with the same weights
+    """
+    filelist = _write_files(tmp_path, 1)
+    # Ports chosen from the process id, so that concurrent test runs don't clash
+    base_port = 20000 + os.getpid() % 20000
+    launch_workers(2, _train_worker, (filelist, str(tmp_path)), base_port)
+    weights = [np.load(tmp_path / f"worker-{i}.npz") for i in range(2)]
+    assert len(weights[0].files) == 4
+    for name in weights[0].files:
+        assert np.all(np.isfinite(weights[0][name]))
+        assert np.array_equal(weights[0][name], weights[1][name])
+    # The metrics are computed over all the workers
+    histories = [np.load(tmp_path / f"history-{i}.npz") for i in range(2)]
+    assert sorted(histories[0].files) == [
+        "accuracy",
+        "loss",
+        "val_accuracy",
+        "val_loss",
+    ]
+    for name in histories[0].files:
+        assert len(histories[0][name]) == 2
+        assert np.allclose(histories[0][name], histories[1][name])
+    assert tf.distribute.get_strategy().num_replicas_in_sync == 1
+
+
+def test_failed_worker_stops_the_others():
+    """
+    Test that the failure of a worker other than the chief stops the chief and
+    is raised, instead of waiting for the chief forever
+    """
+    start = time.perf_counter()
+    with pytest.raises(RuntimeError, match=r"\[1\]"):
+        launch_workers(2, _hang_or_fail, base_port=20000 + os.getpid() % 20000)
+    assert time.perf_counter() - start < 300
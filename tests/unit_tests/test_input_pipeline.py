@@ -0,0 +1,121 @@
+"""
+This module contains tests of the tf.data pipeline feeding the processed TFRecord
+files to training.
+"""
+
+import os
+
+import keras
+import numpy as np
+
+from training.airflow.includes.input_pipeline import (  # pylint: disable=no-name-in-module
+    MEMORY_CACHE,
+    StepTimeCallback,
+    build_input_pipeline,
+    time_input_pipeline,
+)
+from training.airflow.includes.parse_data import (  # pylint: disable=no-name-in-module
+    add_derived_features,
+    read_processed_tfrecord,
+    read_raw_tfrecord,
+    write_processed_output,
+)
+
+mpath = os.path.dirname(__file__)
+
+raw_record = os.path.join(
+    mpath, "../integration_test_inference_pipeline/sample_data/28_07_24/part-r-00012"
+)
+
+
+def _sorted_images(images: np.ndarray) -> np.ndarray:
+    return images[np.lexsort(images.reshape(len(images), -1).T)]
+
+
+def test_build_input_pipeline(tmp_path):
+    """
+    Test that the pipeline returns every record of every file exactly once, in
+    batches, whatever the order and the cache, and that the files may use
+    different compressions
+    """
+    dataset = read_raw_tfrecord(raw_record).map(add_derived_features)
+    filelist = [str(tmp_path / "processed_part-r-00000"), str(tmp_path / "part-1")]
+    write_processed_output(dataset.take(30), filelist[0])
+    write_processed_output(dataset.skip(30), filelist[1], compression="GZIP")
+    keylist = ["B4", "NDVI"]
+    expected = [e[0].numpy() for e in read_processed_tfrecord(filelist, keylist)]
+    expected = _sorted_images(np.stack(expected))
+
+    for cache in [None, MEMORY_CACHE, str(tmp_path / "cache")]:
+        pipeline = build_input_pipeline(
+            filelist, batch_size=16, buffer_size=100, keylist=keylist, cache=cache
+        )
+        # The second epoch reads from the cache
+        for _ in range(2):
+            batches = list(pipeline)
+            assert all(b[0].shape[0] <= 16 for b in batches)
+            assert batches[0][1].shape[1:] == (4,)
+            images = np.concatenate([b[0].numpy() for b in batches])
+            assert np.array_equal(_sorted_images(images), expected)
+    assert os.listdir(tmp_path / "cache")
+
+    # Without shuffling, a deterministic pipeline keeps the order of the files
+    pipeline = build_input_pipeline(
+        filelist, 16, 100, keylist, shuffle=False, cycle_length=1, deterministic=True
+    )
+    images = np.concatenate([b[0].numpy() for b in pipeline])
+    ordered = [e[0].numpy() for e in read_processed_tfrecord(filelist, keylist)]
+    assert np.array_equal(images, np.stack(ordered))
+
+
+def test_shuffle_mixes_files(tmp_path):
+    """
+    Test that a small shuffle buffer still mixes the records of all the files from
+    the start, and that the order changes from one epoch to the next
+    """
+    dataset = read_raw_tfrecord(raw_record).map(add_derived_features)
+    filelist = []
+    for k in range(4):
+        filelist.append(str(tmp_path / f"processed_part-r-{k:05d}"))
+        write_processed_output(dataset.skip(15 * k).take(15), filelist[-1])
+    source = {
+        image.numpy().tobytes(): k
+        for k, f in enumerate(filelist)
+        for image, _ in read_processed_tfrecord(f, ["B4"])
+    }
+
+    pipeline = build_input_pipeline(
+        filelist, 8, 4, ["B4"], cycle_length=4, deterministic=True, seed=1
+    )
+    epochs = [[b[0].numpy() for b in pipeline] for _ in range(2)]
+    first_batch = {source[image.tobytes()] for image in epochs[0][0]}
+    assert first_batch == {0, 1, 2, 3}
+    assert not np.array_equal(np.concatenate(epochs[0]), np.concatenate(epochs[1]))
+
+
+def test_step_time_callback(tmp_path):
+    """
+    Test that the step times and the comparison with the input pipeline are added
+    to the logs of every epoch
+    """
+    dataset = read_raw_tfrecord(raw_record).map(add_derived_features)
+    processed = str(tmp_path / "processed_part-r-00000")
+    write_processed_output(dataset, processed)
+    pipeline = build_input_pipeline([processed], 8, 50, ["B4"])
+    input_seconds = time_input_pipeline(pipeline, 3)
+    assert input_seconds > 0
+
+    model = keras.Sequential(
+        [
+            keras.Input(shape=(65, 65, 1)),
+            keras.layers.GlobalAveragePooling2D(),
+            keras.layers.Dense(4, activation="softmax"),
+        ]
+    )
+    model.compile(loss="categorical_crossentropy", optimizer="adam")
+    history = model.fit(
+        pipeline, epochs=2, callbacks=[StepTimeCallback(input_seconds)], verbose=0
+    )
+    for key in ["step_time_ms", "step_time_p90_ms", "input_time_ms"]:
+        assert len(history.history[key]) == 2
+        assert all(value > 0 for value in history.history[key])
@@ -0,0 +1,99 @@
+"""
+This module contains tests of the score histogram metric and of the
+precision-recall curves derived from it.
+"""
+
+import keras
+import numpy as np
+
+from training.airflow.includes.metrics import (  # pylint: disable=no-name-in-module
+    PR_THRESHOLDS,
+    PRCurveCallback,
+    ScoreHistogram,
+    pr_curves,
+)
+
+
+def test_pr_curves():
+    """
+    Test that the curves derived from the histogram match those of Keras' metrics,
+    with sample weights and over several updates
+    """
+    rng = np.random.default_rng(0)
+    labels = keras.utils.to_categorical(rng.integers(0, 4, 1000), 4)
+    scores = rng.dirichlet(np.ones(4), 1000).astype("float32")
+    weights = rng.random(1000).astype("float32")
+    metric = ScoreHistogram(4)
+    for part in [slice(0, 300), slice(300, 1000)]:
+        metric.update_state(labels[part], scores[part], weights[part])
+    curves = pr_curves(np.asarray(metric.result()))
+
+    for i in range(4):
+        precision = keras.metrics.Precision(thresholds=list(PR_THRESHOLDS), class_id=i)
+        precision.update_state(labels, scores, weights)
+        recall = keras.metrics.Recall(thresholds=list(PR_THRESHOLDS), class_id=i)
+        recall.update_state(labels, scores, weights)
+        assert np.allclose(curves["precision"][i], precision.result(), atol=1e-6)
+        assert np.allclose(curves["recall"][i], recall.result(), atol=1e-6)
+    assert np.all((curves["average_precision"] > 0) & (curves["average_precision"] < 1))
+
+    # A perfect classifier
+    metric.reset_state()
+    metric.update_state(labels, labels)
+    curves = pr_curves(np.asarray(metric.result()))
+    assert np.allclose(curves["average_precision"], 1)
+
+
+def test_pr_curve_callback():
+    """
+    Test that the callback replaces the counts in the logs by the curves, for the
+    training and the validation data
+    """
+    rng = np.random.default_rng(0)
+    images = rng.random((64, 8)).astype("float32")
+    labels = keras.utils.to_categorical(rng.integers(0, 4, 64), 4)
+    model = keras.Sequential(
+        [keras.Input((8,)), keras.layers.Dense(4, activation="softmax")]
+    )
+    model.compile(loss="categorical_crossentropy", metrics=[ScoreHistogram(4)])
+    saved = []
+    batch_logs = []
+    # Sees the logs of every batch after the callback, like the progress bar
+    record = keras.callbacks.LambdaCallback(
+        on_train_batch_end=lambda _, logs: batch_logs.append(set(logs)),
+        on_test_batch_end=lambda _, logs: batch_logs.append(set(logs)),
+    )
+    history = model.fit(
+        images,
+        labels,
+        validation_data=(images, labels),
+        batch_size=16,
+        epochs=2,
+        verbose=0,
+        callbacks=[
+            PRCurveCallback(on_curves=lambda _, curves: saved.append(curves)),
+            record,
+        ],
+    )
+    assert "score_histogram" not in history.history
+    assert len(batch_logs) == 16
+    assert all("loss" in keys and "score_histogram" not in keys for keys in batch_logs)
+    for prefix in ["", "val_"]:
+        for i in range(4):
+            assert len(history.history[f"{prefix}ap_{i}"]) == 2
+            assert len(history.history[f"{prefix}pr_{i}"][0]) == len(PR_THRESHOLDS)
+    assert len(saved) == 2
+    assert saved[0]["val_re_3"] == history.history["val_re_3"][0].tolist()
+
+    # The logs of the epoch may be those of the last batch, without the counts
+    callback = PRCurveCallback()
+    callback.on_epoch_begin(0)
+    metric = ScoreHistogram(4)
+    metric.update_state(labels, model.predict(images, verbose=0))
+    counts = np.asarray(metric.result())
+    callback.on_train_batch_end(0, {"loss": 1.0, "score_histogram": counts})
+    logs = {"loss": 1.0}
+    callback.on_epoch_end(0, logs)
+    assert sorted(logs) == sorted(
+        ["loss"] + [f"{k}_{i}" for k in ["ap", "pr", "re"] for i in range(4)]
+    )
@@ -0,0 +1,57 @@
+"""
+This module contains tests of the construction of the baseline model with its
+numerical settings.
+"""
+
+import keras
+import numpy as np
+import omegaconf
+import pytest
+
+from training.airflow.includes.model import (  # pylint: disable=no-name-in-module
+    construct_baseline_model,
+    float32_model,
+)
+
+
+def _config(precision: str, jit_compile: bool) -> omegaconf.DictConfig:
+    return omegaconf.OmegaConf.create(
+        {
+            "features": {"list": ["B4", "NDVI"]},
+            "model": {
+                "learning_rate": 0.0005,
+                "precision": precision,
+                "jit_compile": jit_compile,
+            },
+        }
+    )
+
+
+def test_mixed_precision_model():
+    """
+    Test that a mixed precision model computes in bfloat16 with float32 weights
+    and outputs, trains with XLA, and converts to an equivalent float32 model
+    """
+    cfg = _config("mixed_bfloat16", True)
+    model = construct_baseline_model(cfg)
+    assert model.layers[0].compute_dtype == "bfloat16"
+    assert model.layers[0].variable_dtype == "float32"
+    assert model.layers[-1].compute_dtype == "float32"
+
+    rng = np.random.default_rng(0)
+    images = rng.random((16, 65, 65, 2)).astype("float32")
+    labels = keras.utils.to_categorical(rng.integers(0, 4, 16), 4)
+    history = model.fit(images, labels, batch_size=8, verbose=0)
+    assert np.isfinite(history.history["loss"][0])
+
+    copy = float32_model(model, cfg)
+    assert all(layer.compute_dtype == "float32" for layer in copy.layers)
+    assert keras.mixed_precision.global_policy().name == "float32"
+    probabilities = model.predict(images, verbose=0)
+    assert np.allclose(copy.predict(images, verbose=0), probabilities, atol=0.02)
+
+    float32_cfg = _config("float32", False)
+    baseline = construct_baseline_model(float32_cfg)
+    assert float32_model(baseline, float32_cfg) is baseline
+    with pytest.raises(ValueError):
+        construct_baseline_model(_config("float16", False))
@@ -0,0 +1,60 @@
+"""
+This module contains tests of the offline graph optimization of the ONNX model.
+"""
+
+import numpy as np
+import onnxruntime as rt
+import pytest
+
+from training.airflow.includes.optimize import (  # pylint: disable=no-name-in-module
+    LEVEL_KEY,
+    SOURCE_HASH_KEY,
+    VERSION_KEY,
+    optimize_model,
+    source_hash,
+)
+from training.airflow.includes.quantize import (  # pylint: disable=no-name-in-module
+    quantize_model,
+)
+
+from .test_quantize import _images, _onnx_model, _predict
+
+
+def test_optimize_model():
+    """
+    Test that the optimized graph fuses the convolution with its activation, and
+    the quantized operators of a static model, and predicts the same
+    """
+    model = _onnx_model()
+    x = _images(32)
+    optimized = optimize_model(model)
+    ops = [node.op_type for node in optimized.graph.node]
+    assert "FusedConv" in ops and "Relu" not in ops
+    assert np.allclose(_predict(optimized, x), _predict(model, x), atol=1e-5)
+    metadata = {prop.key: prop.value for prop in optimized.metadata_props}
+    assert metadata == {
+        VERSION_KEY: rt.__version__,
+        LEVEL_KEY: "extended",
+        SOURCE_HASH_KEY: source_hash(model.SerializeToString()),
+    }
+
+    # The optimized graph is loaded without optimizing it again
+    optimized = optimize_model(model, "all")
+    options = rt.SessionOptions()
+    options.graph_optimization_level = rt.GraphOptimizationLevel.ORT_DISABLE_ALL
+    session = rt.InferenceSession(
+        optimized.SerializeToString(), options, providers=["CPUExecutionProvider"]
+    )
+    assert np.allclose(
+        session.run(None, {"input": x})[0], _predict(model, x), atol=1e-5
+    )
+
+    quantized = quantize_model(model, "static", [_images(16, 2)])
+    optimized = optimize_model(quantized)
+    ops = [node.op_type for node in optimized.graph.node]
+    assert "QLinearConv" in ops and "Conv" not in ops
+    assert len(optimized.graph.node) < len(quantized.graph.node)
+    assert np.allclose(_predict(optimized, x), _predict(quantized, x), atol=0.02)
+
+    with pytest.raises(ValueError):
+        optimize_model(model, "layout")
@@ -3,13 +3,56 @@ This module contains test of various functions parsing and processing
 TFRecord files.
 """
 
+import json
 import os
+import shutil
+from functools import partial
 
+import boto3
+import numpy as np
+import omegaconf
+import tensorflow as tf
 from deepdiff import DeepDiff
+from moto import mock_aws
 
+from training.airflow.includes.band_statistics import (  # pylint: disable=no-name-in-module
+    batch_statistics,
+    dataset_statistics,
+    load_statistics,
+)
 from training.airflow.includes.parse_data import (  # pylint: disable=no-name-in-module
+    HASH_ALGORITHM,
     add_derived_features,
+    compute_hash,
+    count_records,
+    features_processed,
+    find_changed_files,
+    find_shards_to_process,
+    fingerprint_file,
+    keylist_processed,
+    list_processed_files,
+    parse_raw_tfrecord,
+    process_data,
+    process_one_dataset,
+    process_shard,
+    raw_keylist,
+    read_processed_records,
+    read_processed_tfrecord,
     read_raw_tfrecord,
+    serialize_data,
+    update_manifest,
+    veto_missing,
+    write_processed_output,
+)
+from training.airflow.includes.record_compression import (  # pylint: disable=no-name-in-module
+    detect_compression,
+)
+from training.airflow.includes.record_index import (  # pylint: disable=no-name-in-module
+    find_records,
+    load_index,
+    read_byte_range,
+    read_indexed_records,
+    split_byte_ranges,
 )
 
 mpath = os.path.dirname(__file__)
@@ -46,3 +89,443 @@ def test_add_derived_features():
     feats = updated_dataset.element_spec[0].keys()
     for feature in ["NDVI", "NDMI", "EVI"]:
         assert feature in feats
+
+
+def test_spectral_indices():
+    """
+    Test that the spectral indices match their definitions, whether they are
+    computed on the stacked bands of a batch or on single images
+    """
+    indices = ["NDVI", "SAVI", "NBR", "EVI"]
+    batched = read_raw_tfrecord(
+        raw_record, batch_size=32, unbatch=False, derived_features=indices
+    )
+    single = read_raw_tfrecord(raw_record, derived_features=indices).batch(32)
+    for x, _ in [next(iter(batched)), next(iter(single))]:
+        nir, red, blue, swir2 = (x[key].numpy() for key in ["B5", "B4", "B2", "B7"])
+        expected = {
+            "NDVI": (nir - red) / (nir + red + 1e-7),
+            "SAVI": 1.5 * (nir - red) / (nir + red + 0.5),
+            "NBR": (nir - swir2) / (nir + swir2 + 1e-7),
+            "EVI": 2.5 * (nir - red) / (nir + 6 * red - 7.5 * blue + 1),
+        }
+        for key, value in expected.items():
+            assert x[key].shape == (32, 65, 65, 1)
+            assert np.allclose(x[key].numpy(), value, rtol=1e-5, atol=1e-6)
+
+
+def test_read_computed_indices(tmp_path):
+    """
+    Test that reading an index which isn't stored gives the same result as
+    storing it
+    """
+    dataset = read_raw_tfrecord(raw_record).map(
+        partial(add_derived_features, indices=["NDVI", "SAVI"])
+    )
+    out_name = str(tmp_path / "processed")
+    write_processed_output(dataset, out_name, format_version=1)
+    stored = dict(features_processed, SAVI=features_processed["NDVI"])
+    keylist = ["B4", "SAVI", "NDVI"]
+    expected = list(read_processed_tfrecord(out_name, keylist, features=stored))
+    result = list(read_processed_tfrecord(out_name, keylist))
+    assert len(result) == len(expected)
+    for (res_x, res_y), (exp_x, exp_y) in zip(result, expected):
+        assert np.array_equal(res_y.numpy(), exp_y.numpy())
+        assert np.allclose(res_x.numpy(), exp_x.numpy(), rtol=1e-5, atol=1e-6)
+
+
+def test_parse_raw_record_batched():
+    """
+    Test that decoding the raw TFRecord in batches gives the same result
+    as decoding one record at a time
+    """
+    expected = list(read_raw_tfrecord(raw_record))
+    result = list(read_raw_tfrecord(raw_record, batch_size=32))
+    assert len(result) == len(expected)
+    for (res_x, res_y), (exp_x, exp_y) in zip(result, expected):
+        assert int(res_y) == int(exp_y)
+        for key, band in exp_x.items():
+            assert res_x[key].shape == (65, 65, 1)
+            assert np.array_equal(res_x[key].numpy(), band.numpy())
+
+
+def test_veto_raw(tmp_path):
+    """
+    Test that the veto on the raw uint8 bands drops exactly the images which the
+    veto on the normalized bands drops, and counts them
+    """
+    shard = str(tmp_path / "part-r-00000")
+    with tf.io.TFRecordWriter(shard) as file_writer:
+        for kind in range(20):
+            image = np.zeros((len(raw_keylist), 65, 65), np.uint8)
+            if kind % 4 == 1:
+                # Still blank
+                image[:] = 1
+            elif kind % 4 == 2:
+                # A single pixel above the threshold
+                image[3, 10, 10] = 2
+            elif kind % 4 == 3:
+                image[:] = np.arange(65, dtype=np.uint8)
+            feature = {
+                key: tf.train.Feature(
+                    bytes_list=tf.train.BytesList(value=[band.tobytes()])
+                )
+                for key, band in zip(raw_keylist, image)
+            }
+            feature["label"] = tf.train.Feature(
+                int64_list=tf.train.Int64List(value=[kind % 4])
+            )
+            example = tf.train.Example(features=tf.train.Features(feature=feature))
+            file_writer.write(example.SerializeToString())
+
+    expected = [
+        int(y)
+        for _, y in tf.data.TFRecordDataset(shard)
+        .map(parse_raw_tfrecord)
+        .filter(veto_missing)
+    ]
+    assert expected == [2, 3] * 5
+    for batch_size in [None, 8]:
+        vetoed = tf.Variable(0, dtype=tf.int64)
+        dataset = read_raw_tfrecord(shard, batch_size=batch_size, vetoed=vetoed)
+        assert [int(y) for _, y in dataset] == expected
+        assert int(vetoed.numpy()) == 10
+
+    out_name = process_one_dataset(shard)
+    assert load_statistics(out_name)["num_vetoed"] == 10
+    assert load_statistics(out_name)["num_records"] == 10
+
+
+def test_process_data_parallel(tmp_path):
+    """
+    Test that processing the data with several workers produces the same
+    output files and hash record as processing them serially
+    """
+    outputs = {}
+    records = {}
+    for num_workers in [1, 2]:
+        data_path = tmp_path / f"workers_{num_workers}"
+        data_path.mkdir()
+        for i in range(2):
+            shutil.copy(raw_record, data_path / f"part-r-0000{i}")
+        process_data(str(data_path), num_workers=num_workers)
+        records[num_workers] = json.loads(
+            (data_path / "data_hashes.json").read_text(encoding="utf-8")
+        )
+        # The modification times differ between the copies
+        for fingerprint in records[num_workers].values():
+            fingerprint.pop("mtime")
+        outputs[num_workers] = {
+            f.name: f.read_bytes()
+            for f in sorted(data_path.iterdir())
+            if f.name != "data_hashes.json"
+        }
+    assert "processed_part-r-00001" in outputs[1]
+    assert outputs[1] == outputs[2]
+    assert sorted(records[1]) == ["part-r-00000", "part-r-00001"]
+    assert records[1] == records[2]
+
+
+def test_process_data_incremental(tmp_path):
+    """
+    Test that only new, changed or outdated shards are reprocessed, and that
+    the outputs of removed shards are deleted
+    """
+    for i in range(3):
+        shutil.copy(raw_record, tmp_path / f"part-r-0000{i}")
+    process_data(str(tmp_path))
+    manifest_path = tmp_path / "data_hashes.json"
+    manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+    entry = manifest["part-r-00000"]
+    assert entry["output"] == "processed_part-r-00000"
+    assert entry["num_records"] > 0
+    assert entry["num_records"] + entry["num_vetoed"] == count_records(raw_record)
+
+    def output_mtimes():
+        return {
+            os.path.basename(f): os.stat(f).st_mtime_ns
+            for f in list_processed_files(str(tmp_path))
+        }
+
+    before = output_mtimes()
+    # A new shard, a removed shard and a shard built by older code
+    shutil.copy(raw_record, tmp_path / "part-r-00003")
+    os.remove(tmp_path / "part-r-00002")
+    manifest["part-r-00001"]["processing_version"] = 0
+    manifest_path.write_text(json.dumps(manifest), encoding="utf-8")
+    process_data(str(tmp_path))
+    after = output_mtimes()
+
+    assert sorted(after) == [f"processed_part-r-0000{i}" for i in [0, 1, 3]]
+    assert after["processed_part-r-00000"] == before["processed_part-r-00000"]
+    assert after["processed_part-r-00001"] != before["processed_part-r-00001"]
+    assert not os.path.exists(tmp_path / "processed_part-r-00002.index")
+    manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+    assert sorted(manifest) == [f"part-r-0000{i}" for i in [0, 1, 3]]
+
+
+def test_process_shards_separately(tmp_path):
+    """
+    Test that finding, processing and recording the shards one by one, as the
+    tasks of the processing DAG do, gives the same manifest as process_data
+    """
+    manifests = {}
+    for mode in ["together", "separately"]:
+        data_path = tmp_path / mode
+        data_path.mkdir()
+        for i in range(3):
+            shutil.copy(raw_record, data_path / f"part-r-0000{i}")
+        process_data(str(data_path))
+        shutil.copy(raw_record, data_path / "part-r-00003")
+        os.remove(data_path / "part-r-00002")
+        if mode == "together":
+            process_data(str(data_path))
+        else:
+            outdated = find_shards_to_process(str(data_path))
+            assert outdated == [str(data_path / "part-r-00003")]
+            entries = dict(process_shard(f) for f in outdated)
+            assert update_manifest(str(data_path), entries) == ["part-r-00002"]
+            assert not find_shards_to_process(str(data_path))
+            assert update_manifest(str(data_path), {}) == []
+        manifests[mode] = json.loads(
+            (data_path / "data_hashes.json").read_text(encoding="utf-8")
+        )
+        for entry in manifests[mode].values():
+            entry.pop("mtime")
+    assert sorted(manifests["separately"]) == [f"part-r-0000{i}" for i in [0, 1, 3]]
+    assert manifests["separately"] == manifests["together"]
+    assert not os.path.exists(tmp_path / "separately" / "processed_part-r-00002")
+
+
+def test_find_changed_files(tmp_path):
+    """
+    Test that files are only rehashed when their size or modification time
+    changed, and that legacy md5 records are still understood
+    """
+    data_file = tmp_path / "part-r-00000"
+    shutil.copy(raw_record, data_file)
+    assert compute_hash(str(data_file), "md5", chunk_size=1000) == compute_hash(
+        raw_record, "md5"
+    )
+    # The code hashes like the DAG, whose algorithm comes from the config
+    config = omegaconf.OmegaConf.load(
+        os.path.join(mpath, "../../setup/conf/training/data/default.yaml")
+    )
+    assert config.processing.hash_algorithm == HASH_ALGORITHM
+    assert fingerprint_file(str(data_file))["algorithm"] == HASH_ALGORITHM
+    fingerprints = {
+        "part-r-00000": fingerprint_file(str(data_file)),
+        "part-r-00001": compute_hash(str(data_file), "md5"),
+    }
+    shutil.copy(raw_record, tmp_path / "part-r-00001")
+    assert not find_changed_files(str(tmp_path), fingerprints, hash_workers=2)
+
+    # A stale hash goes unnoticed as long as the stat data matches
+    fingerprints["part-r-00000"]["hash"] = "0"
+    assert not find_changed_files(str(tmp_path), fingerprints)
+    fingerprints["part-r-00000"]["mtime"] -= 1
+    assert find_changed_files(str(tmp_path), fingerprints) == ["part-r-00000"]
+
+    # Same size, different content
+    content = bytearray(data_file.read_bytes())
+    content[-1] ^= 1
+    (tmp_path / "part-r-00001").write_bytes(bytes(content))
+    fingerprints["part-r-00000"] = fingerprint_file(str(data_file), "blake2b")
+    assert find_changed_files(str(tmp_path), fingerprints) == ["part-r-00001"]
+
+
+@mock_aws
+def test_processed_index(tmp_path):
+    """
+    Test that the index written with the processed file gives access to any
+    subset of the records, locally and with S3 ranged GETs, and splits the file
+    into byte ranges
+    """
+    dataset = read_raw_tfrecord(raw_record).map(add_derived_features)
+    out_name = str(tmp_path / "processed")
+    write_processed_output(dataset, out_name, assign_id=True)
+    records = [r.numpy() for r in tf.data.TFRecordDataset(out_name)]
+    index = load_index(out_name)
+    assert len(index["offsets"]) == len(index["ids"]) == len(records)
+
+    ids = [index["ids"][i] for i in [7, 2, 3, 30]]
+    result = list(read_processed_records(out_name, ids=ids, keylist=["B4", "NDVI"]))
+    expected = list(read_processed_tfrecord(out_name, keylist=["B4", "NDVI"]))
+    for res, i in zip(result, [7, 2, 3, 30]):
+        assert np.array_equal(res[0].numpy(), expected[i][0].numpy())
+
+    s3 = boto3.client("s3")
+    s3.create_bucket(Bucket="data")
+    s3.upload_file(out_name, "data", "processed")
+    requests = []
+
+    def fetch(start, end):
+        requests.append((start, end))
+        response = s3.get_object(
+            Bucket="data", Key="processed", Range=f"bytes={start}-{end - 1}"
+        )
+        return response["Body"].read()
+
+    positions = find_records(index, ids)
+    assert read_indexed_records(fetch, index, positions) == [
+        records[i] for i in positions
+    ]
+    # Records 2 and 3 are neighbours, so they are fetched together
+    assert len(requests) == 3
+
+    ranges = split_byte_ranges(index, 3)
+    assert len(ranges) == 3
+    assert ranges[-1][1] == os.path.getsize(out_name)
+    result = [r for start, end in ranges for r in read_byte_range(out_name, start, end)]
+    assert result == records
+
+
+def test_processed_compression(tmp_path):
+    """
+    Test that compressed processed files are detected and read like uncompressed
+    ones, alone, mixed with others, and through their index
+    """
+    dataset = read_raw_tfrecord(raw_record).map(add_derived_features)
+    reference = str(tmp_path / "processed")
+    write_processed_output(dataset, reference)
+    expected = [r.numpy() for r in tf.data.TFRecordDataset(reference)]
+    keylist = ["B4", "NDVI"]
+    assert detect_compression(reference) == ""
+
+    for compression in ["GZIP", "ZLIB"]:
+        out_name = str(tmp_path / f"processed_{compression}")
+        write_processed_output(dataset, out_name, True, compression=compression)
+        assert detect_compression(out_name) == compression
+        assert os.path.getsize(out_name) < os.path.getsize(reference)
+        assert count_records(out_name) == len(expected)
+        assert list(read_byte_range(out_name)) == [
+            r.numpy()
+            for r in tf.data.TFRecordDataset(out_name, compression_type=compression)
+        ]
+
+        mixed = list(read_processed_tfrecord([reference, out_name], keylist=keylist))
+        assert len(mixed) == 2 * len(expected)
+        for x, y in zip(mixed[: len(expected)], mixed[len(expected) :]):
+            assert np.array_equal(x[0].numpy(), y[0].numpy())
+
+        index = load_index(out_name)
+        assert index["compression"] == compression
+        ids = [index["ids"][i] for i in [7, 2, 30]]
+        result = list(read_processed_records(out_name, ids=ids, keylist=keylist))
+        for res, i in zip(result, [7, 2, 30]):
+            assert np.array_equal(res[0].numpy(), mixed[i][0].numpy())
+
+
+def test_processed_statistics(tmp_path):
+    """
+    Test that the statistics written with a processed file match those of the data
+    read back, and that the statistics of several files merge correctly
+    """
+    dataset = read_raw_tfrecord(raw_record).map(add_derived_features)
+    out_name = str(tmp_path / "processed_part-r-00000")
+    write_processed_output(dataset, out_name)
+    assert list_processed_files(str(tmp_path)) == [out_name]
+    keylist = ["B4", "B11", "NDVI", "EVI"]
+    images = np.stack(
+        [x.numpy() for x, _ in read_processed_tfrecord(out_name, keylist=keylist)]
+    )
+    labels = [
+        int(np.argmax(y)) for _, y in read_processed_tfrecord(out_name, keylist=keylist)
+    ]
+
+    stats = load_statistics(out_name)
+    assert stats["num_records"] == len(images)
+    assert stats["label_counts"] == np.bincount(labels, minlength=4).tolist()
+    for i, key in enumerate(keylist):
+        values = images[..., i].astype(np.float64).ravel()
+        feature = stats["features"][key]
+        assert feature["count"] == values.size
+        assert np.isclose(feature["mean"], values.mean(), rtol=1e-5)
+        assert np.isclose(feature["variance"], values.var(), rtol=1e-4)
+        assert np.isclose(feature["min"], values.min())
+        assert np.isclose(feature["max"], values.max())
+        assert sum(feature["histogram"]) == values.size
+    # The raw bands are stored as uint8, so their histograms are exact
+    histogram, _ = np.histogram(images[..., 0], bins=64, range=(0, 1))
+    assert stats["features"]["B4"]["histogram"] == histogram.tolist()
+
+    merged = dataset_statistics([out_name, out_name])
+    assert merged["num_records"] == 2 * stats["num_records"]
+    for key, feature in merged["features"].items():
+        assert np.isclose(feature["mean"], stats["features"][key]["mean"])
+        assert np.isclose(feature["variance"], stats["features"][key]["variance"])
+
+    # Undefined values of an index are left out
+    batch = batch_statistics(
+        {"EVI": tf.constant([0.5, np.nan, np.inf, -0.5], tf.float16)},
+        tf.constant([0, 1]),
+        {"EVI": (-1.0, 1.0)},
+        4,
+    )
+    assert int(batch["features"]["EVI"]["count"]) == 2
+    assert float(batch["features"]["EVI"]["mean"]) == 0.0
+
+
+def test_write_processed_output(tmp_path):
+    """
+    Test that the graph-mode serialization writes the same examples as
+    serialize_data, plus a random id if requested
+    """
+    dataset = read_raw_tfrecord(raw_record).map(add_derived_features)
+    out_name = str(tmp_path / "processed")
+    write_processed_output(dataset, out_name, assign_id=True, format_version=1)
+
+    expected = [tf.train.Example.FromString(serialize_data(e)) for e in dataset]
+    result = [
+        tf.train.Example.FromString(r.numpy())
+        for r in tf.data.TFRecordDataset(out_name)
+    ]
+    assert len(result) == len(expected)
+    ids = set()
+    for res, exp in zip(result, expected):
+        res_features = dict(res.features.feature)
+        ids.add(res_features.pop("id").bytes_list.value[0])
+        assert res_features == dict(exp.features.feature)
+    assert len(ids) == len(result)
+    assert all(len(id) == 32 for id in ids)
+
+
+def test_processed_format_versions(tmp_path):
+    """
+    Test that the compact version 2 of the processed format reads back the same
+    data as version 1, and that both versions can be read together
+    """
+    dataset = read_raw_tfrecord(raw_record).map(add_derived_features)
+    for version in [1, 2]:
+        write_processed_output(
+            dataset, str(tmp_path / f"v{version}"), format_version=version
+        )
+    assert os.path.getsize(tmp_path / "v2") < os.path.getsize(tmp_path / "v1") / 3
+
+    keylist = keylist_processed[:-1]
+    expected = list(read_processed_tfrecord(str(tmp_path / "v1"), keylist=keylist))
+    result = list(
+        read_processed_tfrecord(
+            [str(tmp_path / "v2"), str(tmp_path / "v1")], keylist=keylist
+        )
+    )
+    assert len(result) == 2 * len(expected)
+    for (res_x, res_y), (exp_x, exp_y) in zip(result, expected + expected):
+        assert np.array_equal(res_y.numpy(), exp_y.numpy())
+        # The raw bands are stored losslessly
+        assert np.array_equal(res_x[..., :11].numpy(), exp_x[..., :11].numpy())
+        # The derived features are stored as float16
+        assert np.allclose(res_x[..., 11:].numpy(), exp_x[..., 11:].numpy(), rtol=1e-3)
+
+
+def test_read_processed_only_requested_bands(tmp_path):
+    """
+    Test that only the requested bands are parsed, so a file which holds a
+    subset of the processed features can be read with the full description
+    """
+    dataset = read_raw_tfrecord(raw_record, keylist=["B2", "B3", "B4"])
+    out_name = str(tmp_path / "processed")
+    write_processed_output(dataset, out_name)
+    result = read_processed_tfrecord(out_name, keylist=["B4", "B2"])
+    assert result.element_spec[0].shape == (65, 65, 2)
+    assert len(list(result)) == len(list(dataset))
@@ -0,0 +1,190 @@
+"""
+This module contains tests of the INT8 quantization of the ONNX model.
+"""
+
+import numpy as np
+import omegaconf
+import onnx
+import onnxruntime as rt
+import pytest
+import tensorflow as tf
+from onnx import TensorProto, helper, numpy_helper
+
+from training.airflow.includes import quantize  # pylint: disable=no-name-in-module
+from training.airflow.includes.quantize import (  # pylint: disable=no-name-in-module
+    FLOAT_NAME,
+    evaluate_model,
+    quantize_for_registry,
+    quantize_model,
+)
+
+IMG_DIM = 17
+NUM_BANDS = 2
+NUM_CLASSES = 4
+
+
+def _onnx_model() -> onnx.ModelProto:
+    """A small CNN taking NHWC images, like the models exported by tf2onnx."""
+    rng = np.random.default_rng(0)
+    pooled = (IMG_DIM - 2) // 2
+    initializers = [
+        numpy_helper.from_array(
+            rng.normal(0, 0.3, (8, NUM_BANDS, 3, 3)).astype("float32"), "conv_w"
+        ),
+        numpy_helper.from_array(np.zeros(8, "float32"), "conv_b"),
+        numpy_helper.from_array(
+            rng.normal(0, 0.1, (8 * pooled * pooled, NUM_CLASSES)).astype("float32"),
+            "dense_w",
+        ),
+        numpy_helper.from_array(np.zeros(NUM_CLASSES, "float32"), "dense_b"),
+    ]
+    nodes = [
+        helper.make_node("Transpose", ["input"], ["nchw"], perm=[0, 3, 1, 2]),
+        helper.make_node("Conv", ["nchw", "conv_w", "conv_b"], ["conv"]),
+        helper.make_node("Relu", ["conv"], ["relu"]),
+        helper.make_node(
+            "MaxPool", ["relu"], ["pool"], kernel_shape=[2, 2], strides=[2, 2]
+        ),
+        helper.make_node("Flatten", ["pool"], ["flat"]),
+        helper.make_node("Gemm", ["flat", "dense_w", "dense_b"], ["logits"]),
+        helper.make_node("Softmax", ["logits"], ["output"], axis=-1),
+    ]
+    graph = helper.make_graph(
+        nodes,
+        "cnn",
+        [
+            helper.make_tensor_value_info(
+                "input", TensorProto.FLOAT, [None, IMG_DIM, IMG_DIM, NUM_BANDS]
+            )
+        ],
+        [
+            helper.make_tensor_value_info(
+                "output", TensorProto.FLOAT, [None, NUM_CLASSES]
+            )
+        ],
+        initializers,
+    )
+    return helper.make_model(graph, opset_imports=[helper.make_opsetid("", 15)])
+
+
+def _predict(model: onnx.ModelProto, x: np.ndarray) -> np.ndarray:
+    session = rt.InferenceSession(
+        model.SerializeToString(), providers=["CPUExecutionProvider"]
+    )
+    return session.run(None, {"input": x})[0]
+
+
+def _images(num: int, seed: int = 1) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return rng.uniform(size=(num, IMG_DIM, IMG_DIM, NUM_BANDS)).astype("float32")
+
+
+def test_quantize_model():
+    """
+    Test that both quantizations give a smaller model which predicts about the
+    same probabilities
+    """
+    model = _onnx_model()
+    x = _images(64)
+    expected = _predict(model, x)
+    calibration = [_images(16, seed) for seed in range(2, 6)]
+    for mode in ["dynamic", "static"]:
+        quantized = quantize_model(model, mode, calibration)
+        assert quantized.ByteSize() < model.ByteSize()
+        probabilities = _predict(quantized, x)
+        assert probabilities.shape == expected.shape
+        assert np.abs(probabilities - expected).mean() < 0.02
+        assert np.mean(probabilities.argmax(-1) == expected.argmax(-1)) > 0.9
+    with pytest.raises(ValueError):
+        quantize_model(model, "int4")
+    with pytest.raises(ValueError):
+        quantize_model(model, "static")
+
+
+def test_quantize_for_registry():
+    """
+    Test that the report compares the latency and the accuracy of every class
+    of both models, and that the quantized model is only published if it keeps
+    its accuracy
+    """
+    model = _onnx_model()
+    x = _images(96)
+    labels = _predict(model, x).argmax(-1)
+    dataset = tf.data.Dataset.from_tensor_slices(
+        (x, tf.one_hot(labels, NUM_CLASSES))
+    ).batch(16)
+    result = evaluate_model(model, [(x, labels)], NUM_CLASSES)
+    assert result["accuracy"] == 1
+    assert sum(c["count"] for c in result["per_class"].values()) == len(x)
+
+    cfg = omegaconf.OmegaConf.create(
+        {
+            "mode": "static",
+            "calibration_batches": 2,
+            "eval_batches": 4,
+            "per_channel": True,
+            "max_accuracy_drop": 1.0,
+        }
+    )
+    published, report = quantize_for_registry(model, dataset, cfg, NUM_CLASSES)
+    assert sorted(report["models"]) == [FLOAT_NAME, "static"]
+    assert report["num_records"] == 64
+    assert report["models"][FLOAT_NAME]["accuracy"] == 1
+    for result in report["models"].values():
+        assert sorted(result["per_class"]) == ["0", "1", "2", "3"]
+        assert result["latency_ms"]["p95"] >= result["latency_ms"]["p50"] > 0
+    if report["speedup"] > 1:
+        assert report["published"] == "static"
+        assert published.ByteSize() < model.ByteSize()
+
+    # The quantized model can't be more accurate than the labels allow
+    cfg.max_accuracy_drop = -1.0
+    published, report = quantize_for_registry(model, dataset, cfg, NUM_CLASSES)
+    assert report["published"] == FLOAT_NAME
+    assert published is model
+
+    # Without validation batches left, the float32 model is published
+    cfg.calibration_batches = 6
+    published, report = quantize_for_registry(model, dataset, cfg, NUM_CLASSES)
+    assert published is model
+    assert report is None
+
+
+def test_quantize_for_registry_splits_one_iteration(monkeypatch):
+    """
+    Test that the calibration and the evaluation batches never share a record,
+    even if the validation data is shuffled at every iteration
+    """
+    model = _onnx_model()
+    x = _images(96)
+    dataset = (
+        tf.data.Dataset.from_tensor_slices((x, tf.one_hot(np.arange(96) % 4, 4)))
+        .shuffle(96, seed=1)
+        .batch(16)
+    )
+    seen = {}
+
+    def record_calibration(model, _mode, calibration, _per_channel):
+        seen["calibration"] = np.concatenate(calibration)
+        return model
+
+    def record_evaluation(_model, batches, _num_classes):
+        seen["evaluation"] = np.concatenate([x for x, _ in batches])
+        return {"accuracy": 1.0, "latency_ms": {"p50": 1.0}}
+
+    monkeypatch.setattr(quantize, "quantize_model", record_calibration)
+    monkeypatch.setattr(quantize, "evaluate_model", record_evaluation)
+    cfg = omegaconf.OmegaConf.create(
+        {
+            "mode": "static",
+            "calibration_batches": 2,
+            "eval_batches": 4,
+            "per_channel": True,
+            "max_accuracy_drop": 1.0,
+        }
+    )
+    quantize_for_registry(model, dataset, cfg, NUM_CLASSES)
+    calibration = {image.tobytes() for image in seen["calibration"]}
+    evaluation = {image.tobytes() for image in seen["evaluation"]}
+    assert len(calibration) == 32 and len(evaluation) == 64
+    assert not calibration & evaluation
@@ -0,0 +1,87 @@
+"""
+This module contains tests of the rewriting of processed TFRecord files into
+balanced shards.
+"""
+
+import json
+import os
+
+import tensorflow as tf
+
+from training.airflow.includes.parse_data import (  # pylint: disable=no-name-in-module
+    add_derived_features,
+    list_processed_files,
+    read_raw_tfrecord,
+    write_processed_output,
+)
+from training.airflow.includes.record_index import (  # pylint: disable=no-name-in-module
+    file_fetcher,
+    load_index,
+    read_indexed_records,
+)
+from training.airflow.includes.reshard import (  # pylint: disable=no-name-in-module
+    MANIFEST_NAME,
+    plan_shards,
+    reshard_processed,
+)
+
+mpath = os.path.dirname(__file__)
+
+raw_record = os.path.join(
+    mpath, "../integration_test_inference_pipeline/sample_data/28_07_24/part-r-00012"
+)
+
+
+def test_plan_shards():
+    """
+    Test that the shards are contiguous and about equally heavy
+    """
+    assert plan_shards([1] * 10, 3) == [0, 3, 7, 10]
+    assert plan_shards([1] * 10, 1) == [0, 10]
+    assert plan_shards([5, 1, 1, 1, 1, 1], 2) == [0, 1, 6]
+
+
+def test_reshard_processed(tmp_path):
+    """
+    Test that unbalanced processed files are rewritten into balanced shards holding
+    the same records in the same order, with correct indices, and that the shards
+    are only rewritten when needed
+    """
+    dataset = read_raw_tfrecord(raw_record).map(add_derived_features)
+    write_processed_output(dataset, str(tmp_path / "processed_part-r-00000"), True)
+    write_processed_output(
+        dataset.take(5), str(tmp_path / "processed_part-r-00001"), True
+    )
+    sources = list_processed_files(str(tmp_path))
+    records = [r.numpy() for r in tf.data.TFRecordDataset(sources)]
+    ids = [i for f in sources for i in load_index(f)["ids"]]
+
+    out_dir = reshard_processed(str(tmp_path), target_records=10)
+    shards = list_processed_files(out_dir)
+    num_shards = -(-len(records) // 10)
+    assert len(shards) == num_shards
+    counts = [sum(1 for _ in tf.data.TFRecordDataset(s)) for s in shards]
+    assert max(counts) - min(counts) <= 1
+    assert [r.numpy() for r in tf.data.TFRecordDataset(shards)] == records
+
+    shard_ids = []
+    for shard in shards:
+        index = load_index(shard)
+        shard_ids.extend(index["ids"])
+        positions = list(range(len(index["offsets"])))
+        assert read_indexed_records(file_fetcher(shard), index, positions) == [
+            r.numpy() for r in tf.data.TFRecordDataset(shard)
+        ]
+    assert shard_ids == ids
+
+    # Nothing changed, so nothing is rewritten
+    mtime = os.path.getmtime(shards[0])
+    assert reshard_processed(str(tmp_path), target_records=10) == out_dir
+    assert os.path.getmtime(shards[0]) == mtime
+
+    # A size target spreads the bytes evenly
+    reshard_processed(str(tmp_path), target_mb=sum(map(len, records)) / 2e6)
+    with open(os.path.join(out_dir, MANIFEST_NAME), "r", encoding="utf-8") as fp:
+        manifest = json.load(fp)
+    assert len(manifest["shards"]) == 3
+    assert sum(s["num_records"] for s in manifest["shards"]) == len(records)
@@ -0,0 +1,139 @@
+"""
+This module contains tests of the hyperparameter sweep and of its successive
+halving scheduler.
+"""
+
+import json
+import os
+
+import numpy as np
+import omegaconf
+import pytest
+
+from training.airflow.includes.parse_data import (  # pylint: disable=no-name-in-module
+    add_derived_features,
+    read_raw_tfrecord,
+    write_processed_output,
+)
+from training.airflow.includes.sweep import (  # pylint: disable=no-name-in-module
+    AsyncSuccessiveHalving,
+    run_sweep,
+    rungs,
+    sample_trials,
+)
+
+mpath = os.path.dirname(__file__)
+
+raw_record = os.path.join(
+    mpath, "../integration_test_inference_pipeline/sample_data/28_07_24/part-r-00012"
+)
+
+SPACE = {
+    "training.model.learning_rate": {"low": 0.0001, "high": 0.01, "log": True},
+    "training.model.batch_size": {"low": 16, "high": 32},
+    "training.features.list": [["B4"], ["B4", "NDVI"]],
+}
+
+
+def test_sample_trials():
+    """
+    Test that the trials are drawn reproducibly within the search space
+    """
+    trials = sample_trials(SPACE, 50, seed=0)
+    assert trials == sample_trials(SPACE, 50, seed=0)
+    rates = np.array([t["training.model.learning_rate"] for t in trials])
+    assert np.all((rates >= 0.0001) & (rates <= 0.01))
+    # Log-uniform, so about half of them are below the geometric mean
+    assert 15 < np.sum(rates < 0.001) < 35
+    assert all(isinstance(t["training.model.batch_size"], int) for t in trials)
+    assert {tuple(t["training.features.list"]) for t in trials} == {
+        ("B4",),
+        ("B4", "NDVI"),
+    }
+
+
+def test_successive_halving():
+    """
+    Test the rungs, and that only the best third of the trials reported at a rung
+    go on
+    """
+    assert rungs(1, 27, 3) == [1, 3, 9]
+    assert rungs(2, 8, 2) == [2, 4]
+    scheduler = AsyncSuccessiveHalving([1, 3], 3)
+    # Epochs which aren't rungs never stop a trial
+    assert scheduler.report(2, 10.0)
+    assert scheduler.report(1, 0.5)
+    assert not scheduler.report(1, 0.7)
+    assert not scheduler.report(1, 0.6)
+    assert scheduler.report(1, 0.4)
+    assert not scheduler.report(3, float("nan"))
+    assert scheduler.results == {1: [0.5, 0.7, 0.6, 0.4]}
+    scheduler = AsyncSuccessiveHalving([1], 3, mode="max")
+    assert scheduler.report(1, 0.5)
+    assert scheduler.report(1, 0.7)
+    assert not scheduler.report(1, 0.6)
+    with pytest.raises(ValueError):
+        AsyncSuccessiveHalving([1], 3, mode="median")
+
+
+def test_run_sweep(tmp_path):
+    """
+    Test that a sweep runs its trials in worker processes from one cache, stops
+    some of them early, and reports the best one
+    """
+    dataset = read_raw_tfrecord(raw_record).map(add_derived_features)
+    for name in ["train", "val"]:
+        os.makedirs(tmp_path / name)
+        write_processed_output(dataset, str(tmp_path / name / "processed_part-r-00000"))
+    cfg = omegaconf.OmegaConf.create(
+        {
+            "training": {
+                "data": {
+                    "train_data": str(tmp_path / "train"),
+                    "val_data": str(tmp_path / "val"),
+                    "reshard": {"target_records": None, "target_mb": None},
+                },
+                "model": {
+                    "learning_rate": 0.0005,
+                    "batch_size": 64,
+                    "jit_compile": False,
+                    "precision": "float32",
+                },
+                "features": {"list": ["B4"]},
+                "sweep": {
+                    "num_trials": 6,
+                    "num_workers": 2,
+                    "threads_per_worker": 1,
+                    "min_epochs": 1,
+                    "max_epochs": 3,
+                    "reduction_factor": 3,
+                    "metric": "val_loss",
+                    "mode": "min",
+                    "seed": 0,
+                    "output_dir": str(tmp_path / "sweeps"),
+                    "cache_dir": str(tmp_path / "cache"),
+                    "space": SPACE,
+                },
+            }
+        }
+    )
+    best = run_sweep(cfg)
+    # One cache for each of the train and val data
+    assert sorted(os.listdir(tmp_path / "cache")) == ["train", "val"]
+    for name in ["train", "val"]:
+        assert len(os.listdir(tmp_path / "cache" / name)) == 1
+    (output,) = os.listdir(tmp_path / "sweeps")
+    with open(tmp_path / "sweeps" / output, "r", encoding="utf-8") as fp:
+        report = json.load(fp)
+    results = report["results"]
+    assert [r["trial"] for r in results] == list(range(6))
+    assert all(r["epochs"] in [1, 3] for r in results)
+    assert any(r["epochs"] == 1 for r in results)
+    assert report["epochs"] < 6 * 3
+    assert best["epochs"] == 3
+    assert best == report["best"]
+    assert best["metric"] == min(r["metric"] for r in results if r["epochs"] == 3)
+
+    cfg.training.sweep.space = {"training.model.dropout": [0.1, 0.2]}
+    with pytest.raises(ValueError):
+        run_sweep(cfg)
@@ -0,0 +1,125 @@
+"""
+This module contains tests of the memory-mapped tensor cache of processed
+TFRecord files.
+"""
+
+import json
+import os
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from training.airflow.includes.parse_data import (  # pylint: disable=no-name-in-module
+    add_derived_features,
+    features_processed,
+    read_processed_tfrecord,
+    read_raw_tfrecord,
+    write_processed_output,
+)
+from training.airflow.includes.tensor_cache import (  # pylint: disable=no-name-in-module
+    build_tensor_cache,
+    features_key,
+    load_tensor_cache,
+    read_tensor_cache,
+    source_hashes,
+)
+
+mpath = os.path.dirname(__file__)
+
+raw_record = os.path.join(
+    mpath, "../integration_test_inference_pipeline/sample_data/28_07_24/part-r-00012"
+)
+
+
+def test_tensor_cache(tmp_path):
+    """
+    Test that the cache holds the same data as the processed files, and that it
+    is reused when nothing has changed
+    """
+    processed = str(tmp_path / "processed_part-r-00012")
+    dataset = read_raw_tfrecord(raw_record).map(add_derived_features)
+    write_processed_output(dataset, processed, assign_id=True)
+    keylist = ["B4", "NDVI"]
+    features = {**features_processed, "id": tf.io.FixedLenFeature([], tf.string)}
+
+    cache_dir = build_tensor_cache([processed], keylist, str(tmp_path), features)
+    mtime = os.path.getmtime(os.path.join(cache_dir, "images.npy"))
+    assert build_tensor_cache([processed], keylist, str(tmp_path), features) == (
+        cache_dir
+    )
+    assert os.path.getmtime(os.path.join(cache_dir, "images.npy")) == mtime
+    # A different feature list gives a different cache
+    other_root = str(tmp_path / "other")
+    assert build_tensor_cache([processed], ["B4"], other_root) != cache_dir
+
+    expected = list(read_processed_tfrecord(processed, keylist, features))
+    images = np.stack([e[0].numpy() for e in expected])
+    labels = np.stack([e[1].numpy() for e in expected])
+    ids = np.stack([e[2].numpy() for e in expected])
+
+    result = list(read_tensor_cache(cache_dir, batch_size=32, shuffle=False))
+    assert np.array_equal(np.concatenate([r[0].numpy() for r in result]), images)
+    assert np.array_equal(np.concatenate([r[1].numpy() for r in result]), labels)
+
+    # Shuffling returns every record exactly once
+    result = list(read_tensor_cache(cache_dir, batch_size=32, seed=1))
+    shuffled = np.concatenate([r[0].numpy() for r in result])
+    assert not np.array_equal(shuffled, images)
+    assert np.array_equal(np.sort(shuffled, axis=0), np.sort(images, axis=0))
+
+    # Shuffled shards with the same seed split the records between them
+    shards = [
+        np.concatenate(
+            [r[0].numpy() for r in read_tensor_cache(cache_dir, 32, True, 1, 2, i)]
+        )
+        for i in range(2)
+    ]
+    assert len(shards[0]) + len(shards[1]) == len(images)
+    assert np.array_equal(
+        np.sort(np.concatenate(shards), axis=0), np.sort(images, axis=0)
+    )
+
+    # A cache serves any subset of its features
+    result = list(read_tensor_cache(cache_dir, 32, shuffle=False, keylist=["NDVI"]))
+    assert np.array_equal(
+        np.concatenate([r[0].numpy() for r in result]), images[..., 1:]
+    )
+    with pytest.raises(ValueError):
+        read_tensor_cache(cache_dir, 32, keylist=["B2"])
+
+    assert np.array_equal(load_tensor_cache(cache_dir)[2], ids)
+
+
+def test_tensor_cache_uses_manifest_and_prunes(tmp_path):
+    """
+    Test that the hashes of processed files come from the manifest of the
+    processing when there is one, and that a new cache replaces the older ones
+    """
+    processed = str(tmp_path / "processed_part-r-00012")
+    dataset = read_raw_tfrecord(raw_record).map(add_derived_features)
+    write_processed_output(dataset, processed)
+    hashed = source_hashes([processed])
+
+    entry = {"hash": "0", "mtime": 1, "output": "processed_part-r-00012"}
+    manifest = tmp_path / "data_hashes.json"
+    manifest.write_text(json.dumps({"part-r-00012": entry}), encoding="utf-8")
+    recorded = source_hashes([processed])
+    assert recorded != hashed
+    # The modification time of the raw shard doesn't matter, its hash does
+    entry["mtime"] = 2
+    manifest.write_text(json.dumps({"part-r-00012": entry}), encoding="utf-8")
+    assert source_hashes([processed]) == recorded
+
+    cache_root = str(tmp_path / "cache")
+    old_cache = build_tensor_cache([processed], ["B4"], cache_root)
+    # The raw shard changed, so it was processed again
+    entry["hash"] = "1"
+    manifest.write_text(json.dumps({"part-r-00012": entry}), encoding="utf-8")
+    new_cache = build_tensor_cache([processed], ["B4"], cache_root)
+    assert new_cache != old_cache
+    assert os.listdir(cache_root) == [os.path.basename(new_cache)]
+
+    # Models with the same name and different features keep their own caches
+    assert features_key(["B4"]) != features_key(["B4", "NDVI"])
+    assert features_key(["B4", "NDVI"]) != features_key(["NDVI", "B4"])
@@ -1,21 +1,127 @@
+import os
 from datetime import datetime
+from typing import Dict, List
 
 from airflow import DAG
+from airflow.datasets import Dataset
+from airflow.exceptions import AirflowSkipException
 from airflow.operators.python import PythonOperator
-from includes.parse_data import process_data
-from includes.train import train_model
+from hydra import compose, initialize_config_dir
+from includes.parse_data import (
+    find_shards_to_process,
+    limit_threads,
+    process_shard,
+    update_manifest,
+)
+from includes.reshard import MANIFEST_NAME, RESHARD_DIR, reshard_processed
+from includes.sweep import run_sweep
+from includes.train import CONFIG_PATH, train_model
+from omegaconf import DictConfig
 
 TRAIN_DATA_PATH = "data/droughtwatch_data/train"
 VAL_DATA_PATH = "data/droughtwatch_data/val"
+DATA_PATHS = [TRAIN_DATA_PATH, VAL_DATA_PATH]
+
+# The processed train and val data, updated by the data_processing DAG whenever
+# they change, which triggers the DAGs scheduled on them: every DAG which reads
+# them, so that none runs before they are processed or on outdated data
+AIRFLOW_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TRAIN_DATASET = Dataset(f"file://{os.path.join(AIRFLOW_DIR, TRAIN_DATA_PATH)}")
+VAL_DATASET = Dataset(f"file://{os.path.join(AIRFLOW_DIR, VAL_DATA_PATH)}")
+# A training which fails, e.g. runs out of memory, is retried from its latest
+# checkpoint, see setup/conf/training/callbacks
+TRAINING_RETRIES = 2
+# Number of process_shard tasks run at once, the only setting of it. It has to be
+# known when the DAGs are parsed, while the configs are only composed when the
+# tasks run, so that a config error fails a task rather than the whole file.
+PROCESSING_TASKS = 4
+
+
+def load_config(job_name: str) -> DictConfig:
+    """
+    Compose the configs in setup/conf. Only called when a task runs, never when
+    the DAGs are parsed.
+    """
+    with initialize_config_dir(
+        version_base=None, config_dir=CONFIG_PATH, job_name=job_name
+    ):
+        return compose(config_name="config")
 
 
-def process_raw_data():
-    process_data(TRAIN_DATA_PATH)
-    process_data(VAL_DATA_PATH)
-
-
-def create_data_process_task(task_id=None):
-    return PythonOperator(task_id=task_id, python_callable=process_raw_data)
+def find_raw_shards() -> List[Dict[str, str]]:
+    """
+    Find the train and val files which are new, changed or outdated, using the
+    settings in setup/conf/training/data. Every one is processed by its own
+    process_shard task.
+    """
+    processing = load_config("find_shards").training.data.processing
+    return [
+        {"file_name": file_name}
+        for data_path in DATA_PATHS
+        for file_name in find_shards_to_process(
+            data_path,
+            hash_workers=processing.hash_workers,
+            derived_features=list(processing.derived_features),
+            compression=processing.compression,
+        )
+    ]
+
+
+def process_raw_shard(file_name: str) -> Dict:
+    """
+    Process a single train or val file, and return its manifest entry
+    """
+    processing = load_config("process_shard").training.data.processing
+    limit_threads(processing.threads_per_worker)
+    name, entry = process_shard(
+        file_name,
+        hash_algorithm=processing.hash_algorithm,
+        derived_features=list(processing.derived_features),
+        compression=processing.compression,
+    )
+    return {"data_path": os.path.dirname(file_name), "name": name, "entry": entry}
+
+
+def _reshard_manifest(data_path: str) -> str | None:
+    """The content of the manifest of the balanced shards, if any"""
+    manifest_path = os.path.join(data_path, RESHARD_DIR, MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as fp:
+        return fp.read()
+
+
+def record_processed_data(ti) -> None:
+    """
+    Record the processed files in the manifests of train and val, and rewrite
+    them into balanced shards if configured. If nothing changed, the task is
+    skipped, so that the datasets aren't updated and no training is triggered.
+    """
+    cfg = load_config("record_processed")
+    processing = cfg.training.data.processing
+    reshard = cfg.training.data.reshard
+    results = list(ti.xcom_pull(task_ids="process_shard") or [])
+    changed = False
+    for data_path in DATA_PATHS:
+        entries = {
+            result["name"]: result["entry"]
+            for result in results
+            if result["data_path"] == data_path
+        }
+        removed = update_manifest(data_path, entries)
+        changed = changed or bool(entries) or bool(removed)
+        if reshard.target_records is not None or reshard.target_mb is not None:
+            before = _reshard_manifest(data_path)
+            reshard_processed(
+                data_path,
+                target_records=reshard.target_records,
+                target_mb=reshard.target_mb,
+                compression=processing.compression,
+                hash_algorithm=processing.hash_algorithm,
+            )
+            changed = changed or _reshard_manifest(data_path) != before
+    if not changed:
+        raise AirflowSkipException("The processed data is up to date")
 
 
 def train_baseline():
@@ -47,43 +153,81 @@ def train_ndvi():
     train_model(override_args={"training.features.list": ["NDVI"]})
 
 
+def sweep_models():
+    """
+    Search the model and feature settings, with the sweep settings in
+    setup/conf/training/sweep
+    """
+    run_sweep(load_config("sweep"))
+
+
 with DAG(
-    dag_id="baseline",
+    dag_id="data_processing",
     schedule_interval="@daily",
     start_date=datetime(2024, 7, 21),
     catchup=False,
-) as dag1:
-    process = create_data_process_task(task_id="data_processing")
-    train = PythonOperator(task_id="training", python_callable=train_baseline)
+) as dag0:
+    find = PythonOperator(task_id="find_shards", python_callable=find_raw_shards)
+    # One task per file, train and val alike, PROCESSING_TASKS at once
+    process = PythonOperator.partial(
+        task_id="process_shard",
+        python_callable=process_raw_shard,
+        max_active_tis_per_dag=PROCESSING_TASKS,
+    ).expand(op_kwargs=find.output)
+    # Also runs when there was nothing to process, as shards may have been removed
+    record = PythonOperator(
+        task_id="record_processed",
+        python_callable=record_processed_data,
+        outlets=[TRAIN_DATASET, VAL_DATASET],
+        trigger_rule="none_failed",
+    )
+
+    find >> process >> record  # pylint: disable=W0104
 
-    process >> train  # pylint: disable=W0104
+with DAG(
+    dag_id="baseline",
+    schedule=[TRAIN_DATASET, VAL_DATASET],
+    start_date=datetime(2024, 7, 21),
+    catchup=False,
+) as dag1:
+    train = PythonOperator(
+        task_id="training", python_callable=train_baseline, retries=TRAINING_RETRIES
+    )
 
 with DAG(
     dag_id="useful",
-    schedule_interval=None,
+    schedule=[TRAIN_DATASET, VAL_DATASET],
     start_date=datetime(2021, 8, 24),
+    catchup=False,
 ) as dag2:
-    process = create_data_process_task(task_id="data_processing")
-    train = PythonOperator(task_id="training", python_callable=train_useful)
-
-    process >> train  # pylint: disable=W0104
+    train = PythonOperator(
+        task_id="training", python_callable=train_useful, retries=TRAINING_RETRIES
+    )
 
 with DAG(
     dag_id="dummy",
-    schedule_interval=None,
+    schedule=[TRAIN_DATASET, VAL_DATASET],
     start_date=datetime(2021, 8, 24),
+    catchup=False,
 ) as dag3:
-    process = create_data_process_task(task_id="data_processing")
-    train = PythonOperator(task_id="training", python_callable=train_dummy)
-
-    process >> train  # pylint: disable=W0104
+    train = PythonOperator(
+        task_id="training", python_callable=train_dummy, retries=TRAINING_RETRIES
+    )
 
 with DAG(
     dag_id="ndvi",
-    schedule_interval=None,
+    schedule=[TRAIN_DATASET, VAL_DATASET],
     start_date=datetime(2021, 8, 24),
+    catchup=False,
 ) as dag3:
-    process = create_data_process_task(task_id="data_processing")
-    train = PythonOperator(task_id="training", python_callable=train_ndvi)
+    train = PythonOperator(
+        task_id="training", python_callable=train_ndvi, retries=TRAINING_RETRIES
+    )
 
-    process >> train  # pylint: disable=W0104
+with DAG(
+    dag_id="sweep",
+    schedule=[TRAIN_DATASET, VAL_DATASET],
+    start_date=datetime(2021, 8, 24),
+    catchup=False,
+) as dag4:
+    sweep = PythonOperator(task_id="sweep", python_callable=sweep_models)
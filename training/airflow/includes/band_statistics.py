@@ -0,0 +1,261 @@
+"""Contains the statistics written next to every processed TFRecord file.
+
+The statistics of every band are computed batch by batch in the pipeline which
+writes the processed file, see write_processed_output in parse_data, so that they
+cost no extra pass over the data. The batches, and then the files, are merged
+with the parallel form of Welford's algorithm, which gives the statistics of a
+whole dataset, e.g. to standardize the bands for training, or as a reference
+profile for drift checks.
+"""
+
+import json
+import logging
+from itertools import zip_longest
+from typing import Dict, List, Tuple
+
+import tensorflow as tf
+from rich.logging import RichHandler
+from rich.traceback import install
+from tensorflow import Tensor
+
+# Sets up the logger to work with rich
+logger = logging.getLogger(__name__)
+logger.addHandler(RichHandler(rich_tracebacks=True, markup=True))
+logger.setLevel("INFO")
+# Setup rich to get nice tracebacks
+install()
+
+# Suffix of the statistics written next to every processed file, see
+# save_statistics
+STATS_SUFFIX = ".stats.json"
+# Number of bins of the histograms of every band in the statistics
+STATS_NUM_BINS = 64
+
+
+def _uint8_statistics(band: Tensor, value_range: Tuple[float, float]) -> Dict:
+    """The statistics of a band stored as uint8, see batch_statistics. They are all
+    derived from the counts of the 256 possible values, which takes a single pass
+    over the data and is exact."""
+    counts = tf.math.bincount(
+        tf.cast(tf.reshape(band, [-1]), tf.int32),
+        minlength=256,
+        maxlength=256,
+        dtype=tf.int64,
+    )
+    values = tf.range(256, dtype=tf.float64) / 255.0
+    weights = tf.cast(counts, tf.float64)
+    count = tf.reduce_sum(counts)
+    mean = tf.reduce_sum(weights * values) / tf.cast(count, tf.float64)
+    present = tf.boolean_mask(values, counts > 0)
+    lower, upper = value_range
+    bins = tf.cast(
+        tf.clip_by_value(
+            tf.floor((values - lower) / (upper - lower) * STATS_NUM_BINS),
+            0,
+            STATS_NUM_BINS - 1,
+        ),
+        tf.int32,
+    )
+    return {
+        "count": count,
+        "mean": mean,
+        "variance": tf.reduce_sum(weights * tf.square(values - mean))
+        / tf.cast(count, tf.float64),
+        "min": tf.reduce_min(present),
+        "max": tf.reduce_max(present),
+        "histogram": tf.math.unsorted_segment_sum(counts, bins, STATS_NUM_BINS),
+        "range": tf.constant(value_range, tf.float64),
+    }
+
+
+def batch_statistics(
+    stored: Dict[str, Tensor],
+    label: Tensor,
+    value_ranges: Dict[str, Tuple[float, float]],
+    num_classes: int,
+) -> Dict[str, Dict[str, Tensor] | Tensor]:
+    """Compute the statistics of a batch of records, to be merged with those of
+    the other batches by merge_statistics. Non-finite values, where the
+    denominator of a spectral index vanishes, are left out.
+
+    Args:
+        stored (Dict[str, Tensor]): Keys are bands, values are the batched bands as
+            they are stored, see quantize_bands in parse_data
+        label (Tensor): The batched labels
+        value_ranges (Dict[str, Tuple[float, float]]): The lower and upper edges
+            of the histogram of every band, see stats_value_range in parse_data
+        num_classes (int): The number of classes of the labels
+
+    Returns:
+        Dict[str, Dict[str, Tensor] | Tensor]: The statistics, in the format of
+            load_statistics
+    """
+    features = {}
+    for key, band in stored.items():
+        if band.dtype == tf.uint8:
+            features[key] = _uint8_statistics(band, value_ranges[key])
+            continue
+        values = tf.reshape(tf.cast(band, tf.float32), [-1])
+        # An index is undefined where its denominator vanishes, leave these out
+        values = tf.boolean_mask(values, tf.math.is_finite(values))
+        count = tf.cast(tf.size(values), tf.float32)
+        mean = tf.math.divide_no_nan(tf.reduce_sum(values), count)
+        features[key] = {
+            "count": tf.size(values, tf.int64),
+            "mean": mean,
+            "variance": tf.math.divide_no_nan(
+                tf.reduce_sum(tf.square(values - mean)), count
+            ),
+            "min": tf.reduce_min(values),
+            "max": tf.reduce_max(values),
+            # Values outside the range are counted in the first or last bin
+            "histogram": tf.histogram_fixed_width(
+                values, value_ranges[key], nbins=STATS_NUM_BINS, dtype=tf.int64
+            ),
+            "range": tf.constant(value_ranges[key], tf.float64),
+        }
+    return {
+        "num_records": tf.size(label, tf.int64),
+        "label_counts": tf.math.bincount(
+            tf.cast(label, tf.int32),
+            minlength=num_classes,
+            maxlength=num_classes,
+            dtype=tf.int64,
+        ),
+        "features": features,
+    }
+
+
+def empty_statistics(num_classes: int = 0) -> Dict:
+    """The statistics of no records at all, of num_classes classes, see
+    load_statistics. With no classes, they take those of the statistics they are
+    merged with."""
+    return {
+        "num_records": 0,
+        "num_vetoed": 0,
+        "label_counts": [0] * num_classes,
+        "features": {},
+    }
+
+
+def merge_statistics(first: Dict, second: Dict) -> Dict:
+    """Merge the statistics of two sets of records, e.g. two batches or two files.
+
+    The means and variances are combined with the parallel form of Welford's
+    algorithm (Chan et al.), which is exact and numerically stable.
+
+    Args:
+        first (Dict): The statistics of the first set, see load_statistics
+        second (Dict): The statistics of the second set
+
+    Returns:
+        Dict: The statistics of both sets
+    """
+    features = {}
+    for key in {**first["features"], **second["features"]}:
+        a, b = first["features"].get(key), second["features"].get(key)
+        if a is None or b is None:
+            features[key] = a or b
+            continue
+        count = int(a["count"]) + int(b["count"])
+        if not int(a["count"]) or not int(b["count"]):
+            features[key] = b if int(b["count"]) else a
+            continue
+        delta = float(b["mean"]) - float(a["mean"])
+        mean = float(a["mean"]) + delta * int(b["count"]) / count
+        m2 = (
+            float(a["variance"]) * int(a["count"])
+            + float(b["variance"]) * int(b["count"])
+            + delta**2 * int(a["count"]) * int(b["count"]) / count
+        )
+        features[key] = {
+            "count": count,
+            "mean": mean,
+            "variance": m2 / count,
+            "min": min(float(a["min"]), float(b["min"])),
+            "max": max(float(a["max"]), float(b["max"])),
+            "histogram": [
+                int(x) + int(y) for x, y in zip(a["histogram"], b["histogram"])
+            ],
+            "range": a["range"],
+        }
+    for key, stats in features.items():
+        # Batches come straight from tf.data, so convert them to plain types
+        features[key] = {
+            "count": int(stats["count"]),
+            "mean": float(stats["mean"]),
+            "variance": float(stats["variance"]),
+            "min": float(stats["min"]),
+            "max": float(stats["max"]),
+            "histogram": [int(x) for x in stats["histogram"]],
+            "range": [float(x) for x in stats["range"]],
+        }
+    return {
+        "num_records": int(first["num_records"]) + int(second["num_records"]),
+        "num_vetoed": first.get("num_vetoed", 0) + second.get("num_vetoed", 0),
+        "label_counts": [
+            int(x) + int(y)
+            for x, y in zip_longest(
+                first["label_counts"], second["label_counts"], fillvalue=0
+            )
+        ],
+        "features": features,
+    }
+
+
+def stats_name(file_name: str) -> str:
+    """The name of the statistics of a processed file.
+
+    Args:
+        file_name (str): The name of the processed file
+
+    Returns:
+        str: The name of the statistics
+    """
+    return f"{file_name}{STATS_SUFFIX}"
+
+
+def save_statistics(file_name: str, statistics: Dict) -> None:
+    """Write the statistics of a processed file, see load_statistics.
+
+    Args:
+        file_name (str): The name of the processed file
+        statistics (Dict): The statistics of its records
+    """
+    with open(stats_name(file_name), "w", encoding="utf-8") as fw:
+        json.dump(statistics, fw, indent=4)
+
+
+def load_statistics(file_name: str) -> Dict:
+    """Load the statistics of a processed file, as written by write_processed_output.
+
+    Args:
+        file_name (str): The name of the processed file
+
+    Returns:
+        Dict: The statistics. "num_records" is the number of records,
+            "num_vetoed" the number of blank records dropped before they were
+            written, if known, and "label_counts" the number of records of every
+            class. "features" holds,
+            for every band, the number of pixels ("count"), their "mean",
+            "variance", "min" and "max", and a "histogram" of STATS_NUM_BINS
+            bins over "range", whose edge bins include the values outside it.
+    """
+    with open(stats_name(file_name), "r", encoding="utf-8") as fp:
+        return json.load(fp)
+
+
+def dataset_statistics(filelist: List[str]) -> Dict:
+    """Merge the statistics of many processed files, e.g. to get the constants to
+    standardize the bands for training, or a reference profile for drift checks.
+
+    Args:
+        filelist (List[str]): The processed files
+
+    Returns:
+        Dict: The statistics of all the records, see load_statistics
+    """
+    statistics = empty_statistics()
+    for file_name in filelist:
+        statistics = merge_statistics(statistics, load_statistics(file_name))
+    return statistics
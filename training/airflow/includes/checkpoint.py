@@ -0,0 +1,272 @@
+"""Contains the checkpointing of long trainings, so that a training which is
+interrupted, e.g. killed for running out of memory, resumes from its latest
+checkpoint when it is run again instead of starting from the first epoch.
+
+A checkpoint holds the weights of the model, the state of its optimizer (the
+step, the learning rate and the moments), the number of finished epochs, and
+the counters of the early stopping and learning rate callbacks, and the best
+weights kept by the early stopping callback, in a single .npz file. The values
+are copied to host memory at the end of an epoch, which is fast, while the file
+is written by a background thread as the next epoch trains. See the
+configuration options in setup/conf/training/callbacks, which also has the
+settings of the early stopping and learning rate callbacks.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import keras
+import numpy as np
+import omegaconf
+from omegaconf import DictConfig
+from rich.logging import RichHandler
+from rich.traceback import install
+
+from . import parse_data
+
+# Sets up the logger to work with rich
+logger = logging.getLogger(__name__)
+logger.addHandler(RichHandler(rich_tracebacks=True, markup=True))
+logger.setLevel("INFO")
+# Setup rich to get nice tracebacks
+install()
+
+CHECKPOINT_NAME = "checkpoint.npz"
+# The attributes of the callbacks which count epochs across the training
+CALLBACK_STATE = ["wait", "best", "best_epoch", "cooldown_counter"]
+# The weights of the best epoch, kept by EarlyStopping to restore them at the end
+BEST_WEIGHTS = "best_weights"
+
+
+def checkpoint_dir(cfg: DictConfig) -> str:
+    """The directory of the checkpoints of a training, which is the same every
+    time the same training is run on the same data, and differs for any other
+    settings or data.
+
+    The data is identified by the manifests of the processed train and val data,
+    which change whenever a shard is added, removed or processed again, so that a
+    training on new data doesn't resume from a checkpoint left by a failed one.
+
+    Args:
+        cfg (DictConfig): All settings
+
+    Returns:
+        str: The directory
+    """
+    config = omegaconf.OmegaConf.to_container(cfg, resolve=True)
+    # These don't change what is trained
+    for key in ["logging", "callbacks"]:
+        config.pop(key, None)
+    config["manifests"] = [
+        parse_data.load_manifest(data_path)
+        for data_path in [cfg.data.train_data, cfg.data.val_data]
+    ]
+    digest = hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+    return os.path.join(cfg.callbacks.checkpoint.dir, f"{cfg.model.name}-{digest[:16]}")
+
+
+def _snapshot(
+    model: keras.Model, epoch: int, callbacks: List[keras.callbacks.Callback]
+) -> Dict[str, np.ndarray]:
+    """Copy the state of a training to host memory."""
+    arrays = {f"model_{i}": np.array(v) for i, v in enumerate(model.weights)}
+    arrays.update(
+        {f"optimizer_{i}": np.array(v) for i, v in enumerate(model.optimizer.variables)}
+    )
+    state = {
+        "epoch": epoch,
+        "callbacks": [
+            {
+                key: np.asarray(getattr(callback, key)).item()
+                for key in CALLBACK_STATE
+                if hasattr(callback, key)
+            }
+            for callback in callbacks
+        ],
+    }
+    for j, callback in enumerate(callbacks):
+        for i, weight in enumerate(getattr(callback, BEST_WEIGHTS, None) or []):
+            arrays[f"{BEST_WEIGHTS}_{j}_{i}"] = weight
+    arrays["state"] = np.array(json.dumps(state))
+    return arrays
+
+
+def _write(directory: str, arrays: Dict[str, np.ndarray]) -> None:
+    """Write a checkpoint, replacing the previous one only once it is complete."""
+    os.makedirs(directory, exist_ok=True)
+    tmp_name = os.path.join(directory, f"tmp_{CHECKPOINT_NAME}")
+    np.savez(tmp_name, **arrays)
+    os.replace(tmp_name, os.path.join(directory, CHECKPOINT_NAME))
+
+
+def restore_checkpoint(model: keras.Model, directory: str) -> Dict[str, Any] | None:
+    """Restore the weights and the optimizer state of a model from the latest
+    checkpoint of a directory, if there is one. With a distribution strategy,
+    this has to be called in its scope.
+
+    Args:
+        model (keras.Model): The compiled model
+        directory (str): The directory of the checkpoints
+
+    Raises:
+        ValueError: If the checkpoint is of another model
+
+    Returns:
+        Dict[str, Any] | None: The state of the training, with the number of
+            finished epochs in "epoch" and the state of the callbacks in
+            "callbacks", or None if there is no checkpoint
+    """
+    file_name = os.path.join(directory, CHECKPOINT_NAME)
+    if not os.path.isfile(file_name):
+        return None
+    with np.load(file_name) as checkpoint:
+        arrays = dict(checkpoint)
+    # The optimizer creates its variables when it first updates the weights
+    model.optimizer.build(model.trainable_variables)
+    for prefix, variables in [
+        ("model", model.weights),
+        ("optimizer", model.optimizer.variables),
+    ]:
+        names = [name for name in arrays if name.startswith(f"{prefix}_")]
+        if len(names) != len(variables):
+            raise ValueError(
+                f"The checkpoint {file_name} has {len(names)} {prefix} variables,"
+                f" the model {len(variables)}"
+            )
+        for i, variable in enumerate(variables):
+            variable.assign(arrays[f"{prefix}_{i}"])
+    state = json.loads(str(arrays["state"]))
+    for j, values in enumerate(state["callbacks"]):
+        names = [name for name in arrays if name.startswith(f"{BEST_WEIGHTS}_{j}_")]
+        if names:
+            values[BEST_WEIGHTS] = [
+                arrays[f"{BEST_WEIGHTS}_{j}_{i}"] for i in range(len(names))
+            ]
+    logger.info(f"Resuming from {file_name}, after epoch {state['epoch']}")
+    return state
+
+
+def remove_checkpoint(directory: str) -> None:
+    """Delete the checkpoints of a training, once it is done.
+
+    Args:
+        directory (str): The directory of the checkpoints
+    """
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+class CheckpointCallback(keras.callbacks.Callback):
+    """Save a checkpoint every few epochs, in a background thread.
+
+    Only one checkpoint is written at a time: if the previous one isn't written
+    yet when the next is due, the training waits for it, and it waits for the
+    last one at the end of the training. The callback also restores the counters
+    of the early stopping and learning rate callbacks, and the best weights of
+    the early stopping callback, at the start of a resumed training, so it has
+    to come after them.
+
+    Args:
+        directory (str): The directory of the checkpoints
+        every_epochs (int, optional): The number of epochs between two
+            checkpoints. Defaults to 1.
+        callbacks (List[keras.callbacks.Callback] | None, optional): The
+            callbacks whose counters are saved. Defaults to None.
+        state (Dict[str, Any] | None, optional): The state of a resumed
+            training, as returned by restore_checkpoint. Defaults to None.
+        write (bool, optional): Whether to write the checkpoints, e.g. only on
+            the chief of a distributed training. Defaults to True.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        every_epochs: int = 1,
+        callbacks: List[keras.callbacks.Callback] | None = None,
+        state: Dict[str, Any] | None = None,
+        write: bool = True,
+    ):
+        super().__init__()
+        self.directory = directory
+        self.every_epochs = every_epochs
+        self.callbacks = callbacks or []
+        self.state = state
+        self.write = write
+        self._executor: ThreadPoolExecutor | None = None
+        self._pending: Future | None = None
+
+    def on_train_begin(self, logs=None):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        if self.state is not None:
+            for callback, values in zip(self.callbacks, self.state["callbacks"]):
+                for key, value in values.items():
+                    setattr(callback, key, value)
+
+    def _wait(self) -> None:
+        if self._pending is not None:
+            # This re-raises any exception from the writer
+            self._pending.result()
+            self._pending = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        if not self.write or (epoch + 1) % self.every_epochs != 0:
+            return
+        self._wait()
+        arrays = _snapshot(self.model, epoch + 1, self.callbacks)
+        self._pending = self._executor.submit(_write, self.directory, arrays)
+
+    def on_train_end(self, logs=None):
+        self._wait()
+        self._executor.shutdown()
+
+
+def training_callbacks(
+    cfg: DictConfig, state: Dict[str, Any] | None = None, write: bool = True
+) -> List[keras.callbacks.Callback]:
+    """The early stopping, learning rate and checkpoint callbacks enabled in the
+    settings, in the order they have to be called in.
+
+    Args:
+        cfg (DictConfig): All settings
+        state (Dict[str, Any] | None, optional): The state of a resumed
+            training, as returned by restore_checkpoint. Defaults to None.
+        write (bool, optional): Whether to write the checkpoints. Defaults to True.
+
+    Returns:
+        List[keras.callbacks.Callback]: The callbacks
+    """
+    settings = cfg.callbacks
+    callbacks = []
+    if settings.early_stopping.enabled:
+        callbacks.append(
+            keras.callbacks.EarlyStopping(
+                monitor=settings.early_stopping.monitor,
+                patience=settings.early_stopping.patience,
+                min_delta=settings.early_stopping.min_delta,
+                restore_best_weights=settings.early_stopping.restore_best_weights,
+            )
+        )
+    if settings.reduce_lr.enabled:
+        callbacks.append(
+            keras.callbacks.ReduceLROnPlateau(
+                monitor=settings.reduce_lr.monitor,
+                factor=settings.reduce_lr.factor,
+                patience=settings.reduce_lr.patience,
+                min_lr=settings.reduce_lr.min_lr,
+            )
+        )
+    if settings.checkpoint.enabled:
+        callbacks.append(
+            CheckpointCallback(
+                checkpoint_dir(cfg),
+                settings.checkpoint.every_epochs,
+                callbacks=list(callbacks),
+                state=state,
+                write=write,
+            )
+        )
+    return callbacks
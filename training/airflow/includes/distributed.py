@@ -0,0 +1,362 @@
+"""Contains routines to train on several workers with
+tf.distribute.MultiWorkerMirroredStrategy.
+
+Every worker runs the same training with the same config. The workers are
+described by the TF_CONFIG environment variable of every worker: the addresses
+of all of them, and the index of the one it is set for. On a cluster, TF_CONFIG
+is set on every host before starting the training there. launch_workers starts
+the workers as local processes instead, e.g. to use all the cores of one host or
+to test a distributed training on one machine. Every worker reads its own shard
+of the data, and worker 0, the chief, is the one which logs and saves the model.
+See the configuration options in setup/conf/training/distributed.
+"""
+
+import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+from typing import Any, Callable, Dict, Iterator, List, Sequence, Tuple
+
+import keras
+import numpy as np
+import tensorflow as tf
+from omegaconf import DictConfig
+from rich.logging import RichHandler
+from rich.traceback import install
+from tensorflow.data import Dataset
+
+# Sets up the logger to work with rich
+logger = logging.getLogger(__name__)
+logger.addHandler(RichHandler(rich_tracebacks=True, markup=True))
+logger.setLevel("INFO")
+# Setup rich to get nice tracebacks
+install()
+
+TF_CONFIG = "TF_CONFIG"
+
+
+def local_workers(num_workers: int, base_port: int) -> List[str]:
+    """The addresses of workers running as processes of this host.
+
+    Args:
+        num_workers (int): The number of workers
+        base_port (int): The port of the first worker, the others use the next ones
+
+    Returns:
+        List[str]: The address of every worker
+    """
+    return [f"localhost:{base_port + i}" for i in range(num_workers)]
+
+
+def tf_config(workers: List[str], index: int) -> str:
+    """The TF_CONFIG of a worker.
+
+    Args:
+        workers (List[str]): The addresses of all the workers, as host:port
+        index (int): The index of the worker in workers
+
+    Returns:
+        str: The value of TF_CONFIG
+    """
+    return json.dumps(
+        {"cluster": {"worker": workers}, "task": {"type": "worker", "index": index}}
+    )
+
+
+def worker_info() -> Tuple[int, int]:
+    """The number of workers and the index of this one, from TF_CONFIG.
+
+    Returns:
+        Tuple[int, int]: The number of workers and the index of this worker,
+            1 and 0 without TF_CONFIG
+    """
+    if TF_CONFIG not in os.environ:
+        return 1, 0
+    config = json.loads(os.environ[TF_CONFIG])
+    return len(config["cluster"]["worker"]), config["task"]["index"]
+
+
+def get_strategy(cfg: DictConfig) -> tf.distribute.Strategy:
+    """Create the distribution strategy of the training. It has to be created
+    before TensorFlow runs anything else.
+
+    Args:
+        cfg (DictConfig): The distributed settings
+
+    Raises:
+        RuntimeError: If distributed training is enabled but TF_CONFIG isn't set
+
+    Returns:
+        tf.distribute.Strategy: A MultiWorkerMirroredStrategy if distributed
+            training is enabled, else the default strategy
+    """
+    if not cfg.enabled:
+        return tf.distribute.get_strategy()
+    if TF_CONFIG not in os.environ:
+        raise RuntimeError(
+            f"Distributed training needs {TF_CONFIG}, set it on every worker or"
+            " start local workers with launch_workers"
+        )
+    implementation = getattr(
+        tf.distribute.experimental.CommunicationImplementation, cfg.communication
+    )
+    strategy = tf.distribute.MultiWorkerMirroredStrategy(
+        communication_options=tf.distribute.experimental.CommunicationOptions(
+            implementation=implementation
+        )
+    )
+    num_workers, index = worker_info()
+    logger.info(f"Training as worker {index} of {num_workers}")
+    return strategy
+
+
+def _record_loss_fn(model: keras.Model) -> Callable[..., tf.Tensor]:
+    """The compiled loss of the model, for every record rather than averaged."""
+    loss_fn = keras.losses.get(model.loss)
+    if isinstance(loss_fn, keras.losses.Loss):
+        return loss_fn.call
+    return loss_fn
+
+
+def _train_step_fn(
+    model: keras.Model, strategy: tf.distribute.Strategy
+) -> Callable[..., None]:
+    """A training step on a batch of every replica, with the compiled loss and
+    metrics of the model."""
+    loss_fn = _record_loss_fn(model)
+    metrics = {metric.name: metric for metric in model.metrics}
+
+    def step(data):
+        x, y, sample_weight = keras.utils.unpack_x_y_sample_weight(data)
+        with tf.GradientTape() as tape:
+            y_pred = model(x, training=True)
+            losses = tf.cast(loss_fn(y, y_pred), tf.float32)
+            # Averaged over the global batch, as the gradients are summed
+            loss = tf.nn.compute_average_loss(losses, sample_weight=sample_weight)
+            if model.losses:
+                loss += tf.nn.scale_regularization_loss(tf.add_n(model.losses))
+        gradients = tape.gradient(loss, model.trainable_variables)
+        model.optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+        batch_size = tf.cast(tf.shape(losses)[0], tf.float32)
+        if sample_weight is not None:
+            losses *= tf.cast(sample_weight, tf.float32)
+        # Weighted by the batch size, as the metric is summed over the replicas
+        metrics["loss"].update_state(tf.reduce_mean(losses), batch_size)
+        metrics["compile_metrics"].update_state(y, y_pred, sample_weight)
+
+    @tf.function
+    def train_step(iterator):
+        strategy.run(step, args=(next(iterator),))
+
+    return train_step
+
+
+def _test_step_fn(
+    model: keras.Model, strategy: tf.distribute.Strategy
+) -> Callable[..., None]:
+    """An evaluation step on a batch of every replica."""
+    loss_fn = _record_loss_fn(model)
+    metrics = {metric.name: metric for metric in model.metrics}
+
+    def step(data):
+        x, y, sample_weight = keras.utils.unpack_x_y_sample_weight(data)
+        y_pred = model(x, training=False)
+        losses = tf.cast(loss_fn(y, y_pred), tf.float32)
+        if sample_weight is not None:
+            losses *= tf.cast(sample_weight, tf.float32)
+        batch_size = tf.cast(tf.shape(losses)[0], tf.float32)
+        metrics["loss"].update_state(tf.reduce_mean(losses), batch_size)
+        metrics["compile_metrics"].update_state(y, y_pred, sample_weight)
+
+    @tf.function
+    def test_step(iterator):
+        strategy.run(step, args=(next(iterator),))
+
+    return test_step
+
+
+def _metrics_result(model: keras.Model, prefix: str = "") -> Dict[str, Any]:
+    """The values of the metrics of the model, as fit logs them."""
+    logs = {}
+    for name, value in model.get_metrics_result().items():
+        value = np.asarray(value)
+        logs[f"{prefix}{name}"] = float(value) if value.ndim == 0 else value
+    return logs
+
+
+def _run_steps(
+    step_fn: Callable[[Iterator], None],
+    iterator: Iterator,
+    num_steps: int,
+    on_batch_begin: Callable[[int], None],
+    on_batch_end: Callable[[int], None],
+) -> None:
+    """Run some steps on the next batches of a distributed iterator. The iterator
+    goes on where the previous call stopped, so that every epoch reads the next
+    batches of the repeated data instead of its first ones."""
+    for step in range(num_steps):
+        on_batch_begin(step)
+        step_fn(iterator)
+        on_batch_end(step)
+
+
+def fit(
+    model: keras.Model,
+    strategy: tf.distribute.Strategy,
+    dataset: Dataset,
+    epochs: int,
+    steps_per_epoch: int,
+    validation_data: Dataset | None = None,
+    validation_steps: int | None = None,
+    callbacks: List[keras.callbacks.Callback] | None = None,
+    initial_epoch: int = 0,
+) -> keras.callbacks.History:
+    """Train a model on the shard of this worker, in step with the other workers.
+
+    This stands in for model.fit, which Keras 3 can't run with a
+    MultiWorkerMirroredStrategy. The model has to be built and compiled in the
+    scope of the strategy. The training uses the compiled loss, optimizer and
+    metrics of the model, and calls the callbacks as model.fit does, with the
+    same logs. The datasets are read as they are, without any further sharding
+    or rebatching, and by a single iterator over all the epochs, so they have to
+    repeat. Class weights have to be given as sample weights in the datasets.
+
+    Args:
+        model (keras.Model): The compiled model
+        strategy (tf.distribute.Strategy): The distribution strategy
+        dataset (Dataset): The batches of training data of this worker
+        epochs (int): The number of epochs
+        steps_per_epoch (int): The number of steps of an epoch, the same for
+            every worker
+        validation_data (Dataset | None, optional): The batches of validation
+            data of this worker. Defaults to None.
+        validation_steps (int | None, optional): The number of validation steps,
+            the same for every worker. Defaults to None.
+        callbacks (List[keras.callbacks.Callback] | None, optional): The
+            callbacks. Defaults to None.
+        initial_epoch (int, optional): The epoch at which to start, e.g. to
+            resume a training. Defaults to 0.
+
+    Returns:
+        keras.callbacks.History: The history of the training
+    """
+    callback_list = keras.callbacks.CallbackList(
+        callbacks,
+        add_history=True,
+        model=model,
+        epochs=epochs,
+        steps=steps_per_epoch,
+        verbose=0,
+    )
+    train_step = _train_step_fn(model, strategy)
+    test_step = _test_step_fn(model, strategy)
+    iterator = iter(strategy.distribute_datasets_from_function(lambda _: dataset))
+    if validation_data is not None:
+        val_iterator = iter(
+            strategy.distribute_datasets_from_function(lambda _: validation_data)
+        )
+    model.stop_training = False
+    callback_list.on_train_begin()
+    logs = {}
+    for epoch in range(initial_epoch, epochs):
+        model.reset_metrics()
+        callback_list.on_epoch_begin(epoch)
+        _run_steps(
+            train_step,
+            iterator,
+            steps_per_epoch,
+            callback_list.on_train_batch_begin,
+            callback_list.on_train_batch_end,
+        )
+        logs = _metrics_result(model)
+        if validation_data is not None:
+            model.reset_metrics()
+            callback_list.on_test_begin()
+            _run_steps(
+                test_step,
+                val_iterator,
+                validation_steps,
+                callback_list.on_test_batch_begin,
+                callback_list.on_test_batch_end,
+            )
+            val_logs = _metrics_result(model, "val_")
+            callback_list.on_test_end(val_logs)
+            logs.update(val_logs)
+        callback_list.on_epoch_end(epoch, logs)
+        if model.stop_training:
+            break
+    callback_list.on_train_end(logs)
+    return model.history
+
+
+def steps_per_epoch(num_records: int, batch_size: int, num_workers: int) -> int:
+    """The number of steps of an epoch, the same for every worker. Otherwise the
+    workers with more batches would wait for the others forever.
+
+    Args:
+        num_records (int): The number of records of all the workers
+        batch_size (int): The batch size of every worker
+        num_workers (int): The number of workers
+
+    Returns:
+        int: The number of steps, at least 1
+    """
+    return max(num_records // (batch_size * num_workers), 1)
+
+
+def _run_worker(
+    config: str, target: Callable[..., Any], args: Sequence[Any]
+) -> None:  # pragma: no cover
+    """The entry point of a local worker process."""
+    os.environ[TF_CONFIG] = config
+    target(*args)
+
+
+def launch_workers(
+    num_workers: int,
+    target: Callable[..., Any],
+    args: Sequence[Any] = (),
+    base_port: int = 23456,
+) -> None:
+    """Run a function in several local worker processes, each with the TF_CONFIG
+    of one worker, and wait for all of them.
+
+    The processes are spawned, so that none of them inherits a TensorFlow
+    runtime from this process, and target and args have to be picklable.
+
+    Args:
+        num_workers (int): The number of workers
+        target (Callable[..., Any]): The function run by every worker
+        args (Sequence[Any], optional): The arguments of target. Defaults to ().
+        base_port (int, optional): The port of the first worker. Defaults to 23456.
+
+    Raises:
+        RuntimeError: If a worker fails, in which case the others are stopped
+    """
+    workers = local_workers(num_workers, base_port)
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=_run_worker, args=(tf_config(workers, i), target, args))
+        for i in range(num_workers)
+    ]
+    logger.info(f"Starting {num_workers} local workers on {', '.join(workers)}")
+    for process in processes:
+        process.start()
+    failed = []
+    running = {process.sentinel: i for i, process in enumerate(processes)}
+    # Wait for any worker to exit, not in order, since the others hang in their
+    # collective ops when one of them fails
+    while running and not failed:
+        for sentinel in multiprocessing.connection.wait(list(running)):
+            i = running.pop(sentinel)
+            processes[i].join()
+            if processes[i].exitcode != 0:
+                failed.append(i)
+    if failed:
+        # The others would wait for the failed worker forever
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        raise RuntimeError(f"The workers {failed} failed")
@@ -0,0 +1,262 @@
+"""Contains the tf.data pipeline which feeds the processed TFRecords to training,
+and a callback telling whether training waits for it.
+
+The pipeline reads several processed files at once with a parallel interleave,
+parses the records with a parallel map, optionally caches the parsed records in
+memory or on disk, and prefetches batches so that the next ones are prepared while
+the model trains on the current one. All of it is set in setup/conf/training/data.
+"""
+
+import logging
+import os
+import time
+from functools import partial
+from typing import Dict, List
+
+import keras
+import numpy as np
+import tensorflow as tf
+from rich.logging import RichHandler
+from rich.traceback import install
+from tensorflow.data import Dataset
+
+from . import parse_data, record_compression, tensor_cache
+
+# Sets up the logger to work with rich
+logger = logging.getLogger(__name__)
+logger.addHandler(RichHandler(rich_tracebacks=True, markup=True))
+logger.setLevel("INFO")
+# Setup rich to get nice tracebacks
+install()
+
+AUTOTUNE = tf.data.AUTOTUNE
+# The value of the cache setting which keeps the parsed records in memory
+MEMORY_CACHE = "memory"
+# Training is reported as input-bound when the input pipeline alone takes at
+# least this fraction of the time of a training step
+INPUT_BOUND_FRACTION = 0.8
+
+
+def cache_file(
+    cache: str,
+    filelist: List[str],
+    keylist: List[str],
+    shuffle: bool,
+    num_shards: int = 1,
+    shard_index: int = 0,
+) -> str:
+    """The file in which tf.data caches the parsed records of some processed files.
+    It is keyed like the tensor caches, so a change of the files or the features
+    never reuses a stale cache.
+
+    Args:
+        cache (str): The directory of the cache files
+        filelist (List[str]): The processed files
+        keylist (List[str]): The features read from them
+        shuffle (bool): Whether the files are shuffled, which changes the order of
+            the cached records
+        num_shards (int, optional): The number of shards the records are split
+            into. Defaults to 1.
+        shard_index (int, optional): The shard of the records which is cached.
+            Defaults to 0.
+
+    Returns:
+        str: The prefix of the cache files
+    """
+    key = tensor_cache.cache_key(tensor_cache.source_hashes(filelist), list(keylist))
+    os.makedirs(cache, exist_ok=True)
+    name = f"tfdata_{key}{'_shuffled' if shuffle else ''}"
+    if num_shards > 1:
+        name += f"_shard-{shard_index}-of-{num_shards}"
+    return os.path.join(cache, name)
+
+
+def build_input_pipeline(
+    filelist: List[str],
+    batch_size: int,
+    buffer_size: int,
+    keylist: List[str],
+    shuffle: bool = True,
+    cycle_length: int = AUTOTUNE,
+    num_parallel_calls: int = AUTOTUNE,
+    prefetch: int = AUTOTUNE,
+    deterministic: bool = False,
+    cache: str | None = None,
+    seed: int | None = None,
+    num_shards: int = 1,
+    shard_index: int = 0,
+) -> Dataset:
+    """Build the dataset of batches read from processed files.
+
+    The files are read by a parallel interleave and the records are parsed by a
+    parallel map. If shuffle is True, the order of the files is drawn again every
+    epoch, and the interleave takes one record at a time from cycle_length files,
+    so the shuffle buffer receives records already mixed from many files. The
+    buffer can then stay small, whereas reading the files one after the other
+    would need a buffer of a whole file to mix two of them. Balanced shards, see
+    reshard.py, make every file last about as long in the interleave. If
+    deterministic is False, the interleave and the map hand over whichever records
+    are ready first, so a slow file or record doesn't stall the others, but the
+    order of the records changes from run to run.
+
+    With num_shards > 1, e.g. one shard per worker of a distributed training,
+    the pipeline only returns the records of shard shard_index. If there are at
+    least num_shards files, every shard reads its own files. Otherwise every
+    shard reads all the files, in the same order, and keeps every num_shards-th
+    record.
+
+    The cache comes after the parsing, so only the first epoch reads and parses
+    the files, and before the shuffle buffer, so that every epoch is still
+    shuffled. The later epochs replay the order of the first one through the
+    buffer, though, so the files are not shuffled again.
+
+    Args:
+        filelist (List[str]): The processed TFRecord files
+        batch_size (int): The batch size
+        buffer_size (int): The buffer size for shuffling
+        keylist (List[str]): The features to return
+        shuffle (bool, optional): Determines if we shuffle the dataset.
+            Defaults to True.
+        cycle_length (int, optional): Number of files read concurrently, which
+            also sets how many files the records are mixed from. Defaults to
+            AUTOTUNE.
+        num_parallel_calls (int, optional): Number of files opened and records
+            parsed in parallel. Defaults to AUTOTUNE.
+        prefetch (int, optional): Number of batches prepared ahead, 0 disables
+            prefetching. Defaults to AUTOTUNE.
+        deterministic (bool, optional): Keep the order of the records
+            reproducible. Defaults to False.
+        cache (str | None, optional): MEMORY_CACHE, or the directory in which to
+            cache the parsed records on disk. Defaults to None, meaning no cache.
+        seed (int | None, optional): Seed for the shuffling. Defaults to None.
+        num_shards (int, optional): The number of shards the records are split
+            into. Defaults to 1.
+        shard_index (int, optional): The shard to return. Defaults to 0.
+
+    Returns:
+        Dataset: Batches of images and one-hot encoded labels
+    """
+    filelist = list(filelist)
+    shard_records = num_shards > 1 and len(filelist) < num_shards
+    if num_shards > 1 and not shard_records:
+        filelist = filelist[shard_index::num_shards]
+    compressions = [record_compression.detect_compression(f) for f in filelist]
+    files = Dataset.from_tensor_slices((filelist, compressions))
+    # Every shard has to see the records in the same order to keep its share
+    if shuffle and not shard_records:
+        # Reshuffled every epoch
+        files = files.shuffle(len(filelist), seed=seed, reshuffle_each_iteration=True)
+    if cycle_length > 0:
+        cycle_length = min(cycle_length, len(filelist))
+    records = files.interleave(
+        lambda f, c: tf.data.TFRecordDataset(f, compression_type=c),
+        cycle_length=cycle_length,
+        block_length=1,
+        num_parallel_calls=num_parallel_calls,
+        deterministic=deterministic or shard_records,
+    )
+    if shard_records:
+        records = records.shard(num_shards, shard_index)
+    dataset = records.map(
+        partial(parse_data.parse_tf_record, keylist=list(keylist)),
+        num_parallel_calls=num_parallel_calls,
+        deterministic=deterministic,
+    )
+    if cache == MEMORY_CACHE:
+        dataset = dataset.cache()
+    elif cache:
+        # Shards reading the same files cache different records
+        shards = (num_shards, shard_index) if shard_records else (1, 0)
+        dataset = dataset.cache(cache_file(cache, filelist, keylist, shuffle, *shards))
+    if shuffle:
+        dataset = dataset.shuffle(buffer_size, seed=seed)
+    dataset = dataset.batch(batch_size)
+    if prefetch:
+        dataset = dataset.prefetch(prefetch)
+    return dataset
+
+
+def time_input_pipeline(dataset: Dataset, num_batches: int) -> float:
+    """Measure how long the input pipeline alone takes to produce a batch, by
+    iterating over it without training.
+
+    Args:
+        dataset (Dataset): The dataset of batches
+        num_batches (int): The number of batches to time, after a first one which
+            warms up the pipeline
+
+    Returns:
+        float: The mean duration in seconds, NaN if the dataset is too short
+    """
+    iterator = iter(dataset.take(num_batches + 1))
+    if next(iterator, None) is None:
+        return float("nan")
+    count = 0
+    start = time.perf_counter()
+    for _ in iterator:
+        count += 1
+    return (time.perf_counter() - start) / count if count else float("nan")
+
+
+class StepTimeCallback(keras.callbacks.Callback):
+    """Break down the time of the training steps of every epoch, and compare it
+    with the time the input pipeline alone takes per batch.
+
+    The step time is measured from the start to the end of every batch, which
+    includes waiting for the input. The time spent between batches, in Keras and
+    the other callbacks, is reported separately. The first step of every epoch,
+    which starts the input pipeline, is left out. The results are logged and
+    added to the logs of the epoch, so that the metric loggers placed after this
+    callback record them.
+    """
+
+    def __init__(self, input_seconds: float | None = None):
+        """
+        Args:
+            input_seconds (float | None, optional): The time the input pipeline
+                alone takes per batch, see time_input_pipeline. Defaults to None.
+        """
+        super().__init__()
+        self.input_seconds = input_seconds
+        self.step_seconds: List[float] = []
+        self.between_seconds: List[float] = []
+        self._step_start = 0.0
+        self._step_end: float | None = None
+
+    def on_epoch_begin(self, epoch: int, logs: Dict | None = None) -> None:
+        self.step_seconds = []
+        self.between_seconds = []
+        self._step_end = None
+
+    def on_train_batch_begin(self, batch: int, logs: Dict | None = None) -> None:
+        self._step_start = time.perf_counter()
+        if self._step_end is not None:
+            self.between_seconds.append(self._step_start - self._step_end)
+
+    def on_train_batch_end(self, batch: int, logs: Dict | None = None) -> None:
+        self._step_end = time.perf_counter()
+        if batch > 0:
+            self.step_seconds.append(self._step_end - self._step_start)
+
+    def on_epoch_end(self, epoch: int, logs: Dict | None = None) -> None:
+        if not self.step_seconds:
+            return
+        step_ms = 1e3 * np.median(self.step_seconds)
+        p90_ms = 1e3 * np.percentile(self.step_seconds, 90)
+        between_ms = 1e3 * np.median(self.between_seconds)
+        report = {"step_time_ms": step_ms, "step_time_p90_ms": p90_ms}
+        message = (
+            f"Epoch {epoch + 1}: step time {step_ms:.1f} ms (p90 {p90_ms:.1f} ms),"
+            f" {between_ms:.1f} ms between steps"
+        )
+        if self.input_seconds is not None and not np.isnan(self.input_seconds):
+            input_ms = 1e3 * self.input_seconds
+            fraction = input_ms / step_ms
+            report["input_time_ms"] = input_ms
+            report["input_fraction"] = fraction
+            message += f", the input pipeline alone takes {input_ms:.1f} ms per batch"
+            if fraction >= INPUT_BOUND_FRACTION:
+                message += ": training is input-bound"
+        logger.info(message)
+        if logs is not None:
+            logs.update(report)
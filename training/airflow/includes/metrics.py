@@ -0,0 +1,224 @@
+"""Contains a cheap metric from which the precision-recall curves of every class
+are derived, and the callback which derives them.
+
+Keras' Precision and Recall metrics with a list of thresholds update one
+accumulator per threshold on every step, for every class. The ScoreHistogram
+metric only counts the predicted probabilities of every class in fixed bins,
+separately for the records which belong to the class and the others, with a
+single segment sum per step. Once per epoch, PRCurveCallback turns the counts into
+the precision and recall at every threshold with cumulative sums.
+"""
+
+import logging
+from typing import Callable, Dict
+
+import keras
+import numpy as np
+from keras import ops
+from rich.logging import RichHandler
+from rich.traceback import install
+
+# Sets up the logger to work with rich
+logger = logging.getLogger(__name__)
+logger.addHandler(RichHandler(rich_tracebacks=True, markup=True))
+logger.setLevel("INFO")
+# Setup rich to get nice tracebacks
+install()
+
+# Number of bins of the predicted probabilities, the thresholds are bin edges
+NUM_SCORE_BINS = 100
+# The thresholds of the curves, the same as the Keras metrics used before
+PR_THRESHOLDS = np.arange(0, 0.99, 0.01)
+# The name of the metric, and so of its entry in the logs
+HISTOGRAM_NAME = "score_histogram"
+
+
+class ScoreHistogram(keras.metrics.Metric):
+    """Count the predicted probabilities of every class in NUM_SCORE_BINS bins,
+    separately for the records which belong to the class (positives) and the
+    others (negatives).
+
+    The result is the array of counts, of shape (2, num_classes, num_bins), where
+    the first axis is negatives then positives. The counts are weighted by the
+    sample weights, e.g. the class weights, like those of Keras' metrics.
+    """
+
+    def __init__(
+        self,
+        num_classes: int,
+        num_bins: int = NUM_SCORE_BINS,
+        name: str = HISTOGRAM_NAME,
+        **kwargs,
+    ):
+        """
+        Args:
+            num_classes (int): The number of classes
+            num_bins (int, optional): The number of bins. Defaults to
+                NUM_SCORE_BINS.
+            name (str, optional): The name of the metric. Defaults to
+                HISTOGRAM_NAME.
+        """
+        super().__init__(name=name, **kwargs)
+        self.num_classes = num_classes
+        self.num_bins = num_bins
+        self.counts = self.add_variable(
+            shape=(2, num_classes, num_bins), initializer="zeros", name="counts"
+        )
+
+    def update_state(self, *args, **kwargs) -> None:
+        """Count the predicted probabilities of a batch, see _update_state for the
+        arguments. The signature is that of keras.metrics.Metric."""
+        self._update_state(*args, **kwargs)
+
+    def _update_state(self, y_true, y_pred, sample_weight=None) -> None:
+        """
+        Args:
+            y_true: The one-hot encoded labels
+            y_pred: The predicted probabilities of every class
+            sample_weight (optional): The weight of every record. Defaults to None.
+        """
+        y_pred = ops.convert_to_tensor(y_pred, dtype="float32")
+        bins = ops.clip(
+            ops.cast(ops.floor(y_pred * self.num_bins), "int32"), 0, self.num_bins - 1
+        )
+        positive = ops.cast(ops.convert_to_tensor(y_true) > 0.5, "int32")
+        # The flat position in counts of the bin of every probability
+        size = self.num_classes * self.num_bins
+        index = positive * size + ops.arange(self.num_classes) * self.num_bins + bins
+        if sample_weight is None:
+            weights = ops.ones(ops.shape(index), dtype="float32")
+        else:
+            sample_weight = ops.cast(ops.reshape(sample_weight, (-1, 1)), "float32")
+            weights = ops.broadcast_to(sample_weight, ops.shape(index))
+        # A segment sum rather than a bincount, as XLA can compile it
+        counts = ops.segment_sum(
+            ops.reshape(weights, (-1,)),
+            ops.reshape(index, (-1,)),
+            num_segments=2 * size,
+        )
+        self.counts.assign_add(ops.reshape(counts, self.counts.shape))
+
+    def result(self):
+        return ops.convert_to_tensor(self.counts)
+
+    def reset_state(self) -> None:
+        self.counts.assign(ops.zeros(self.counts.shape, dtype=self.counts.dtype))
+
+    def get_config(self) -> Dict:
+        return {
+            **super().get_config(),
+            "num_classes": self.num_classes,
+            "num_bins": self.num_bins,
+        }
+
+
+def pr_curves(
+    counts: np.ndarray, thresholds: np.ndarray = PR_THRESHOLDS
+) -> Dict[str, np.ndarray]:
+    """Derive the precision-recall curve of every class from the counts of a
+    ScoreHistogram. A record is predicted to belong to a class if its probability
+    is at least the threshold, while Keras' metrics take it if it is above, so the
+    curves only differ from theirs for probabilities which are exactly equal to a
+    threshold, e.g. 0. The thresholds are rounded down to the edges of the bins.
+
+    Args:
+        counts (np.ndarray): The result of ScoreHistogram
+        thresholds (np.ndarray, optional): The thresholds in [0, 1]. Defaults to
+            PR_THRESHOLDS.
+
+    Returns:
+        Dict[str, np.ndarray]: The precision and the recall at every threshold,
+            of shape (num_classes, len(thresholds)), and the average precision of
+            every class
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    num_bins = counts.shape[-1]
+    # Number of records with a probability in bin j or above
+    above = np.cumsum(counts[..., ::-1], axis=-1)[..., ::-1]
+    first_bins = np.minimum(
+        np.floor(np.asarray(thresholds) * num_bins + 1e-9).astype(int), num_bins - 1
+    )
+    false_pos, true_pos = above[0][:, first_bins], above[1][:, first_bins]
+    num_positives = counts[1].sum(axis=-1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.nan_to_num(true_pos / (true_pos + false_pos))
+        recall = np.nan_to_num(true_pos / num_positives)
+    # Sum of the precision over the steps of the recall, from high to low threshold
+    steps = -np.diff(np.concatenate([recall, np.zeros_like(recall[:, :1])], -1))
+    return {
+        "precision": precision,
+        "recall": recall,
+        "average_precision": (steps * precision).sum(axis=-1),
+    }
+
+
+class PRCurveCallback(keras.callbacks.Callback):
+    """Turn the counts of the ScoreHistogram metric into precision-recall curves
+    at the end of every epoch, for the training and the validation data.
+
+    The counts are removed from the logs of every batch, where the progress bar
+    and the loggers would take them for a metric, and from the logs of the epoch,
+    where they are replaced by the average precision of every class, ap_<class>.
+    If curves_in_logs is True, the precision and recall at every threshold are
+    added too, as pr_<class> and re_<class>, the names Keras' metrics used to log
+    them. Any other use of the curves, e.g. saving them as an artifact, goes
+    through on_curves. The callback has to come before the metric loggers, so
+    that they see the changed logs.
+    """
+
+    def __init__(
+        self,
+        thresholds: np.ndarray = PR_THRESHOLDS,
+        curves_in_logs: bool = True,
+        on_curves: Callable[[int, Dict[str, list]], None] | None = None,
+    ):
+        """
+        Args:
+            thresholds (np.ndarray, optional): The thresholds of the curves.
+                Defaults to PR_THRESHOLDS.
+            curves_in_logs (bool, optional): Add the curves to the logs.
+                Defaults to True.
+            on_curves (Callable[[int, Dict[str, list]], None] | None, optional):
+                Called with the epoch and the curves, whose keys are those of the
+                logs. Defaults to None.
+        """
+        super().__init__()
+        self.thresholds = thresholds
+        self.curves_in_logs = curves_in_logs
+        self.on_curves = on_curves
+        # The counts removed from the logs of the latest batches, by prefix of the
+        # logs of the epoch. Some versions of Keras take the logs of the epoch
+        # from those of the last batch, without the counts then.
+        self._batch_counts = {}
+
+    def on_epoch_begin(self, epoch: int, logs: Dict | None = None) -> None:
+        self._batch_counts = {}
+
+    def on_train_batch_end(self, batch: int, logs: Dict | None = None) -> None:
+        if logs is not None and HISTOGRAM_NAME in logs:
+            self._batch_counts[""] = logs.pop(HISTOGRAM_NAME)
+
+    def on_test_batch_end(self, batch: int, logs: Dict | None = None) -> None:
+        if logs is not None and HISTOGRAM_NAME in logs:
+            self._batch_counts["val_"] = logs.pop(HISTOGRAM_NAME)
+
+    def on_epoch_end(self, epoch: int, logs: Dict | None = None) -> None:
+        if logs is None:
+            return
+        curves = {"thresholds": np.asarray(self.thresholds).tolist()}
+        for prefix in ["", "val_"]:
+            counts = logs.pop(
+                f"{prefix}{HISTOGRAM_NAME}", self._batch_counts.get(prefix)
+            )
+            if counts is None:
+                continue
+            result = pr_curves(np.asarray(counts), self.thresholds)
+            for i, ap in enumerate(result["average_precision"]):
+                logs[f"{prefix}ap_{i}"] = float(ap)
+                curves[f"{prefix}pr_{i}"] = result["precision"][i].tolist()
+                curves[f"{prefix}re_{i}"] = result["recall"][i].tolist()
+                if self.curves_in_logs:
+                    logs[f"{prefix}pr_{i}"] = result["precision"][i]
+                    logs[f"{prefix}re_{i}"] = result["recall"][i]
+        if self.on_curves is not None:
+            self.on_curves(epoch, curves)
@@ -0,0 +1,126 @@
+"""Contains the construction of the CNN trained by train.py, with the numerical
+settings of setup/conf/training/model: XLA compilation and mixed precision.
+"""
+
+import logging
+from typing import Dict
+
+import keras
+import omegaconf
+from keras import layers
+from omegaconf import DictConfig
+from rich.logging import RichHandler
+from rich.traceback import install
+
+from .metrics import ScoreHistogram
+from .parse_data import IMG_DIM, NUM_CLASSES
+
+# Sets up the logger to work with rich
+logger = logging.getLogger(__name__)
+logger.addHandler(RichHandler(rich_tracebacks=True, markup=True))
+logger.setLevel("INFO")
+# Setup rich to get nice tracebacks
+install()
+
+# The Keras dtype policies the model can be trained with
+PRECISIONS = ["float32", "mixed_bfloat16"]
+
+
+def class_weights() -> Dict[int, float]:
+    """Define class weights to account for uneven distribution of classes
+    distribution of ground truth labels:
+    0: ~60%
+    1: ~15%
+    2: ~15%
+    3: ~10%
+
+    Returns:
+        Dict[int, float]: Class weights for evert class
+    """
+
+    class_weights_dict = {}
+    class_weights_dict[0] = 1.0
+    class_weights_dict[1] = 4.0
+    class_weights_dict[2] = 4.0
+    class_weights_dict[3] = 6.0
+    return class_weights_dict
+
+
+def construct_baseline_model(cfg: DictConfig) -> keras.Sequential:
+    """Construct a simple baseline CNN
+
+    With the mixed_bfloat16 precision, the layers compute in bfloat16 but keep
+    their weights in float32, and the last layer computes in float32, so that the
+    probabilities and the loss are accurate. jit_compile compiles the training
+    and evaluation steps with XLA.
+
+    Args:
+        cfg (DictConfig): The config object which holds learning parameters
+
+    Raises:
+        ValueError: If the precision is not one of PRECISIONS
+
+    Returns:
+        keras.Sequential: The compiled baseline model
+    """
+    num_bands = len(cfg.features.list)
+    lr = cfg.model.learning_rate
+    if cfg.model.precision not in PRECISIONS:
+        raise ValueError(
+            f"Unknown precision {cfg.model.precision}, use one of {PRECISIONS}"
+        )
+    # The policy of every layer created from now on
+    keras.mixed_precision.set_global_policy(cfg.model.precision)
+    model = keras.Sequential(
+        [
+            keras.Input(shape=[IMG_DIM, IMG_DIM, num_bands]),
+            layers.Conv2D(32, kernel_size=(3, 3), activation="relu"),
+            layers.MaxPooling2D(pool_size=(2, 2)),
+            layers.Conv2D(32, kernel_size=(3, 3), activation="relu"),
+            layers.MaxPooling2D(pool_size=(2, 2)),
+            layers.Conv2D(64, kernel_size=(3, 3), activation="relu"),
+            layers.MaxPooling2D(pool_size=(2, 2)),
+            layers.Conv2D(128, kernel_size=(3, 3), activation="relu"),
+            layers.Conv2D(128, kernel_size=(3, 3), activation="relu"),
+            layers.MaxPooling2D(pool_size=(2, 2)),
+            layers.Dropout(0.2),
+            layers.Flatten(),
+            layers.Dense(units=50, activation="relu"),
+            layers.Dropout(0.2),
+            layers.Dense(NUM_CLASSES, activation="softmax", dtype="float32"),
+        ]
+    )
+    # Precision and recall of every class at every threshold are derived from
+    # these counts at the end of every epoch, see PRCurveCallback
+    metrics = [ScoreHistogram(NUM_CLASSES), "accuracy"]
+
+    model.compile(
+        loss="categorical_crossentropy",
+        optimizer=keras.optimizers.Adam(learning_rate=lr),
+        metrics=metrics,
+        jit_compile=cfg.model.jit_compile,
+    )
+
+    return model
+
+
+def float32_model(model: keras.Sequential, cfg: DictConfig) -> keras.Sequential:
+    """Return a float32 copy of a model trained with mixed precision, e.g. to
+    convert it to ONNX, whose CPU kernels don't take bfloat16. The weights of a
+    mixed precision model are float32 already, so they are copied as they are.
+
+    Args:
+        model (keras.Sequential): The trained model
+        cfg (DictConfig): The config object the model was constructed with
+
+    Returns:
+        keras.Sequential: The model itself if it is float32, else the copy
+    """
+    if cfg.model.precision == "float32":
+        return model
+    float32_cfg = omegaconf.OmegaConf.merge(
+        cfg, {"model": {"precision": "float32", "jit_compile": False}}
+    )
+    copy = construct_baseline_model(float32_cfg)
+    copy.set_weights(model.get_weights())
+    return copy
@@ -0,0 +1,120 @@
+"""Contains the offline graph optimization of the ONNX model which is registered
+for inference.
+
+ONNX Runtime optimizes the graph of a model every time it creates a session for
+it: it folds constants and transposes, fuses every convolution with its
+activation, and for a statically quantized model folds the quantize and
+dequantize nodes into QLinearConv and QLinearMatMul. Optimizing the graph once at
+registration saves this work at every cold start of the inference Lambda, which
+loads the optimized model first.
+
+The "extended" level keeps the graph portable: the layout optimizations, which
+depend on the instruction set of the CPU, are still applied by the session of
+the Lambda. The "all" level also applies them, so the Lambda loads the model
+without any optimization, but then it only runs on CPUs like the one of the
+training. Either way, the optimized graph is only valid for the version of ONNX
+Runtime which produced it, and for the model.onnx it was optimized from: both are
+recorded with it, so the Lambda falls back to model.onnx when either changed. See
+the configuration options in setup/conf/training/optimization.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+from typing import Dict
+
+import onnx
+import onnxruntime as rt
+from rich.logging import RichHandler
+from rich.traceback import install
+
+# Sets up the logger to work with rich
+logger = logging.getLogger(__name__)
+logger.addHandler(RichHandler(rich_tracebacks=True, markup=True))
+logger.setLevel("INFO")
+# Setup rich to get nice tracebacks
+install()
+
+# The name of the optimized model, next to model.onnx in the model registry
+OPTIMIZED_MODEL_NAME = "model.optimized.onnx"
+# The metadata of the optimized model, in the model and on its S3 object
+VERSION_KEY = "onnxruntime-version"
+LEVEL_KEY = "optimization-level"
+SOURCE_HASH_KEY = "source-sha256"
+LEVELS = {
+    "extended": rt.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": rt.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+
+def optimize_model(model: onnx.ModelProto, level: str = "extended") -> onnx.ModelProto:
+    """Apply the graph optimizations of ONNX Runtime up to a level to a model, for
+    the CPUExecutionProvider.
+
+    Args:
+        model (onnx.ModelProto): The model
+        level (str, optional): "extended" for the optimizations which don't
+            depend on the CPU, or "all" to also change the layout of the
+            convolutions for this CPU. Defaults to "extended".
+
+    Raises:
+        ValueError: If the level is unknown
+
+    Returns:
+        onnx.ModelProto: The optimized model, with the version of ONNX Runtime,
+            the level and the hash of the model in its metadata
+    """
+    if level not in LEVELS:
+        raise ValueError(f"Unknown optimization level {level}, use one of {[*LEVELS]}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        optimized_name = os.path.join(tmp_dir, OPTIMIZED_MODEL_NAME)
+        options = rt.SessionOptions()
+        options.graph_optimization_level = LEVELS[level]
+        options.optimized_model_filepath = optimized_name
+        # Creating the session writes the optimized graph
+        rt.InferenceSession(
+            model.SerializeToString(), options, providers=["CPUExecutionProvider"]
+        )
+        optimized = onnx.load(optimized_name)
+    onnx.helper.set_model_props(
+        optimized, optimization_metadata(level, model.SerializeToString())
+    )
+    logger.info(
+        f"Optimized the model at the {level} level from {len(model.graph.node)}"
+        f" to {len(optimized.graph.node)} nodes"
+    )
+    return optimized
+
+
+def optimization_metadata(level: str, source: bytes) -> Dict[str, str]:
+    """The metadata recorded with a model optimized by this version of ONNX
+    Runtime, which the inference Lambda checks before loading it.
+
+    Args:
+        level (str): The optimization level
+        source (bytes): The serialized model which was optimized, as uploaded
+            to model.onnx
+
+    Returns:
+        Dict[str, str]: The version of ONNX Runtime, the level and the hash of
+            the model
+    """
+    return {
+        VERSION_KEY: rt.__version__,
+        LEVEL_KEY: level,
+        SOURCE_HASH_KEY: source_hash(source),
+    }
+
+
+def source_hash(source: bytes) -> str:
+    """The hash of a serialized model, which ties the optimized model to the
+    model.onnx it was optimized from.
+
+    Args:
+        source (bytes): The serialized model
+
+    Returns:
+        str: The hex SHA-256 digest of the model
+    """
+    return hashlib.sha256(source).hexdigest()
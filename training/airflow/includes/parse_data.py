@@ -8,8 +8,10 @@ import glob
 import hashlib
 import json
 import logging
+import multiprocessing
 import os
 import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from functools import partial
 from typing import Dict, List, Tuple
 
@@ -20,6 +22,35 @@ from rich.traceback import install
 from tensorflow import Tensor
 from tensorflow.data import Dataset
 
+from .band_statistics import (
+    STATS_SUFFIX,
+    batch_statistics,
+    empty_statistics,
+    load_statistics,
+    merge_statistics,
+    save_statistics,
+    stats_name,
+)
+from .record_compression import (
+    TFRECORD_FOOTER_SIZE,
+    TFRECORD_HEADER_SIZE,
+    processed_record_dataset,
+)
+from .record_index import (
+    INDEX_SUFFIX,
+    file_fetcher,
+    find_records,
+    index_name,
+    load_index,
+    read_indexed_records,
+    save_index,
+)
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 # Sets up the logger to work with rich
 logger = logging.getLogger(__name__)
 logger.addHandler(RichHandler(rich_tracebacks=True, markup=True))
@@ -80,11 +111,40 @@ features_processed = {
     "NDMI": tf.io.FixedLenFeature([], tf.string),
     "EVI": tf.io.FixedLenFeature([], tf.string),
 }
+# The version of the processed format, missing in files which predate versioning
+format_version_feature = tf.io.FixedLenFeature([], tf.int64, default_value=1)
+
+# The indices added to the processed data by default
+derived_keylist = ["NDVI", "NDMI", "EVI"]
 
 # default image side dimension (65 x 65 square)
 IMG_DIM = 65
 # Number of classes
 NUM_CLASSES = 4
+# Number of raw records to decode at once when processing
+RAW_BATCH_SIZE = 256
+# An image is blank if no pixel of any band exceeds this raw uint8 value, i.e. if
+# the normalized image is nowhere above 1/255
+BLANK_MAX_VALUE = 1
+# Number of records to serialize at once when writing processed output
+SERIALIZE_BATCH_SIZE = 64
+# The version of the processed data format written by write_processed_output.
+# Version 1 stores every band as float32. Version 2 stores the raw bands as uint8
+# and the derived features as float16, and records the version in every example.
+PROCESSED_FORMAT_VERSION = 2
+# Largest finite float16 value, derived features are clipped to this in version 2
+FLOAT16_MAX = 65504.0
+# Digest used to detect changes to the raw files, the default of
+# processing.hash_algorithm in setup/conf/training/data. Any hashlib algorithm
+# works, as do the xxhash ones if the package is installed.
+HASH_ALGORITHM = "xxh3_128"
+# Number of bytes read at once when hashing a file
+HASH_CHUNK_SIZE = 1 << 20
+# The version of the processing code. Bump it whenever process_one_dataset
+# changes its output, so that process_data rebuilds the shards made by older code.
+# Version 2 writes the statistics of every processed file, version 3 records the
+# number of vetoed records in them.
+PROCESSING_VERSION = 3
 
 
 def parse_raw_tfrecord(
@@ -101,6 +161,29 @@ def parse_raw_tfrecord(
             all the features in the file. Defaults to None.
     """
 
+    return normalize_bands(
+        *decode_raw_tfrecord(serialized_example, keylist=keylist, features=features)
+    )
+
+
+def decode_raw_tfrecord(
+    serialized_example: str,
+    keylist: List[str] | None = None,
+    features: Dict[str, tf.io.FixedLenFeature] | None = None,
+) -> Tuple[Dict[str, Tensor], Tensor]:
+    """Parse a single raw example, and decode its bands without normalizing them.
+
+    Args:
+        serialized_example (str): The serialized example
+        keylist (List[str] | None, optional): The features to return. Defaults to None.
+        features (Dict[str, tf.io.FixedLenFeature] | None, optional): The map that describes
+            all the features in the file. Defaults to None.
+
+    Returns:
+        Tuple[Dict[str, Tensor], Tensor]: Keys are bands, values are the uint8 bands
+            with shape [IMG_DIM,IMG_DIM,1], and the label
+    """
+
     def getband(example_key: Tensor) -> Tensor:
         img = tf.io.decode_raw(example_key, tf.uint8)
         return tf.reshape(img[: IMG_DIM**2], shape=(IMG_DIM, IMG_DIM, 1))
@@ -111,16 +194,80 @@ def parse_raw_tfrecord(
         features = raw_features
 
     example = tf.io.parse_single_example(serialized_example, features)
-
-    data_features = {}
-    for key in keylist:
-        band = getband(example[key])
-        # Normalize the data to be between [0 and 1]
-        data_features[key] = tf.cast(band, tf.float32) / 255.0
+    data_features = {key: getband(example[key]) for key in keylist}
     label = tf.cast(example["label"], tf.int32)
     return data_features, label
 
 
+def normalize_bands(
+    data_features: Dict[str, Tensor], label: Tensor
+) -> Tuple[Dict[str, Tensor], Tensor]:
+    """Convert uint8 bands to float32 and normalize them to be between [0 and 1].
+
+    Args:
+        data_features (Dict[str, Tensor]): Keys are bands, values are the uint8 bands
+        label (Tensor): The label
+
+    Returns:
+        Tuple[Dict[str, Tensor], Tensor]: Keys are bands, values are the
+            normalized bands
+    """
+    return {
+        key: tf.cast(band, tf.float32) / 255.0 for key, band in data_features.items()
+    }, label
+
+
+def parse_raw_tfrecord_batch(
+    serialized_examples: Tensor,
+    keylist: List[str] | None = None,
+    features: Dict[str, tf.io.FixedLenFeature] | None = None,
+    veto: bool = False,
+    vetoed: tf.Variable | None = None,
+) -> Tuple[Tensor, Tensor]:
+    """Parse a batch of raw TFRecord examples at once.
+
+    All the bands are decoded in a single op into one stacked tensor, which
+    is then normalized to be between [0 and 1]. The bands are stacked along
+    the second dimension, as this avoids an expensive transpose of the image data.
+    If veto is True, the blank images are dropped as soon as their raw uint8
+    pixels are decoded, before the conversion to float32, see veto_missing_raw.
+
+    Args:
+        serialized_examples (Tensor): A 1D tensor of serialized examples
+        keylist (List[str] | None, optional): The features to return. Defaults to None.
+        features (Dict[str, tf.io.FixedLenFeature] | None, optional): The map that describes
+            all the features in the file. Defaults to None.
+        veto (bool, optional): If True, drop the blank images. Defaults to False.
+        vetoed (tf.Variable | None, optional): An int64 counter, to which the
+            number of dropped images is added. Defaults to None.
+
+    Returns:
+        Tuple[Tensor, Tensor]: The image tensor with shape
+            [nitems,len(keylist),IMG_DIM,IMG_DIM] and the labels.
+    """
+    if keylist is None:
+        keylist = raw_keylist
+    if features is None:
+        features = raw_features
+
+    examples = tf.io.parse_example(serialized_examples, features)
+    # Shape (nitems, nbands) of raw bytes, decoded to (nitems, nbands, IMG_DIM**2)
+    band_bytes = tf.stack([examples[key] for key in keylist], axis=-1)
+    img = tf.io.decode_raw(band_bytes, tf.uint8, fixed_length=IMG_DIM**2)
+    img = tf.reshape(img, (-1, len(keylist), IMG_DIM, IMG_DIM))
+    label = tf.cast(examples["label"], tf.int32)
+    if veto:
+        # The uint8 images are 4 times smaller than the float32 ones
+        keep = tf.reduce_max(img, axis=[1, 2, 3]) > BLANK_MAX_VALUE
+        img = tf.boolean_mask(img, keep)
+        label = tf.boolean_mask(label, keep)
+        if vetoed is not None:
+            vetoed.assign_add(tf.size(keep, tf.int64) - tf.size(label, tf.int64))
+    # Normalize the data to be between [0 and 1]
+    image = tf.cast(img, tf.float32) / 255.0
+    return image, label
+
+
 def serialize_tensor(tensor: Tensor) -> tf.train.Feature:
     """Serialize a tensor to bytes.
 
@@ -164,6 +311,232 @@ def serialize_data(element: Tuple[Dict[str, Tensor], Tensor], assign_id=False) -
     return example.SerializeToString()
 
 
+def quantize_band(key: str, band: Tensor, format_version: int) -> Tensor:
+    """Convert a band to the dtype it is stored as in the given version of the
+    processed format.
+
+    Args:
+        key (str): The name of the band
+        band (Tensor): The normalized float32 band
+        format_version (int): The version of the processed format
+
+    Returns:
+        Tensor: The band, ready to be serialized
+    """
+    if format_version < 2:
+        return band
+    if key in raw_keylist:
+        # The raw bands were uint8 to begin with, so this is lossless
+        return tf.cast(tf.round(band * 255.0), tf.uint8)
+    return tf.cast(tf.clip_by_value(band, -FLOAT16_MAX, FLOAT16_MAX), tf.float16)
+
+
+def dequantize_band(key: str, serialized: Tensor, format_version: Tensor) -> Tensor:
+    """Parse a serialized band and convert it back to a normalized float32 band.
+    The inverse of quantize_band followed by tf.io.serialize_tensor.
+
+    Args:
+        key (str): The name of the band
+        serialized (Tensor): The serialized band
+        format_version (Tensor): The version of the processed format
+
+    Returns:
+        Tensor: The float32 band
+    """
+
+    def parse_v1() -> Tensor:
+        return tf.io.parse_tensor(serialized, out_type=tf.float32)
+
+    def parse_v2() -> Tensor:
+        if key in raw_keylist:
+            band = tf.io.parse_tensor(serialized, out_type=tf.uint8)
+            return tf.cast(band, tf.float32) / 255.0
+        return tf.cast(tf.io.parse_tensor(serialized, out_type=tf.float16), tf.float32)
+
+    return tf.cond(format_version >= 2, parse_v2, parse_v1)
+
+
+def quantize_bands(
+    data_features: Dict[str, Tensor], format_version: int = PROCESSED_FORMAT_VERSION
+) -> Dict[str, Tensor]:
+    """Convert every band of an element of the dataset to the dtype it is stored as,
+    see quantize_band.
+
+    Args:
+        data_features (Dict[str, Tensor]): Keys are bands, values are corresponding tensors
+        format_version (int, optional): The version of the processed format.
+            Defaults to PROCESSED_FORMAT_VERSION.
+
+    Returns:
+        Dict[str, Tensor]: Keys are bands, values are the converted tensors
+    """
+    return {
+        key: quantize_band(key, band, format_version)
+        for key, band in data_features.items()
+    }
+
+
+def serialize_bands(
+    data_features: Dict[str, Tensor],
+    label: Tensor,
+    format_version: int = PROCESSED_FORMAT_VERSION,
+) -> Tuple[Dict[str, Tensor], Tensor]:
+    """Serialize every band of a single element of the dataset to bytes. This is
+    the graph equivalent of the per band serialization in serialize_data.
+
+    Args:
+        data_features (Dict[str, Tensor]): Keys are bands, values are corresponding tensors
+        label (Tensor): The label
+        format_version (int, optional): The version of the processed format.
+            Defaults to PROCESSED_FORMAT_VERSION.
+
+    Returns:
+        Tuple[Dict[str, Tensor], Tensor]: Keys are bands, values are the serialized
+            tensors
+    """
+    return {
+        key: tf.io.serialize_tensor(band)
+        for key, band in quantize_bands(data_features, format_version).items()
+    }, label
+
+
+def _varint(value: Tensor) -> Tensor:
+    """Encode non-negative integers as protobuf varints.
+
+    Args:
+        value (Tensor): The int64 values to encode, smaller than 2**35
+
+    Returns:
+        Tensor: The varint bytes of every value
+    """
+    byte_table = tf.constant([bytes([i]) for i in range(256)])
+    shifted = tf.bitwise.right_shift(value[..., None], [0, 7, 14, 21, 28])
+    more = tf.cast(shifted >= 128, tf.int64) * 128
+    byte = tf.bitwise.bitwise_or(tf.bitwise.bitwise_and(shifted, 127), more)
+    # The first byte is always needed, even if the value is 0
+    needed = tf.concat([tf.ones_like(shifted[..., :1]), shifted[..., 1:]], -1) > 0
+    return tf.strings.reduce_join(
+        tf.where(needed, tf.gather(byte_table, byte), ""), axis=-1
+    )
+
+
+def _varint_size(value: Tensor) -> Tensor:
+    """The number of bytes in the varint encoding of the values, see _varint.
+
+    Args:
+        value (Tensor): The int64 values
+
+    Returns:
+        Tensor: The size of every encoded value
+    """
+    size = tf.ones_like(value)
+    for i in range(1, 5):
+        size += tf.cast(value >= 2 ** (7 * i), tf.int64)
+    return size
+
+
+def random_ids(num: Tensor) -> Tensor:
+    """Generate random 32 character hex ids, in the same format as uuid.uuid4().hex.
+
+    Args:
+        num (Tensor): The number of ids to generate
+
+    Returns:
+        Tensor: A 1D tensor of ids
+    """
+    hex_bytes = tf.constant([f"{i:02x}" for i in range(256)])
+    random_bytes = tf.random.uniform((num, 16), maxval=256, dtype=tf.int32)
+    return tf.strings.reduce_join(tf.gather(hex_bytes, random_bytes), axis=-1)
+
+
+def _wrapped_length(length: Tensor) -> Tensor:
+    """The length of a length-delimited protobuf field, given the length of its
+    content. This includes the tag and the varint encoded length.
+
+    Args:
+        length (Tensor): The int64 length of the content
+
+    Returns:
+        Tensor: The length of the field
+    """
+    return 1 + _varint_size(length) + length
+
+
+def encode_examples(
+    band_bytes: Dict[str, Tensor],
+    label: Tensor,
+    assign_id: bool = False,
+    format_version: int = PROCESSED_FORMAT_VERSION,
+) -> Tensor:
+    """Encode a batch of serialized bands and labels as tf.train.Example protos.
+
+    The protobuf wire format is written directly with string ops, so this runs
+    inside the graph. All the length prefixes are computed and encoded up front,
+    for all the features at once, so that the band data is only copied once,
+    when the final strings are joined.
+
+    Args:
+        band_bytes (Dict[str, Tensor]): Keys are bands, values are batches of
+            serialized tensors, see serialize_bands
+        label (Tensor): A batch of labels
+        assign_id (bool, optional): If True, give every record a random hex id.
+            Defaults to False.
+        format_version (int, optional): The version of the processed format. From
+            version 2 on, it is stored in every example. Defaults to
+            PROCESSED_FORMAT_VERSION.
+
+    Returns:
+        Tensor: A 1D tensor of tf.train.Example, serialized to bytes
+    """
+    byte_features = dict(band_bytes)
+    if assign_id:
+        byte_features["id"] = random_ids(tf.size(label))
+    int_features = {"label": tf.cast(label, tf.int64)}
+    if format_version >= 2:
+        int_features["format_version"] = tf.fill(
+            tf.shape(label), tf.constant(format_version, tf.int64)
+        )
+    keys = [*byte_features.keys(), *int_features.keys()]
+    # Every entry of Features.feature is nested as
+    # FeatureEntry(key, value=Feature(bytes_list or int64_list=List(value)))
+    # so we compute the length at every level of nesting, for all entries at once.
+    value_length = tf.stack(
+        [tf.cast(tf.strings.length(v), tf.int64) for v in byte_features.values()]
+        # The integer features are stored as a packed list of varints
+        + [_varint_size(v) for v in int_features.values()],
+        axis=-1,
+    )
+    list_length = _wrapped_length(value_length)
+    feature_length = _wrapped_length(list_length)
+    key_fields = [bytes([0x0A, len(key)]) + key.encode("utf-8") for key in keys]
+    entry_length = _wrapped_length(feature_length) + [len(k) for k in key_fields]
+    features_length = tf.reduce_sum(_wrapped_length(entry_length), axis=-1)
+
+    # Build the header that precedes the value of every entry
+    shape = tf.shape(value_length)
+    varints = _varint(
+        tf.stack([entry_length, feature_length, list_length, value_length], axis=-1)
+    )
+    list_tags = [b"\x0a"] * len(byte_features) + [b"\x1a"] * len(int_features)
+    headers = tf.strings.join(
+        [
+            b"\x0a",
+            varints[..., 0],
+            tf.broadcast_to([k + b"\x12" for k in key_fields], shape),
+            varints[..., 1],
+            tf.broadcast_to(list_tags, shape),
+            varints[..., 2],
+            b"\x0a",
+            varints[..., 3],
+        ]
+    )
+    values = [*byte_features.values(), *map(_varint, int_features.values())]
+    pieces = [b"\x0a", _varint(features_length)]
+    for i, value in enumerate(values):
+        pieces.extend([headers[:, i], value])
+    return tf.strings.join(pieces)
+
+
 def parse_tf_record(
     serialized_example: str,
     keylist: List[str] | None = None,
@@ -171,10 +544,14 @@ def parse_tf_record(
 ) -> Tuple[Tensor, Tensor]:
     """Parse a single item from TFRecordDataset.
 
+    The spectral indices in keylist which are not described in features are
+    computed from the raw bands, so they don't have to be stored.
+
     Args:
         serialized_example (str): Name of the file to parse
         keylist (List[str] | None, optional): The features to add to the
-            return tensor. Defaults to None.
+            return tensor. Only these, the label, the id and the bands needed
+            by the computed indices are parsed. Defaults to None.
         features (Dict[str, tf.io.FixedLenFeature] | None, optional): The description
             of all the features in the file. Defaults to None.
 
@@ -187,17 +564,29 @@ def parse_tf_record(
         keylist = keylist_processed
     if features is None:
         features = features_processed
-    example = tf.io.parse_single_example(serialized_example, features)
-    bandlist = []
-    for key in keylist:
-        bandlist.append(
-            tf.reshape(
-                tf.io.parse_tensor(example[key], out_type=tf.float32),
-                (IMG_DIM, IMG_DIM, 1),
-            )
+    computed_keys = [key for key in keylist if key not in features]
+    source_keys = spectral_index_bands(computed_keys) if computed_keys else []
+    band_keys = [key for key in keylist if key in features]
+    band_keys += [key for key in source_keys if key not in band_keys]
+    # Only parse the features we actually need
+    needed_features = {key: features[key] for key in band_keys}
+    for key in ["label", "id"]:
+        if key in features:
+            needed_features[key] = features[key]
+    # Files written before the format was versioned have no format_version
+    needed_features["format_version"] = format_version_feature
+    example = tf.io.parse_single_example(serialized_example, needed_features)
+    bands = {
+        key: tf.reshape(
+            dequantize_band(key, example[key], example["format_version"]),
+            (IMG_DIM, IMG_DIM, 1),
         )
+        for key in band_keys
+    }
+    if computed_keys:
+        bands, _ = add_derived_features(bands, None, indices=computed_keys)
 
-    image = tf.concat(bandlist, -1)
+    image = tf.concat([bands[key] for key in keylist], -1)
     if "label" in example.keys():
         label = tf.cast(example["label"], tf.int32)
         # This is now actual data we want to use, so we one-hot encode the labels
@@ -211,6 +600,28 @@ def parse_tf_record(
     return image, label
 
 
+def veto_missing_raw(
+    x: Dict[str, Tensor], y: Tensor, vetoed: tf.Variable | None = None
+) -> Tensor:
+    """Veto a blank image from its raw uint8 bands, before they are converted to
+    float32. Uses the same definition of blank as veto_missing.
+
+    Args:
+        x (Dict[str, Tensor]): Keys are bands, values are the uint8 bands, see
+            decode_raw_tfrecord
+        y (Tensor): The label
+        vetoed (tf.Variable | None, optional): An int64 counter, incremented if the
+            image is blank. Defaults to None.
+
+    Returns:
+        Tensor: True if the image isn't blank
+    """
+    keep = tf.reduce_max(tf.stack(list(x.values()))) > BLANK_MAX_VALUE
+    if vetoed is not None:
+        vetoed.assign_add(1 - tf.cast(keep, tf.int64))
+    return keep
+
+
 def veto_missing(x: Dict[str, Tensor], y: Tensor) -> Tensor:
     """Veto all blank images. An image is defined as blank if the maximum across all
     bands is below some threshold, which we take to be 1/255.
@@ -229,19 +640,56 @@ def veto_missing(x: Dict[str, Tensor], y: Tensor) -> Tensor:
     return tf.reduce_max(image) > 1.0 / 255
 
 
+def split_bands(
+    image: Tensor, label: Tensor, keylist: List[str]
+) -> Tuple[Dict[str, Tensor], Tensor]:
+    """Split a batch of stacked images into a dict of bands.
+
+    Args:
+        image (Tensor): The images, with shape [nitems,nbands,IMG_DIM,IMG_DIM]
+        label (Tensor): The labels
+        keylist (List[str]): The names of the bands, in the order they are stacked
+
+    Returns:
+        Tuple[Dict[str, Tensor], Tensor]: Keys are bands, values are
+            corresponding tensors with shape [nitems,IMG_DIM,IMG_DIM,1]
+    """
+    bands = tf.unstack(image, num=len(keylist), axis=1)
+    return {key: band[..., None] for key, band in zip(keylist, bands)}, label
+
+
 def read_raw_tfrecord(
     path: str | List[str],
     keylist: List[str] | None = None,
     features: Dict[str, tf.io.FixedLenFeature] | None = None,
+    batch_size: int | None = None,
+    unbatch: bool = True,
+    derived_features: List[str] | None = None,
+    vetoed: tf.Variable | None = None,
 ) -> Dataset[Tuple[Dict[str, Tensor], Tensor]]:
     """Read one or many raw datasets. Will normalize the data and remove any blank
-    images.
+    images, and optionally add derived features.
+
+    The blank images are removed as soon as their raw uint8 pixels are decoded,
+    so that they are never converted to float32 nor go through the rest of the
+    processing. If batch_size is given, the records are batched before being
+    parsed, so that decoding, the blank veto, normalization and the derived
+    features all run on the whole batch.
 
     Args:
         path (str | List[str]): The path to the raw data
         keylist (List[str] | None, optional): The features to use. Defaults to None.
         features (Dict[str, tf.io.FixedLenFeature] | None, optional): Mapping of each
             feature inside the file. Defaults to None.
+        batch_size (int | None, optional): Number of records to decode at once. If None,
+            decode one record at a time. Defaults to None.
+        unbatch (bool, optional): If True, unbatch the decoded records so that every
+            element is a single image. Only used if batch_size is given.
+            Defaults to True.
+        derived_features (List[str] | None, optional): The spectral indices to add,
+            see spectral_indices. Defaults to None.
+        vetoed (tf.Variable | None, optional): An int64 counter, to which the number
+            of blank images is added as they are read. Defaults to None.
 
     Returns:
         Dataset: The parsed dataset, as a dict, with keys representing features
@@ -249,10 +697,50 @@ def read_raw_tfrecord(
 
     dataset = tf.data.TFRecordDataset(path)
 
-    parsed_dataset = dataset.map(
-        partial(parse_raw_tfrecord, keylist=keylist, features=features)
+    if batch_size is None:
+        parsed_dataset = (
+            dataset.map(
+                partial(decode_raw_tfrecord, keylist=keylist, features=features)
+            )
+            .filter(partial(veto_missing_raw, vetoed=vetoed))
+            .map(normalize_bands)
+        )
+        if derived_features:
+            parsed_dataset = parsed_dataset.map(
+                partial(add_derived_features, indices=derived_features)
+            )
+        return parsed_dataset
+
+    if keylist is None:
+        keylist = raw_keylist
+    parsed_dataset = dataset.batch(batch_size).map(
+        partial(
+            parse_raw_tfrecord_batch,
+            keylist=keylist,
+            features=features,
+            veto=True,
+            vetoed=vetoed,
+        ),
+        num_parallel_calls=tf.data.AUTOTUNE,
     )
-    parsed_dataset = parsed_dataset.filter(veto_missing)  # type: ignore
+    if derived_features:
+        # Compute the indices on the stacked bands, before splitting them
+        parsed_dataset = parsed_dataset.map(
+            lambda image, label: (
+                tf.concat(
+                    [
+                        image,
+                        compute_spectral_indices(image, keylist, derived_features),
+                    ],
+                    axis=1,
+                ),
+                label,
+            )
+        )
+        keylist = [*keylist, *derived_features]
+    parsed_dataset = parsed_dataset.map(partial(split_bands, keylist=keylist))
+    if unbatch:
+        parsed_dataset = parsed_dataset.unbatch()
 
     return parsed_dataset
 
@@ -266,6 +754,10 @@ def read_processed_tfrecord(
     to training. In particular we have Tensors with shape (IMG_DIM,IMG_DIM,N_FEATURES)
     where N_FEATURES is len(keylist)
 
+    Every version of the processed format can be read, the version is detected for
+    every record and the bands are converted back to float32. The compression of
+    every file is detected too.
+
     Args:
         path (str | List[str]): The path to the processed data.
         keylist (List[str] | None, optional): The features to use. Defaults to None.
@@ -275,7 +767,7 @@ def read_processed_tfrecord(
         Dataset: The parsed dataset, as a dataset of Tensors. The order of the last
         dimension is the same as the ordering of features in keylist.
     """
-    raw_dataset = tf.data.TFRecordDataset(path)
+    raw_dataset = processed_record_dataset(path)
 
     parsed_dataset = raw_dataset.map(
         partial(parse_tf_record, keylist=keylist, features=features)
@@ -288,178 +780,892 @@ def write_processed_output(
     dataset: Dataset[Tuple[Dict[str, Tensor], Tensor]],
     out_name: str = "processed",
     assign_id: bool = False,
+    format_version: int = PROCESSED_FORMAT_VERSION,
+    write_index: bool = True,
+    compression: str | None = None,
+    write_stats: bool = True,
+    vetoed: tf.Variable | None = None,
 ) -> None:
     """Write the processed output to disk.
 
+    The serialization happens inside the tf.data pipeline, see serialize_bands and
+    encode_examples, so the writer only receives finished byte strings. The
+    statistics of every batch are computed in the same pipeline, see
+    batch_statistics, and merged as the batches are written, so that they cost no
+    extra pass over the data.
+
     Args:
         dataset (Dataset): The processed output
         out_name (str, optional): The name of the output file. Defaults to "processed".
+        assign_id (bool, optional): If True, give every record a random hex id.
+            Defaults to False.
+        format_version (int, optional): The version of the processed format to
+            write. Defaults to PROCESSED_FORMAT_VERSION.
+        write_index (bool, optional): If True, also write the index of the records
+            to index_name(out_name), see load_index. Defaults to True.
+        compression (str | None, optional): The compression codec, one of
+            record_compression.COMPRESSION_TYPES. Defaults to None, meaning
+            uncompressed.
+        write_stats (bool, optional): If True, also write the statistics of every
+            band to stats_name(out_name), see load_statistics. Defaults to True.
+        vetoed (tf.Variable | None, optional): The counter of the records vetoed
+            while reading dataset, see read_raw_tfrecord. Its final value is
+            recorded in the statistics. Defaults to None.
     """
-    with tf.io.TFRecordWriter(out_name) as file_writer:
-        for element in dataset:
-            example = serialize_data(element, assign_id=assign_id)
-            file_writer.write(example)
+
+    # The ranges of the histograms of the bands in the statistics
+    value_ranges = {key: stats_value_range(key) for key in dataset.element_spec[0]}
+
+    def serialize(
+        data_features: Dict[str, Tensor], label: Tensor
+    ) -> Tuple[Dict[str, Tensor], Tensor, Dict[str, Tensor]]:
+        # The same as serialize_bands, but the stored bands are also kept for the
+        # statistics, which are then those of the data as it is read back
+        stored = quantize_bands(data_features, format_version)
+        band_bytes = {key: tf.io.serialize_tensor(band) for key, band in stored.items()}
+        return band_bytes, label, stored if write_stats else {}
+
+    def encode(
+        band_bytes: Dict[str, Tensor], label: Tensor, stored: Dict[str, Tensor]
+    ) -> Tuple[Tensor, Tensor, Dict]:
+        # The ids are generated here rather than in encode_examples, so that they
+        # can be recorded in the index
+        if assign_id:
+            ids = random_ids(tf.size(label))
+            band_bytes = {**band_bytes, "id": ids}
+        else:
+            ids = tf.fill(tf.shape(label), "")
+        examples = encode_examples(band_bytes, label, format_version=format_version)
+        return examples, ids, batch_statistics(stored, label, value_ranges, NUM_CLASSES)
+
+    serialized_dataset = (
+        dataset.map(serialize, num_parallel_calls=tf.data.AUTOTUNE)
+        .batch(SERIALIZE_BATCH_SIZE)
+        .map(encode, num_parallel_calls=tf.data.AUTOTUNE)
+        .prefetch(tf.data.AUTOTUNE)
+    )
+    offsets, lengths, all_ids = [], [], []
+    offset = 0
+    statistics = empty_statistics(NUM_CLASSES)
+    with tf.io.TFRecordWriter(out_name, options=compression or "") as file_writer:
+        for batch, ids, batch_stats in serialized_dataset:
+            for example in batch.numpy():
+                file_writer.write(example)
+                offsets.append(offset)
+                lengths.append(len(example))
+                offset += TFRECORD_HEADER_SIZE + len(example) + TFRECORD_FOOTER_SIZE
+            all_ids.extend(i.decode("utf-8") for i in ids.numpy())
+            statistics = merge_statistics(
+                statistics, tf.nest.map_structure(lambda t: t.numpy(), batch_stats)
+            )
         file_writer.close()
+    if write_index:
+        save_index(
+            out_name, offsets, lengths, all_ids if assign_id else None, compression
+        )
+    if write_stats:
+        if vetoed is not None:
+            statistics["num_vetoed"] = int(vetoed.numpy())
+        save_statistics(out_name, statistics)
+
+
+def stats_value_range(key: str) -> Tuple[float, float]:
+    """The range of the histogram of a band in the statistics. The raw bands are
+    normalized to [0, 1], and most spectral indices lie in [-1, 1].
+
+    Args:
+        key (str): The name of the band
+
+    Returns:
+        Tuple[float, float]: The lower and upper edges of the histogram
+    """
+    return (0.0, 1.0) if key in raw_keylist else (-1.0, 1.0)
+
+
+def list_processed_files(data_path: str, prefix: str = "processed") -> List[str]:
+    """Find the processed files of a directory, leaving out their indices and
+    statistics.
+
+    Args:
+        data_path (str): The directory
+        prefix (str, optional): The prefix of the processed files.
+            Defaults to "processed".
+
+    Returns:
+        List[str]: The sorted names of the files
+    """
+    flist = glob.glob(os.path.join(data_path, f"{prefix}_part*"))
+    return sorted(
+        f
+        for f in flist
+        if not f.endswith(INDEX_SUFFIX) and not f.endswith(STATS_SUFFIX)
+    )
+
+
+def read_processed_records(
+    file_name: str,
+    ids: List[str] | None = None,
+    positions: List[int] | None = None,
+    keylist: List[str] | None = None,
+    features: Dict[str, tf.io.FixedLenFeature] | None = None,
+) -> Dataset[Tuple[Tensor, Tensor]]:
+    """Read a subset of the records of a processed file, using its index.
+
+    Args:
+        file_name (str): The name of the processed file
+        ids (List[str] | None, optional): The ids of the records to read.
+            Defaults to None.
+        positions (List[int] | None, optional): The positions of the records to
+            read, if ids is None. Defaults to None.
+        keylist (List[str] | None, optional): The features to use. Defaults to None.
+        features (Dict[str, tf.io.FixedLenFeature] | None, optional): Mapping of each
+            feature inside the file. Defaults to None.
+
+    Returns:
+        Dataset: The parsed records, in the order of ids or positions, as returned
+            by read_processed_tfrecord
+    """
+    index = load_index(file_name)
+    if ids is not None:
+        positions = find_records(index, ids)
+    records = read_indexed_records(file_fetcher(file_name), index, positions or [])
+    return Dataset.from_tensor_slices(tf.constant(records, tf.string)).map(
+        partial(parse_tf_record, keylist=keylist, features=features)
+    )
+
+
+def _normalized_difference(a: Tensor, b: Tensor) -> Tensor:
+    """Normalized difference (a - b) / (a + b) of two bands."""
+    return (a - b) / (a + b + 1e-7)
+
+
+def _evi(b_band: Tensor, r_band: Tensor, nir_band: Tensor) -> Tensor:
+    """Enhanced Vegetation Index."""
+    G = 2.5
+    c1 = 6
+    c2 = -7.5
+    L = 1
+    return G * ((nir_band - r_band) / (nir_band + c1 * r_band + c2 * b_band + L))
+
+
+def _savi(r_band: Tensor, nir_band: Tensor) -> Tensor:
+    """Soil Adjusted Vegetation Index."""
+    L = 0.5
+    return (1 + L) * (nir_band - r_band) / (nir_band + r_band + L)
+
+
+def _msavi(r_band: Tensor, nir_band: Tensor) -> Tensor:
+    """Modified Soil Adjusted Vegetation Index."""
+    return (
+        2 * nir_band + 1 - tf.sqrt((2 * nir_band + 1) ** 2 - 8 * (nir_band - r_band))
+    ) / 2
+
+
+# The spectral indices which can be derived from the raw bands. Values are the
+# bands passed to the formula, and the formula.
+spectral_indices = {
+    "NDVI": (("B5", "B4"), _normalized_difference),
+    "NDMI": (("B5", "B6"), _normalized_difference),
+    "NBR": (("B5", "B7"), _normalized_difference),
+    "NDWI": (("B3", "B5"), _normalized_difference),
+    "MNDWI": (("B3", "B6"), _normalized_difference),
+    "NDBI": (("B6", "B5"), _normalized_difference),
+    "EVI": (("B2", "B4", "B5"), _evi),
+    "SAVI": (("B4", "B5"), _savi),
+    "MSAVI": (("B4", "B5"), _msavi),
+}
+
+
+def spectral_index_bands(indices: List[str]) -> List[str]:
+    """Find the raw bands needed to compute some spectral indices.
+
+    Args:
+        indices (List[str]): The names of the indices
+
+    Raises:
+        ValueError: If one of the indices is unknown
+
+    Returns:
+        List[str]: The bands, in the order of raw_keylist
+    """
+    needed = set()
+    for name in indices:
+        if name not in spectral_indices:
+            raise ValueError(f"Unknown spectral index {name}")
+        needed.update(spectral_indices[name][0])
+    return [key for key in raw_keylist if key in needed]
+
+
+def compute_spectral_indices(
+    image: Tensor, keylist: List[str], indices: List[str], axis: int = 1
+) -> Tensor:
+    """Compute spectral indices from a tensor of stacked bands, in a single pass.
+
+    The operands of all the normalized difference indices are gathered at once,
+    so these are computed by a single set of elementwise operations.
+
+    Args:
+        image (Tensor): The bands, stacked along axis
+        keylist (List[str]): The names of the bands, in the order they are stacked
+        indices (List[str]): The names of the indices to compute
+        axis (int, optional): The axis along which the bands are stacked.
+            Defaults to 1, as in the batches of parse_raw_tfrecord_batch.
+
+    Returns:
+        Tensor: The indices, stacked along axis in the order of indices
+    """
+    spectral_index_bands(indices)
+    res: Dict[str, Tensor] = {}
+    nd_names = [
+        name for name in indices if spectral_indices[name][1] is _normalized_difference
+    ]
+    if nd_names:
+        operands = [
+            tf.gather(
+                image,
+                [keylist.index(spectral_indices[name][0][i]) for name in nd_names],
+                axis=axis,
+            )
+            for i in range(2)
+        ]
+        nd = _normalized_difference(*operands)
+        res.update(zip(nd_names, tf.split(nd, len(nd_names), axis=axis)))
+    for name in indices:
+        if name not in res:
+            bands, formula = spectral_indices[name]
+            res[name] = formula(
+                *[tf.gather(image, [keylist.index(b)], axis=axis) for b in bands]
+            )
+    return tf.concat([res[name] for name in indices], axis=axis)
 
 
 def add_derived_features(
-    data_features: Dict[str, Tensor], label: Tensor
+    data_features: Dict[str, Tensor],
+    label: Tensor,
+    indices: List[str] | None = None,
 ) -> Tuple[Dict[str, Tensor], Tensor]:
     """Add additional features to the dataset which are derived
-    from the raw data. Currently we add NDVI, NDMI and EVI.
+    from the raw data. By default we add NDVI, NDMI and EVI, any of the
+    spectral_indices can be chosen.
     For a description of what these mean, consult here:
     https://www.usgs.gov/landsat-missions/landsat-surface-reflectance-derived-spectral-indices
 
     Args:
         data_features (Dict[str, Tensor]): The Dict with all of our features
         label (Tensor): The labels (not used)
+        indices (List[str] | None, optional): The indices to add. Defaults to None,
+            meaning derived_keylist.
 
     Returns:
         Tuple[Dict[str, Tensor], Tensor]: Updated Dict of
             features and labels.
     """
-    # Function to add our new feature
+    if indices is None:
+        indices = derived_keylist
+    spectral_index_bands(indices)
     res: Dict[str, Tensor] = {}
     res.update(**data_features)
-    r_band = data_features["B4"]
-    b_band = data_features["B2"]
-    nir_band = data_features["B5"]
-    swir_band = data_features["B6"]
-    # Calculate NDVI
-    ndvi = (nir_band - r_band) / (r_band + nir_band + 1e-7)
-    # Calculate NDMI
-    ndmi = (nir_band - swir_band) / (nir_band + swir_band + 1e-7)
-    # Calculate EVI
-    G = 2.5
-    c1 = 6
-    c2 = -7.5
-    L = 1
-    evi = G * ((nir_band - r_band) / (nir_band + c1 * r_band + c2 * b_band + L))
-    res["NDVI"] = ndvi
-    res["NDMI"] = ndmi
-    res["EVI"] = evi
-
+    for name in indices:
+        bands, formula = spectral_indices[name]
+        res[name] = formula(*[data_features[key] for key in bands])
     return res, label
 
 
 def process_one_dataset(
-    dataset_file: str, output_prefix: str = "processed", assign_id: bool = False
+    dataset_file: str,
+    output_prefix: str = "processed",
+    assign_id: bool = False,
+    derived_features: List[str] | None = None,
+    compression: str | None = None,
 ) -> str:
     """Process a single TFRecord file.
 
     Performs the following:
-    - reads and decodes the data
-    - normalizes all the image data in all bands to be in [0,1]
+    - reads the data and drops the blank images
+    - decodes the rest and normalizes all the image data in all bands to be in [0,1]
     - adds additional derived features
-    - serializes the data back to disk
+    - serializes the data back to disk, along with its index and statistics,
+      which include the number of blank images
 
     Args:
         dataset_file (str): The file to process
         output_prefix (str, optional): Prefix to add the name. Defaults to "processed".
-        use_buffer (bool, optional): If True, don't write to disk, return a
+        assign_id (bool, optional): If True, give every record a random hex id.
+            Defaults to False.
+        derived_features (List[str] | None, optional): The spectral indices to add.
+            Defaults to None, meaning derived_keylist.
+        compression (str | None, optional): The compression codec of the processed
+            file, one of record_compression.COMPRESSION_TYPES. Defaults to None,
+            meaning uncompressed.
+
+    Returns:
+        str: The name of the processed file, next to dataset_file
     """
+    if derived_features is None:
+        derived_features = derived_keylist
     # Read the data and decode it
-    # Also normalize and remove blanks
-    raw_dataset = read_raw_tfrecord(dataset_file)
-    # Add the extra features if desired
-    updated_dataset = raw_dataset.map(add_derived_features)
+    # Also normalize, remove blanks and add the extra features
+    vetoed = tf.Variable(0, dtype=tf.int64, trainable=False)
+    updated_dataset = read_raw_tfrecord(
+        dataset_file,
+        batch_size=RAW_BATCH_SIZE,
+        derived_features=derived_features,
+        vetoed=vetoed,
+    )
     # Write the data back to disk for use
     dataset_dir = os.path.dirname(dataset_file)
     dataset_name = os.path.basename(dataset_file)
 
     out_name = os.path.join(dataset_dir, f"{output_prefix}_{dataset_name}")
 
-    write_processed_output(updated_dataset, out_name, assign_id=assign_id)
+    write_processed_output(
+        updated_dataset,
+        out_name,
+        assign_id=assign_id,
+        compression=compression,
+        vetoed=vetoed,
+    )
     return out_name
 
 
-def compute_hash(file_name: str) -> str:
-    """Compute the md5sum of the given file.
+def compute_hash(
+    file_name: str,
+    algorithm: str = HASH_ALGORITHM,
+    chunk_size: int = HASH_CHUNK_SIZE,
+) -> str:
+    """Compute the digest of the given file, reading it in chunks so that memory
+    usage doesn't depend on the size of the file.
 
     Args:
         file_name (str): The name of the file to process
+        algorithm (str, optional): Any algorithm supported by hashlib (e.g. "md5",
+            "sha256", "blake2b"), or one of the xxhash algorithms (e.g. "xxh3_128")
+            if the xxhash package is installed. Defaults to HASH_ALGORITHM.
+        chunk_size (int, optional): Number of bytes read at once.
+            Defaults to HASH_CHUNK_SIZE.
+
+    Raises:
+        ValueError: If the algorithm is not available
 
     Returns:
         str: The hex representation of the hash
     """
+    if algorithm.startswith("xxh"):
+        if xxhash is None:
+            raise ValueError(
+                f"The {algorithm} digest requires the xxhash package to be installed"
+            )
+        hasher = getattr(xxhash, algorithm)()
+    else:
+        hasher = hashlib.new(algorithm)
     with open(file_name, "rb") as f:
-        data = f.read()
-        hash_signature = hashlib.md5(data).hexdigest()
-    return hash_signature
+        while chunk := f.read(chunk_size):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def fingerprint_file(file_name: str, algorithm: str = HASH_ALGORITHM) -> Dict:
+    """Describe a file by its digest, size and modification time, as stored in
+    the hash record of process_data.
+
+    Args:
+        file_name (str): The name of the file to process
+        algorithm (str, optional): The digest to use. Defaults to HASH_ALGORITHM.
+
+    Returns:
+        Dict: The hash, the algorithm, the size in bytes and the modification
+            time in nanoseconds
+    """
+    # Stat before hashing, so that a write during hashing makes the stored
+    # mtime stale instead of hiding the change
+    stat = os.stat(file_name)
+    return {
+        "hash": compute_hash(file_name, algorithm),
+        "algorithm": algorithm,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+    }
+
+
+def file_changed(file_name: str, fingerprint: Dict | str) -> bool:
+    """Check if a file differs from its stored fingerprint.
+
+    If the size and modification time match the fingerprint, the file is assumed
+    unchanged and isn't hashed. Otherwise it is rehashed with the algorithm of the
+    fingerprint. Fingerprints which are a plain string are md5 sums written by
+    older versions of process_data, so they are always checked by hashing.
+
+    Args:
+        file_name (str): The name of the file to check
+        fingerprint (Dict | str): The fingerprint, as returned by fingerprint_file
+
+    Returns:
+        bool: True if the file is missing or its content changed
+    """
+    if isinstance(fingerprint, str):
+        fingerprint = {"hash": fingerprint, "algorithm": "md5"}
+    try:
+        stat = os.stat(file_name)
+    except FileNotFoundError:
+        return True
+    if stat.st_size != fingerprint.get("size", stat.st_size):
+        return True
+    if stat.st_mtime_ns == fingerprint.get("mtime"):
+        return False
+    return compute_hash(file_name, fingerprint["algorithm"]) != fingerprint["hash"]
+
+
+def find_changed_files(
+    data_path: str, fingerprints: Dict[str, Dict | str], hash_workers: int = 1
+) -> List[str]:
+    """Find the files of a hash record which changed since it was written.
+
+    Hashing is I/O bound and hashlib releases the GIL, so the files are checked
+    by a pool of threads.
+
+    Args:
+        data_path (str): The directory containing the files
+        fingerprints (Dict[str, Dict | str]): The hash record, keys are the names
+            of the files
+        hash_workers (int, optional): Number of files checked concurrently.
+            Defaults to 1.
+
+    Returns:
+        List[str]: The names of the files which changed
+    """
+    names = sorted(fingerprints)
+    with ThreadPoolExecutor(max_workers=max(hash_workers, 1)) as executor:
+        changed = executor.map(
+            lambda name: file_changed(
+                os.path.join(data_path, name), fingerprints[name]
+            ),
+            names,
+        )
+        return [
+            name
+            for name, has_changed in zip(
+                names,
+                track(
+                    changed,
+                    total=len(names),
+                    description="Checking hashes correspond to current data",
+                ),
+            )
+            if has_changed
+        ]
+
+
+def limit_threads(threads_per_worker: int) -> None:
+    """Limit the number of threads TensorFlow uses inside a worker process, so that
+    several workers can share the machine without oversubscribing it.
+
+    Args:
+        threads_per_worker (int): The number of intra- and inter-op threads
+    """
+    tf.config.threading.set_intra_op_parallelism_threads(threads_per_worker)
+    tf.config.threading.set_inter_op_parallelism_threads(threads_per_worker)
+
+
+def count_records(file_name: str) -> int:
+    """Count the records of a TFRecord file, whatever its compression, without
+    parsing them.
+
+    Args:
+        file_name (str): The name of the file
+
+    Returns:
+        int: The number of records
+    """
+    dataset = processed_record_dataset(file_name)
+    return int(dataset.reduce(tf.constant(0, tf.int64), lambda count, _: count + 1))
+
+
+def num_processed_records(file_name: str) -> int:
+    """The number of records of a processed file, read from its statistics or its
+    index if it has either, which is cheaper than counting them.
+
+    Args:
+        file_name (str): The name of the processed file
+
+    Returns:
+        int: The number of records
+    """
+    if os.path.isfile(stats_name(file_name)):
+        return load_statistics(file_name)["num_records"]
+    if os.path.isfile(index_name(file_name)):
+        return len(load_index(file_name)["offsets"])
+    return count_records(file_name)
+
+
+def process_shard(
+    file_name: str,
+    hash_algorithm: str = HASH_ALGORITHM,
+    derived_features: List[str] | None = None,
+    compression: str | None = None,
+) -> Tuple[str, Dict]:
+    """Hash and process a single TFRecord file.
+
+    Args:
+        file_name (str): The file to process
+        hash_algorithm (str, optional): The digest to use. Defaults to HASH_ALGORITHM.
+        derived_features (List[str] | None, optional): The spectral indices to add.
+            Defaults to None, meaning derived_keylist.
+        compression (str | None, optional): The compression codec of the processed
+            file. Defaults to None, meaning uncompressed.
 
+    Returns:
+        Tuple[str, Dict]: The name of the file and its manifest entry, i.e. its
+            fingerprint along with the processing version, the derived features,
+            the compression, the name of the processed file, and the number of
+            records written and vetoed
+    """
+    if derived_features is None:
+        derived_features = derived_keylist
+    entry = fingerprint_file(file_name, hash_algorithm)
+    logger.info(f"Processing {file_name}")
+    out_name = process_one_dataset(
+        file_name, derived_features=derived_features, compression=compression
+    )
+    # The statistics count the records as they are written and vetoed, so the
+    # files don't have to be read again
+    statistics = load_statistics(out_name)
+    entry.update(
+        {
+            "processing_version": PROCESSING_VERSION,
+            "derived_features": list(derived_features),
+            "compression": compression or "",
+            "output": os.path.basename(out_name),
+            "num_records": statistics["num_records"],
+            "num_vetoed": statistics["num_vetoed"],
+        }
+    )
+    return os.path.basename(file_name), entry
 
-def _process_data(flist: List[str], db_path: str) -> None:
-    """Process all the TFRecord files in file list.
 
-    Will:
-    - Store the hash of all files for future reference
-    - Process all the data as described in process_one_dataset
+def _process_data(
+    flist: List[str],
+    num_workers: int = 1,
+    threads_per_worker: int = 1,
+    hash_algorithm: str = HASH_ALGORITHM,
+    derived_features: List[str] | None = None,
+    compression: str | None = None,
+) -> Dict[str, Dict]:
+    """Process all the TFRecord files in file list, as described in
+    process_one_dataset.
 
     Args:
         flist (List[str]): List of files to process
-        db_path (str): Path to the json file in which to store the hashes
+        num_workers (int, optional): Number of worker processes to use. If 1, process
+            the files one after the other in this process. Defaults to 1.
+        threads_per_worker (int, optional): Number of TensorFlow threads every
+            worker process may use. Defaults to 1.
+        hash_algorithm (str, optional): The digest used for the fingerprints.
+            Defaults to HASH_ALGORITHM.
+        derived_features (List[str] | None, optional): The spectral indices to add.
+            Defaults to None, meaning derived_keylist.
+        compression (str | None, optional): The compression codec of the processed
+            files. Defaults to None, meaning uncompressed.
+
+    Returns:
+        Dict[str, Dict]: The manifest entries of the files, keys are their names
     """
     res = {}
-    for f in track(flist):
-        name = os.path.basename(f)
-        res[name] = compute_hash(f)
-        logger.info(f"Processing {f}")
-        process_one_dataset(f)
-    with open(db_path, "w", encoding="utf-8") as fw:
-        json.dump(res, fw, indent=4)
+    process = partial(
+        process_shard,
+        hash_algorithm=hash_algorithm,
+        derived_features=derived_features,
+        compression=compression,
+    )
+    if num_workers <= 1 or len(flist) <= 1:
+        for f in track(flist):
+            name, entry = process(f)
+            res[name] = entry
+    else:
+        logger.info(f"Processing {len(flist)} files with {num_workers} workers")
+        # TensorFlow is not fork-safe, so the workers have to be spawned
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=limit_threads,
+            initargs=(threads_per_worker,),
+        ) as executor:
+            futures = [executor.submit(process, f) for f in flist]
+            for future in track(as_completed(futures), total=len(futures)):
+                # This re-raises any exception from the worker
+                name, entry = future.result()
+                res[name] = entry
+    return res
+
+
+def find_outdated_shards(
+    data_path: str,
+    names: List[str],
+    manifest: Dict[str, Dict | str],
+    hash_workers: int = 1,
+    derived_features: List[str] | None = None,
+    compression: str | None = None,
+) -> List[str]:
+    """Find the shards which have to be (re)processed.
+
+    A shard is outdated if it is missing from the manifest, if it was processed
+    by another version of the processing code or with other derived features or
+    compression, if its processed file is gone, or if it changed since it was
+    processed.
+
+    Args:
+        data_path (str): The directory containing the shards
+        names (List[str]): The names of the shards currently in the directory
+        manifest (Dict[str, Dict | str]): The manifest, keys are the names of the
+            shards
+        hash_workers (int, optional): Number of files checked concurrently.
+            Defaults to 1.
+        derived_features (List[str] | None, optional): The spectral indices the
+            processed files should hold. Defaults to None, meaning derived_keylist.
+        compression (str | None, optional): The compression codec the processed
+            files should have. Defaults to None, meaning uncompressed.
+
+    Returns:
+        List[str]: The names of the outdated shards
+    """
+    if derived_features is None:
+        derived_features = derived_keylist
+    outdated = set()
+    to_check = {}
+    for name in names:
+        entry = manifest.get(name)
+        if entry is None:
+            logger.info(f"{name} is a new shard")
+            outdated.add(name)
+        # Entries written before the manifest existed are plain hashes
+        elif (
+            isinstance(entry, str)
+            or entry.get("processing_version") != PROCESSING_VERSION
+        ):
+            logger.info(f"{name} was processed by an older version of the code")
+            outdated.add(name)
+        elif entry.get("derived_features", derived_keylist) != list(derived_features):
+            logger.info(f"{name} was processed with other derived features")
+            outdated.add(name)
+        elif entry.get("compression", "") != (compression or ""):
+            logger.info(f"{name} was processed with another compression")
+            outdated.add(name)
+        elif not os.path.isfile(os.path.join(data_path, entry["output"])):
+            logger.info(f"The processed file of {name} is missing")
+            outdated.add(name)
+        else:
+            to_check[name] = entry
+    for name in find_changed_files(data_path, to_check, hash_workers):
+        logger.warning(f"The hashes for {name} don't match, it will be reprocessed")
+        outdated.add(name)
+    return sorted(outdated)
 
 
-def process_data(
+def remove_stale_shards(
+    data_path: str,
+    names: List[str],
+    manifest: Dict[str, Dict | str],
+    output_prefix: str = "processed",
+) -> List[str]:
+    """Delete the processed files, indices and statistics of the shards which no
+    longer exist, and drop them from the manifest.
+
+    Args:
+        data_path (str): The directory containing the shards
+        names (List[str]): The names of the shards currently in the directory
+        manifest (Dict[str, Dict | str]): The manifest, updated in place
+        output_prefix (str, optional): The prefix of the processed files written
+            before the manifest recorded them. Defaults to "processed".
+
+    Returns:
+        List[str]: The names of the removed shards
+    """
+    removed = sorted(set(manifest) - set(names))
+    for name in removed:
+        entry = manifest.pop(name)
+        if isinstance(entry, str):
+            output = f"{output_prefix}_{name}"
+        else:
+            output = entry["output"]
+        logger.info(f"{name} was removed, deleting {output}")
+        for file_name in [output, index_name(output), stats_name(output)]:
+            try:
+                os.remove(os.path.join(data_path, file_name))
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+def list_raw_files(data_path: str, prefix: str = "part") -> List[str]:
+    """Find the raw TFRecord files of a directory.
+
+    Args:
+        data_path (str): The directory
+        prefix (str, optional): The prefix of the raw files. Defaults to "part".
+
+    Returns:
+        List[str]: The sorted names of the files
+    """
+    return sorted(glob.glob(os.path.join(data_path, f"{prefix}*")))
+
+
+def load_manifest(data_path: str, dbname: str = "data_hashes.json") -> Dict:
+    """Load the manifest of the processed shards of a directory, see process_data.
+
+    Args:
+        data_path (str): The directory containing the shards
+        dbname (str, optional): The name of the manifest. Defaults to
+            "data_hashes.json".
+
+    Returns:
+        Dict: The manifest, keys are the names of the shards, empty if there is
+            no manifest
+    """
+    db_path = os.path.join(data_path, dbname)
+    if not os.path.isfile(db_path):
+        return {}
+    with open(db_path, "r", encoding="utf-8") as fp:
+        return json.load(fp)
+
+
+def find_shards_to_process(
     data_path: str,
     prefix: str = "part",
     dbname: str = "data_hashes.json",
     check_processed: bool = True,
-) -> None:
-    """Process an entire folder of TFRecords.
+    hash_workers: int = 1,
+    derived_features: List[str] | None = None,
+    compression: str | None = None,
+) -> List[str]:
+    """Find the raw files of a directory which have to be (re)processed, without
+    changing anything.
 
     Args:
         data_path (str): The path to the directory containing TFRecords
         prefix (str, optional): The prefix of the TFRecord files. Defaults to "part".
-        dbname (str, optional): The name used to store file hashes. Defaults to "data_hashes.json".
-        check_processed (bool, optional): Check if the data has been processed
-            and if so, don't reprocess it. Defaults to True.
+        dbname (str, optional): The name of the manifest. Defaults to
+            "data_hashes.json".
+        check_processed (bool, optional): If False, every file has to be
+            processed. Defaults to True.
+        hash_workers (int, optional): Number of files hashed concurrently when
+            checking for changes. Defaults to 1.
+        derived_features (List[str] | None, optional): The spectral indices the
+            processed files should hold. Defaults to None, meaning derived_keylist.
+        compression (str | None, optional): The compression codec the processed
+            files should have. Defaults to None, meaning uncompressed.
+
+    Returns:
+        List[str]: The full names of the files to process
     """
+    names = [os.path.basename(f) for f in list_raw_files(data_path, prefix)]
+    if check_processed:
+        manifest = load_manifest(data_path, dbname)
+        if manifest:
+            logger.info("Found existing manifest!")
+        else:
+            logger.info("The manifest doesn't exist, will process the data")
+        names = find_outdated_shards(
+            data_path,
+            names,
+            manifest,
+            hash_workers,
+            derived_features,
+            compression,
+        )
+    return [os.path.join(data_path, name) for name in names]
 
-    flist = glob.glob(os.path.join(data_path, f"{prefix}*"))
-    db_path = os.path.join(data_path, dbname)
 
-    if check_processed:
-        # Check if we have already processed the data.
-        # If not, process it
-        if not os.path.isfile(db_path):
-            # If there is no hashes file we know we haven't processed data yet
-            logger.info("The hash record doesn't exist, will process the data")
-            _process_data(flist, db_path)
+def update_manifest(
+    data_path: str,
+    entries: Dict[str, Dict],
+    prefix: str = "part",
+    dbname: str = "data_hashes.json",
+) -> List[str]:
+    """Record newly processed shards in the manifest of a directory, and delete
+    the processed files of the shards which no longer exist.
 
-        else:
-            # We have a hashes file, check the data hasn't changed
-            logger.info("Found existing hash record!")
-            with open(db_path, "r", encoding="utf-8") as fp:
-                hashes = json.load(fp)
-                retrain = False
-                for name, hash_signature in track(
-                    hashes.items(),
-                    description="Checking hashes correspond to current data",
-                ):
-                    current_md5 = compute_hash(os.path.join(data_path, name))
-                    if current_md5 != hash_signature:
-                        logger.warning(
-                            f"The hashes for {name} don't match we need to retrain!"
-                        )
-                        retrain = True
-                if retrain:
-                    # We have to retrain
-                    logger.info("Processing the data, this may take some time")
-                    _process_data(flist, db_path)
-                else:
-                    logger.info(
-                        "Hashes correspond to the current data, will not re-process data"
-                    )
+    Args:
+        data_path (str): The directory containing the shards
+        entries (Dict[str, Dict]): The manifest entries of the processed shards,
+            as returned by process_shard
+        prefix (str, optional): The prefix of the TFRecord files. Defaults to "part".
+        dbname (str, optional): The name of the manifest. Defaults to
+            "data_hashes.json".
+
+    Returns:
+        List[str]: The names of the removed shards
+    """
+    names = [os.path.basename(f) for f in list_raw_files(data_path, prefix)]
+    manifest = load_manifest(data_path, dbname)
+    removed = remove_stale_shards(data_path, names, manifest)
+    manifest.update(entries)
+    with open(os.path.join(data_path, dbname), "w", encoding="utf-8") as fw:
+        json.dump(manifest, fw, indent=4, sort_keys=True)
+    return removed
+
+
+def process_data(
+    data_path: str,
+    prefix: str = "part",
+    dbname: str = "data_hashes.json",
+    check_processed: bool = True,
+    num_workers: int = 1,
+    threads_per_worker: int = 1,
+    hash_algorithm: str = HASH_ALGORITHM,
+    hash_workers: int = 1,
+    derived_features: List[str] | None = None,
+    compression: str | None = None,
+) -> None:
+    """Process an entire folder of TFRecords.
+
+    The manifest in dbname records, for every shard, its fingerprint, the version
+    of the processing code, the derived features, the compression, the name of
+    its processed file and its number of records written and vetoed. Only the
+    shards which are new, changed, or were processed by an older version of the
+    code or with other derived features or compression are processed again, and
+    the processed files of removed shards are deleted.
+
+    Args:
+        data_path (str): The path to the directory containing TFRecords
+        prefix (str, optional): The prefix of the TFRecord files. Defaults to "part".
+        dbname (str, optional): The name used to store the manifest. Defaults to "data_hashes.json".
+        check_processed (bool, optional): Check which shards have already been
+            processed and don't reprocess them. If False, process every shard.
+            Defaults to True.
+        num_workers (int, optional): Number of worker processes used to process
+            the files in parallel. Defaults to 1.
+        threads_per_worker (int, optional): Number of TensorFlow threads every
+            worker process may use. Defaults to 1.
+        hash_algorithm (str, optional): The digest used to fingerprint the files.
+            Defaults to HASH_ALGORITHM.
+        hash_workers (int, optional): Number of files hashed concurrently when
+            checking for changes. Defaults to 1.
+        derived_features (List[str] | None, optional): The spectral indices stored
+            in the processed files. Defaults to None, meaning derived_keylist.
+        compression (str | None, optional): The compression codec of the processed
+            files, one of record_compression.COMPRESSION_TYPES. Defaults to None,
+            meaning uncompressed.
+    """
+    outdated = find_shards_to_process(
+        data_path,
+        prefix,
+        dbname,
+        check_processed,
+        hash_workers,
+        derived_features,
+        compression,
+    )
+    entries = {}
+    if outdated:
+        num_files = len(list_raw_files(data_path, prefix))
+        logger.info(f"Processing {len(outdated)} of {num_files} shards")
+        entries = _process_data(
+            outdated,
+            num_workers=num_workers,
+            threads_per_worker=threads_per_worker,
+            hash_algorithm=hash_algorithm,
+            derived_features=derived_features,
+            compression=compression,
+        )
     else:
-        # We want to force data processing
-        _process_data(flist, db_path)
+        logger.info("The manifest corresponds to the current data, nothing to process")
+    update_manifest(data_path, entries, prefix, dbname)
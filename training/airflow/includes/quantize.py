@@ -0,0 +1,262 @@
+"""Contains the post-training INT8 quantization of the ONNX model which is
+registered for inference.
+
+Dynamic quantization stores the weights as int8 and quantizes the activations on
+the fly, from their range in every batch. Static quantization also quantizes the
+activations, with fixed ranges calibrated on batches of validation data, so that
+the whole network runs on int8 kernels. Both models are compared with the
+float32 one on other validation batches, for their latency and their accuracy on
+every class, and the quantized model is published only if it is faster and
+doesn't lose more accuracy than allowed. Dynamic quantization is rarely faster
+for a CNN on CPU: the activations of every convolution are quantized at run time,
+and ConvInteger has no optimized kernels. See the configuration options in
+setup/conf/training/quantization.
+"""
+
+import logging
+import os
+import tempfile
+import time
+from typing import Any, Dict, Iterable, List, Tuple
+
+import numpy as np
+import onnx
+import onnxruntime as rt
+from omegaconf import DictConfig
+from onnxruntime.quantization import (
+    CalibrationDataReader,
+    QuantFormat,
+    QuantType,
+    quantize_dynamic,
+    quantize_static,
+)
+from onnxruntime.quantization.shape_inference import quant_pre_process
+from rich.logging import RichHandler
+from rich.traceback import install
+from tensorflow.data import Dataset
+
+# Sets up the logger to work with rich
+logger = logging.getLogger(__name__)
+logger.addHandler(RichHandler(rich_tracebacks=True, markup=True))
+logger.setLevel("INFO")
+# Setup rich to get nice tracebacks
+install()
+
+MODES = ["none", "dynamic", "static"]
+FLOAT_NAME = "float32"
+
+
+class BatchReader(CalibrationDataReader):
+    """Feed batches of inputs to the calibration of static quantization.
+
+    Args:
+        input_name (str): The name of the input of the model
+        batches (Iterable[np.ndarray]): The batches
+    """
+
+    def __init__(self, input_name: str, batches: Iterable[np.ndarray]):
+        self.input_name = input_name
+        self._batches = iter(batches)
+
+    def get_next(self) -> Dict[str, np.ndarray] | None:
+        batch = next(self._batches, None)
+        return None if batch is None else {self.input_name: batch}
+
+
+def quantize_model(
+    model: onnx.ModelProto,
+    mode: str,
+    calibration: Iterable[np.ndarray] | None = None,
+    per_channel: bool = True,
+) -> onnx.ModelProto:
+    """Quantize the weights, and for static quantization the activations, of an
+    ONNX model to int8.
+
+    Args:
+        model (onnx.ModelProto): The float32 model
+        mode (str): "dynamic" or "static"
+        calibration (Iterable[np.ndarray] | None, optional): The batches of inputs
+            the ranges of the activations are calibrated on, for static
+            quantization. Defaults to None.
+        per_channel (bool, optional): Quantize the weights with a scale per output
+            channel rather than per tensor. Defaults to True.
+
+    Raises:
+        ValueError: If the mode is unknown, or static quantization has no
+            calibration data
+
+    Returns:
+        onnx.ModelProto: The quantized model
+    """
+    if mode not in MODES[1:]:
+        raise ValueError(f"Unknown quantization mode {mode}, use one of {MODES[1:]}")
+    if mode == "static" and calibration is None:
+        raise ValueError("Static quantization needs calibration data")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        float_name = os.path.join(tmp_dir, "model.onnx")
+        prepared_name = os.path.join(tmp_dir, "prepared.onnx")
+        quantized_name = os.path.join(tmp_dir, "quantized.onnx")
+        onnx.save(model, float_name)
+        # Fold constants and infer the shapes, so that every node can be quantized
+        quant_pre_process(float_name, prepared_name)
+        if mode == "dynamic":
+            # The CPU kernel of ConvInteger only takes uint8 weights
+            quantize_dynamic(
+                prepared_name,
+                quantized_name,
+                per_channel=per_channel,
+                weight_type=QuantType.QUInt8,
+            )
+        else:
+            input_name = model.graph.input[0].name
+            quantize_static(
+                prepared_name,
+                quantized_name,
+                BatchReader(input_name, calibration),
+                quant_format=QuantFormat.QDQ,
+                per_channel=per_channel,
+                activation_type=QuantType.QUInt8,
+                weight_type=QuantType.QInt8,
+            )
+        return onnx.load(quantized_name)
+
+
+def evaluate_model(
+    model: onnx.ModelProto,
+    batches: List[Tuple[np.ndarray, np.ndarray]],
+    num_classes: int,
+) -> Dict[str, Any]:
+    """Measure the latency of an ONNX model on CPUExecutionProvider, as used for
+    inference, and its accuracy on every class.
+
+    Args:
+        model (onnx.ModelProto): The model
+        batches (List[Tuple[np.ndarray, np.ndarray]]): The batches of inputs and
+            labels, either one-hot or class indices
+        num_classes (int): The number of classes
+
+    Returns:
+        Dict[str, Any]: The size of the model in MB, the mean, median and 95th
+            percentile latency of a batch in ms, the latency per record in ms,
+            the accuracy, and the precision, recall and number of records of
+            every class
+    """
+    serialized = model.SerializeToString()
+    session = rt.InferenceSession(serialized, providers=["CPUExecutionProvider"])
+    input_name = session.get_inputs()[0].name
+    # The first run allocates the buffers of the session
+    session.run(None, {input_name: batches[0][0]})
+    latencies = []
+    predictions = []
+    labels = []
+    for x, y in batches:
+        start = time.perf_counter()
+        probabilities = session.run(None, {input_name: x})[0]
+        latencies.append(1000 * (time.perf_counter() - start))
+        predictions.append(np.argmax(probabilities, axis=-1))
+        labels.append(np.argmax(y, axis=-1) if y.ndim > 1 else y)
+    predictions = np.concatenate(predictions)
+    labels = np.concatenate(labels)
+    per_class = {}
+    for c in range(num_classes):
+        true_positives = int(np.sum((predictions == c) & (labels == c)))
+        predicted = int(np.sum(predictions == c))
+        count = int(np.sum(labels == c))
+        per_class[str(c)] = {
+            "precision": true_positives / predicted if predicted else 0.0,
+            "recall": true_positives / count if count else 0.0,
+            "count": count,
+        }
+    return {
+        "size_mb": len(serialized) / 1e6,
+        "latency_ms": {
+            "mean": float(np.mean(latencies)),
+            "p50": float(np.percentile(latencies, 50)),
+            "p95": float(np.percentile(latencies, 95)),
+        },
+        "ms_per_record": float(np.sum(latencies) / len(labels)),
+        "accuracy": float(np.mean(predictions == labels)),
+        "per_class": per_class,
+    }
+
+
+def numpy_batches(
+    dataset: Dataset, num_batches: int
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Take batches of inputs and labels of a dataset as NumPy arrays, in a
+    single iteration of it.
+
+    Args:
+        dataset (Dataset): The batched dataset, of inputs and labels
+        num_batches (int): The number of batches
+
+    Returns:
+        List[Tuple[np.ndarray, np.ndarray]]: The batches
+    """
+    return [
+        (batch[0], batch[1]) for batch in dataset.take(num_batches).as_numpy_iterator()
+    ]
+
+
+def quantize_for_registry(
+    model: onnx.ModelProto, dataset: Dataset, cfg: DictConfig, num_classes: int
+) -> Tuple[onnx.ModelProto, Dict[str, Any] | None]:
+    """Quantize the model to register as configured, and choose which model to
+    publish.
+
+    The first calibration_batches batches of the validation data calibrate static
+    quantization, and the next eval_batches compare the quantized model with the
+    float32 one. Both are taken from a single iteration of the data, so that they
+    never share a record even if the data is shuffled at every iteration.
+
+    Args:
+        model (onnx.ModelProto): The float32 model
+        dataset (Dataset): The batched validation data
+        cfg (DictConfig): The quantization settings
+        num_classes (int): The number of classes
+
+    Returns:
+        Tuple[onnx.ModelProto, Dict[str, Any] | None]: The model to publish, the
+            quantized one if it is faster and lost at most max_accuracy_drop of
+            accuracy, and the report of the comparison. If there are no
+            validation batches left to compare the models on, the float32 model
+            is published without a report.
+    """
+    batches = numpy_batches(dataset, cfg.calibration_batches + cfg.eval_batches)
+    calibration = None
+    if cfg.mode == "static":
+        calibration = [x for x, _ in batches[: cfg.calibration_batches]]
+    evaluation = batches[cfg.calibration_batches :]
+    if not evaluation:
+        logger.warning(
+            f"The validation data has no batches left after the"
+            f" {cfg.calibration_batches} calibration batches, publishing the"
+            f" {FLOAT_NAME} model"
+        )
+        return model, None
+    logger.info(f"Quantizing the model with {cfg.mode} quantization")
+    quantized = quantize_model(model, cfg.mode, calibration, cfg.per_channel)
+    results = {
+        FLOAT_NAME: evaluate_model(model, evaluation, num_classes),
+        cfg.mode: evaluate_model(quantized, evaluation, num_classes),
+    }
+    float_result, quantized_result = results[FLOAT_NAME], results[cfg.mode]
+    accuracy_drop = float_result["accuracy"] - quantized_result["accuracy"]
+    speedup = float_result["latency_ms"]["p50"] / quantized_result["latency_ms"]["p50"]
+    published = FLOAT_NAME
+    if accuracy_drop <= cfg.max_accuracy_drop and speedup > 1:
+        published = cfg.mode
+    report = {
+        "mode": cfg.mode,
+        "num_records": sum(len(x) for x, _ in evaluation),
+        "batch_size": len(evaluation[0][0]),
+        "models": results,
+        "speedup": speedup,
+        "accuracy_drop": accuracy_drop,
+        "published": published,
+    }
+    logger.info(
+        f"The {cfg.mode} model is {report['speedup']:.2f}x as fast and"
+        f" {100 * accuracy_drop:.2f}% less accurate, publishing the {published} model"
+    )
+    return (quantized if published == cfg.mode else model), report
@@ -0,0 +1,137 @@
+"""Contains the compression of the processed TFRecords.
+
+The processed files are written uncompressed, or compressed with GZIP or ZLIB,
+see write_processed_output in parse_data. The codec isn't recorded anywhere the
+readers could find it, e.g. a file may be uploaded on its own, so they detect it
+from the first bytes of every file, which also lets a directory mix codecs. The
+TFRecord framing of the records, which the uncompressed files start with, is
+defined here too.
+"""
+
+import gzip
+import io
+import logging
+import zlib
+from typing import BinaryIO, List
+
+import tensorflow as tf
+from rich.logging import RichHandler
+from rich.traceback import install
+from tensorflow import Tensor
+from tensorflow.data import Dataset
+
+# Sets up the logger to work with rich
+logger = logging.getLogger(__name__)
+logger.addHandler(RichHandler(rich_tracebacks=True, markup=True))
+logger.setLevel("INFO")
+# Setup rich to get nice tracebacks
+install()
+
+# Every record of a TFRecord file is framed by its length (uint64) and the CRC of
+# the length (uint32) before the data, and the CRC of the data (uint32) after it
+TFRECORD_HEADER_SIZE = 12
+TFRECORD_FOOTER_SIZE = 4
+# The compression codecs of the processed files, "" meaning uncompressed. The
+# readers detect the codec of every file, see detect_compression.
+COMPRESSION_TYPES = ["", "GZIP", "ZLIB"]
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def _crc32c(data: bytes) -> int:
+    """CRC-32C (Castagnoli) of some bytes, as used by the TFRecord framing."""
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ (0x82F63B78 & -(crc & 1))
+    return crc ^ 0xFFFFFFFF
+
+
+def _masked_crc32c(data: bytes) -> int:
+    """The masked CRC stored in the TFRecord framing."""
+    crc = _crc32c(data)
+    return ((((crc >> 15) | (crc << 17)) & 0xFFFFFFFF) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+def detect_compression(file_name: str) -> str:
+    """Detect the compression codec of a TFRecord file from its first bytes.
+
+    An uncompressed file starts with the length of its first record followed by
+    the CRC of that length, which a compressed file almost never does. GZIP
+    files start with the GZIP magic bytes, and ZLIB streams with a header whose
+    checksum is a multiple of 31.
+
+    Args:
+        file_name (str): The name of the file
+
+    Returns:
+        str: The codec, one of COMPRESSION_TYPES
+    """
+    with tf.io.gfile.GFile(file_name, "rb") as f:
+        header = f.read(TFRECORD_HEADER_SIZE)
+    if len(header) < TFRECORD_HEADER_SIZE:
+        return ""
+    if int.from_bytes(header[8:], "little") == _masked_crc32c(header[:8]):
+        return ""
+    if header.startswith(GZIP_MAGIC):
+        return "GZIP"
+    if header[0] & 0x0F == 8 and int.from_bytes(header[:2], "big") % 31 == 0:
+        return "ZLIB"
+    return ""
+
+
+def processed_record_dataset(path: List[str] | str) -> Dataset[Tensor]:
+    """Read the serialized examples of one or many processed files, whatever
+    their compression.
+
+    Args:
+        path (str | List[str]): The processed files
+
+    Returns:
+        Dataset: The serialized examples
+    """
+    filelist = [path] if isinstance(path, str) else list(path)
+    compressions = [detect_compression(f) for f in filelist]
+    if len(set(compressions)) <= 1:
+        compression = compressions[0] if compressions else ""
+        return tf.data.TFRecordDataset(filelist, compression_type=compression)
+    return Dataset.from_tensor_slices((filelist, compressions)).flat_map(
+        lambda f, c: tf.data.TFRecordDataset(f, compression_type=c)
+    )
+
+
+def decompress(data: bytes, compression: str) -> bytes:
+    """Decompress the content of a TFRecord file.
+
+    Args:
+        data (bytes): The content of the file
+        compression (str): The compression codec, one of COMPRESSION_TYPES
+
+    Returns:
+        bytes: The uncompressed TFRecord stream
+    """
+    if compression == "GZIP":
+        return gzip.decompress(data)
+    if compression == "ZLIB":
+        return zlib.decompress(data)
+    return data
+
+
+def open_records(file_name: str) -> BinaryIO:
+    """Open the uncompressed TFRecord stream of a processed file, whatever its
+    compression. GZIP files are decompressed as they are read, while ZLIB files
+    are decompressed in memory, since zlib has no file interface.
+
+    Args:
+        file_name (str): The name of the processed file
+
+    Returns:
+        BinaryIO: A seekable binary file
+    """
+    compression = detect_compression(file_name)
+    if compression == "GZIP":
+        return gzip.open(file_name, "rb")
+    if compression == "ZLIB":
+        with open(file_name, "rb") as f:
+            return io.BytesIO(decompress(f.read(), compression))
+    return open(file_name, "rb")
@@ -0,0 +1,267 @@
+"""Contains the index written next to every processed TFRecord file.
+
+The index holds the position in the file and the length of every record, and the
+ids of the records if they have any. The routines here use it to read any subset
+of the records without reading the rest of the file, e.g. with S3 ranged GETs in
+the inference Lambda, and to split a file into byte ranges which workers can read
+in parallel. The index is written by write_processed_output in parse_data.
+"""
+
+import json
+import logging
+import os
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from rich.logging import RichHandler
+from rich.traceback import install
+
+from .record_compression import (
+    TFRECORD_FOOTER_SIZE,
+    TFRECORD_HEADER_SIZE,
+    decompress,
+    open_records,
+)
+
+# Sets up the logger to work with rich
+logger = logging.getLogger(__name__)
+logger.addHandler(RichHandler(rich_tracebacks=True, markup=True))
+logger.setLevel("INFO")
+# Setup rich to get nice tracebacks
+install()
+
+# Suffix of the index written next to every processed file, see save_index
+INDEX_SUFFIX = ".index"
+
+
+def index_name(file_name: str) -> str:
+    """The name of the index of a processed file.
+
+    Args:
+        file_name (str): The name of the processed file
+
+    Returns:
+        str: The name of the index
+    """
+    return f"{file_name}{INDEX_SUFFIX}"
+
+
+def save_index(
+    file_name: str,
+    offsets: List[int],
+    lengths: List[int],
+    ids: List[str] | None,
+    compression: str | None = None,
+) -> None:
+    """Write the index of a processed file, see load_index. The file has to be
+    written already, since its size is recorded too.
+
+    Args:
+        file_name (str): The name of the processed file
+        offsets (List[int]): The position in the file of every record
+        lengths (List[int]): The length of the data of every record
+        ids (List[str] | None): The ids of the records, or None if they have no ids
+        compression (str | None, optional): The compression codec of the file.
+            Defaults to None, meaning uncompressed.
+    """
+    index = {
+        "offsets": offsets,
+        "lengths": lengths,
+        "ids": ids,
+        "compression": compression or "",
+        "file_size": os.path.getsize(file_name),
+    }
+    with open(index_name(file_name), "w", encoding="utf-8") as fw:
+        json.dump(index, fw)
+
+
+def load_index(file_name: str) -> Dict:
+    """Load the index of a processed file, as written by write_processed_output.
+
+    Args:
+        file_name (str): The name of the processed file
+
+    Returns:
+        Dict: The index. "offsets" and "lengths" are the position in the file of
+            every record and the length of its data, in the uncompressed stream if
+            the file is compressed. "ids" are the ids of the records, or None if
+            they have no ids. "compression" is the codec of the file and
+            "file_size" its size on disk, both missing from older indices.
+    """
+    with open(index_name(file_name), "r", encoding="utf-8") as fp:
+        return json.load(fp)
+
+
+def find_records(index: Dict, ids: List[str]) -> List[int]:
+    """Find the positions of some records in a processed file, given their ids.
+
+    Args:
+        index (Dict): The index of the file, see load_index
+        ids (List[str]): The ids of the records
+
+    Raises:
+        ValueError: If the records have no ids, or an id isn't in the file
+
+    Returns:
+        List[int]: The positions of the records, in the order of ids
+    """
+    if index["ids"] is None:
+        raise ValueError("The records of this file have no ids")
+    positions = {id: i for i, id in enumerate(index["ids"])}
+    missing = [id for id in ids if id not in positions]
+    if missing:
+        raise ValueError(f"Unknown record ids {missing}")
+    return [positions[id] for id in ids]
+
+
+def file_fetcher(file_name: str) -> Callable[[int, int], bytes]:
+    """Make a function reading a range of bytes of a local file, for use with
+    read_indexed_records.
+
+    Args:
+        file_name (str): The name of the file
+
+    Returns:
+        Callable[[int, int], bytes]: Returns the bytes from start to end (exclusive)
+    """
+
+    def fetch(start: int, end: int) -> bytes:
+        with open(file_name, "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    return fetch
+
+
+def memory_fetcher(data: bytes) -> Callable[[int, int], bytes]:
+    """Make a function reading a range of bytes held in memory, for use with
+    read_indexed_records.
+
+    Args:
+        data (bytes): The content of the file
+
+    Returns:
+        Callable[[int, int], bytes]: Returns the bytes from start to end (exclusive)
+    """
+
+    def fetch(start: int, end: int) -> bytes:
+        return data[start:end]
+
+    return fetch
+
+
+def read_indexed_records(
+    fetch: Callable[[int, int], bytes],
+    index: Dict,
+    positions: List[int],
+    max_gap: int = 0,
+) -> List[bytes]:
+    """Read some records of a processed file, without reading the rest of it.
+
+    The records are sorted by position, and records separated by at most max_gap
+    bytes are read with a single call to fetch. With a fetch function doing S3
+    ranged GETs, this gives one request per run of neighbouring records.
+    A compressed file can't be read in pieces, so it is fetched whole and
+    decompressed in memory instead.
+
+    Args:
+        fetch (Callable[[int, int], bytes]): Returns the bytes of the file from
+            start to end (exclusive), e.g. file_fetcher
+        index (Dict): The index of the file, see load_index
+        positions (List[int]): The positions of the records in the file
+        max_gap (int, optional): The largest number of bytes between two records
+            read with a single call. Defaults to 0.
+
+    Returns:
+        List[bytes]: The serialized examples, in the order of positions
+    """
+    offsets, lengths = index["offsets"], index["lengths"]
+    compression = index.get("compression", "")
+    if compression:
+        fetch = memory_fetcher(decompress(fetch(0, index["file_size"]), compression))
+
+    def frame_end(i: int) -> int:
+        return offsets[i] + TFRECORD_HEADER_SIZE + lengths[i] + TFRECORD_FOOTER_SIZE
+
+    records = {}
+    ordered = sorted(set(positions))
+    start = 0
+    while start < len(ordered):
+        stop = start + 1
+        while (
+            stop < len(ordered)
+            and offsets[ordered[stop]] - frame_end(ordered[stop - 1]) <= max_gap
+        ):
+            stop += 1
+        first = offsets[ordered[start]]
+        data = fetch(first, frame_end(ordered[stop - 1]))
+        for i in ordered[start:stop]:
+            begin = offsets[i] - first + TFRECORD_HEADER_SIZE
+            records[i] = data[begin : begin + lengths[i]]
+        start = stop
+    return [records[i] for i in positions]
+
+
+def split_byte_ranges(index: Dict, num_splits: int) -> List[Tuple[int, int]]:
+    """Split a processed file into byte ranges holding about the same amount of
+    data, whose boundaries fall between records, so that workers can read them
+    in parallel with read_byte_range.
+
+    Args:
+        index (Dict): The index of the file, see load_index
+        num_splits (int): The number of ranges
+
+    Returns:
+        List[Tuple[int, int]]: The start and end (exclusive) of every non-empty range
+    """
+    offsets = index["offsets"]
+    if not offsets:
+        return []
+    last = len(offsets) - 1
+    file_size = (
+        offsets[last]
+        + TFRECORD_HEADER_SIZE
+        + index["lengths"][last]
+        + TFRECORD_FOOTER_SIZE
+    )
+    # The first record starting at or after every ideal boundary
+    boundaries = [0]
+    position = 0
+    for k in range(1, num_splits):
+        target = file_size * k / num_splits
+        while position < len(offsets) and offsets[position] < target:
+            position += 1
+        start = offsets[position] if position < len(offsets) else file_size
+        if start > boundaries[-1]:
+            boundaries.append(start)
+    boundaries.append(file_size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def read_byte_range(
+    file_name: str, start: int = 0, end: int | None = None
+) -> Iterator[bytes]:
+    """Read the records of a processed file between two record boundaries, e.g.
+    as returned by split_byte_ranges. The positions are those of the index, so
+    for a compressed file they are positions in the uncompressed stream, and
+    everything before start has to be decompressed to reach it.
+
+    Args:
+        file_name (str): The name of the processed file
+        start (int, optional): The position of the first record. Defaults to 0.
+        end (int | None, optional): The end (exclusive) of the last record.
+            Defaults to None, meaning the end of the file.
+
+    Yields:
+        bytes: The serialized examples
+    """
+    with open_records(file_name) as f:
+        f.seek(start)
+        position = start
+        while end is None or position < end:
+            header = f.read(TFRECORD_HEADER_SIZE)
+            if len(header) < TFRECORD_HEADER_SIZE:
+                break
+            length = int.from_bytes(header[:8], "little")
+            yield f.read(length)
+            f.seek(TFRECORD_FOOTER_SIZE, os.SEEK_CUR)
+            position += TFRECORD_HEADER_SIZE + length + TFRECORD_FOOTER_SIZE
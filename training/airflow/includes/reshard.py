@@ -0,0 +1,233 @@
+"""Contains routines to rewrite processed TFRecords into balanced shards.
+
+process_data writes one processed file per raw file, so the sizes of the
+processed files follow those of the raw export. The routines here rewrite them
+into shards holding about the same number of records, or bytes, so that readers
+interleaving the shards and workers splitting them get an even share of the work.
+The records are copied as they are, without being parsed, and the boundaries of
+the shards are found from the indices of the processed files.
+"""
+
+import json
+import logging
+import math
+import os
+import shutil
+from typing import Dict, List
+
+import numpy as np
+import tensorflow as tf
+from omegaconf import DictConfig
+from rich.logging import RichHandler
+from rich.progress import track
+from rich.traceback import install
+
+from . import parse_data, record_compression, record_index
+
+# Sets up the logger to work with rich
+logger = logging.getLogger(__name__)
+logger.addHandler(RichHandler(rich_tracebacks=True, markup=True))
+logger.setLevel("INFO")
+# Setup rich to get nice tracebacks
+install()
+
+# The subdirectory of the processed data holding the balanced shards
+RESHARD_DIR = "balanced"
+MANIFEST_NAME = "shards.json"
+
+
+def source_index(file_name: str) -> Dict:
+    """Load the index of a processed file. Files written before the indices
+    existed are scanned instead, and their ids are unknown.
+
+    Args:
+        file_name (str): The name of the processed file
+
+    Returns:
+        Dict: The index, see record_index.load_index
+    """
+    if os.path.isfile(record_index.index_name(file_name)):
+        return record_index.load_index(file_name)
+    offsets, lengths = [], []
+    offset = 0
+    for record in record_index.read_byte_range(file_name):
+        offsets.append(offset)
+        lengths.append(len(record))
+        offset += (
+            record_compression.TFRECORD_HEADER_SIZE
+            + len(record)
+            + record_compression.TFRECORD_FOOTER_SIZE
+        )
+    return {"offsets": offsets, "lengths": lengths, "ids": None}
+
+
+def plan_shards(weights: List[int], num_shards: int) -> List[int]:
+    """Split a sequence of records into contiguous shards of about equal weight.
+
+    Args:
+        weights (List[int]): The weight of every record, e.g. 1 or its size
+        num_shards (int): The number of shards
+
+    Returns:
+        List[int]: The position of the first record of every shard, followed by
+            the number of records
+    """
+    cumulative = np.cumsum(weights)
+    total = cumulative[-1] if len(weights) else 0
+    starts = [0]
+    for k in range(1, num_shards):
+        target = total * k / num_shards
+        j = int(np.searchsorted(cumulative, target))
+        before = cumulative[j - 1] if j > 0 else 0
+        # End the shard before or after record j, whichever is closer to target
+        start = j + 1 if cumulative[j] - target <= target - before else j
+        starts.append(max(start, starts[-1]))
+    starts.append(len(weights))
+    return starts
+
+
+def reshard_processed(
+    data_path: str,
+    target_records: int | None = None,
+    target_mb: float | None = None,
+    out_dir: str | None = None,
+    prefix: str = "processed",
+    compression: str | None = None,
+    hash_algorithm: str = parse_data.HASH_ALGORITHM,
+) -> str:
+    """Rewrite the processed files of a directory into balanced shards, unless they
+    were already written from the same files with the same target and compression.
+
+    The number of shards is the smallest one for which no shard exceeds the target
+    on average, and the records are spread so that every shard holds about the
+    same number of records, or bytes if target_mb is given. The order of the
+    records is kept. Every shard gets an index, and the shards are described in
+    the manifest MANIFEST_NAME.
+
+    Args:
+        data_path (str): The directory containing the processed files
+        target_records (int | None, optional): The target number of records of
+            every shard. Defaults to None.
+        target_mb (float | None, optional): The target size of every shard in MB,
+            used if target_records is None. Defaults to None.
+        out_dir (str | None, optional): The directory of the shards. Defaults to
+            None, meaning the RESHARD_DIR subdirectory of data_path.
+        prefix (str, optional): The prefix of the processed files, and of the shards.
+            Defaults to "processed".
+        compression (str | None, optional): The compression codec of the shards,
+            one of record_compression.COMPRESSION_TYPES. The processed files may use any.
+            Defaults to None, meaning uncompressed.
+        hash_algorithm (str, optional): The digest used to fingerprint the
+            processed files. Defaults to parse_data.HASH_ALGORITHM.
+
+    Raises:
+        ValueError: If neither target is given
+
+    Returns:
+        str: The directory of the shards
+    """
+    if target_records is None and target_mb is None:
+        raise ValueError("Either target_records or target_mb has to be given")
+    if out_dir is None:
+        out_dir = os.path.join(data_path, RESHARD_DIR)
+    filelist = parse_data.list_processed_files(data_path, prefix)
+    target = {
+        "target_records": target_records,
+        "target_mb": target_mb,
+        "compression": compression or "",
+    }
+
+    manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as fp:
+            manifest = json.load(fp)
+        sources = manifest["sources"]
+        if (
+            all(manifest.get(key, "") == value for key, value in target.items())
+            and sorted(sources) == [os.path.basename(f) for f in filelist]
+            and not parse_data.find_changed_files(data_path, sources)
+        ):
+            logger.info(f"The shards in {out_dir} are up to date")
+            return out_dir
+
+    indices = [source_index(f) for f in filelist]
+    lengths = [length for index in indices for length in index["lengths"]]
+    framing = (
+        record_compression.TFRECORD_HEADER_SIZE
+        + record_compression.TFRECORD_FOOTER_SIZE
+    )
+    sizes = [length + framing for length in lengths]
+    if target_records is not None:
+        weights = [1] * len(lengths)
+        num_shards = math.ceil(len(lengths) / target_records)
+    else:
+        weights = sizes
+        num_shards = math.ceil(sum(sizes) / (target_mb * 1e6))
+    starts = plan_shards(weights, max(num_shards, 1))
+    num_shards = len(starts) - 1
+    has_ids = all(index["ids"] is not None for index in indices)
+    all_ids = [i for index in indices for i in index["ids"]] if has_ids else None
+    logger.info(
+        f"Writing {len(lengths)} records from {len(filelist)} files"
+        f" into {num_shards} shards in {out_dir}"
+    )
+
+    # Write everything in a temporary directory, so that an interrupted run never
+    # looks like a finished one
+    tmp_dir = f"{out_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    records = (record for f in filelist for record in record_index.read_byte_range(f))
+    shards = []
+    for k in track(range(num_shards), description="Writing balanced shards"):
+        name = f"{prefix}_part-{k:05d}-of-{num_shards:05d}"
+        out_name = os.path.join(tmp_dir, name)
+        first, last = starts[k], starts[k + 1]
+        with tf.io.TFRecordWriter(out_name, options=compression or "") as file_writer:
+            for _ in range(first, last):
+                file_writer.write(next(records))
+        record_index.save_index(
+            out_name,
+            np.cumsum([0] + sizes[first:last])[:-1].tolist(),
+            lengths[first:last],
+            all_ids[first:last] if has_ids else None,
+            compression,
+        )
+        shards.append(
+            {
+                "name": name,
+                "num_records": last - first,
+                "size": os.path.getsize(out_name),
+            }
+        )
+
+    manifest = {
+        **target,
+        "num_records": len(lengths),
+        "sources": {
+            os.path.basename(f): parse_data.fingerprint_file(f, hash_algorithm)
+            for f in filelist
+        },
+        "shards": shards,
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_NAME), "w", encoding="utf-8") as fw:
+        json.dump(manifest, fw, indent=4)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    return out_dir
+
+
+def data_dir(data_path: str, cfg: DictConfig) -> str:
+    """The directory of the processed files to read, which holds the balanced
+    shards if resharding is configured.
+
+    Args:
+        data_path (str): The directory of the processed data
+        cfg (DictConfig): All settings
+
+    Returns:
+        str: The directory of the files to read
+    """
+    if cfg.data.reshard.target_records is None and cfg.data.reshard.target_mb is None:
+        return data_path
+    return os.path.join(data_path, RESHARD_DIR)
@@ -0,0 +1,394 @@
+"""Contains a hyperparameter sweep over the model and feature settings, whose
+trials train in parallel worker processes, and whose poor trials are stopped
+early by asynchronous successive halving (ASHA).
+
+Every key of the search space is a key of the config, as in the overrides of
+train.train_model, e.g. training.model.learning_rate, and every trial trains the
+baseline model with a random sample of the space. All the trials read one tensor cache of the
+processed data, which holds the union of their features and is built before they
+start. As it is memory-mapped, the workers share one copy of it in memory.
+
+The trials are compared at the end of the rung epochs, min_epochs times a power
+of reduction_factor. At a rung, a trial goes on only if its metric is among the
+best 1/reduction_factor of those reported at this rung so far, by any trial, and
+its worker moves on to the next trial otherwise. Only the promising trials train
+for max_epochs. See the configuration options in setup/conf/training/sweep.
+"""
+
+import copy
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Dict, List, Tuple
+
+import keras
+import numpy as np
+import tensorflow as tf
+from omegaconf import DictConfig, OmegaConf
+from rich.console import Console
+from rich.logging import RichHandler
+from rich.progress import track
+from rich.table import Table
+from rich.traceback import install
+
+from . import parse_data, reshard, tensor_cache
+from .metrics import PRCurveCallback
+from .model import class_weights, construct_baseline_model
+
+# Sets up the logger to work with rich
+logger = logging.getLogger(__name__)
+logger.addHandler(RichHandler(rich_tracebacks=True, markup=True))
+logger.setLevel("INFO")
+# Setup rich to get nice tracebacks
+install()
+
+# The ways to compare the metric of the trials
+MODES = ["min", "max"]
+
+
+def sample_trials(
+    space: Dict[str, Any], num_trials: int, seed: int | None = None
+) -> List[Dict[str, Any]]:
+    """Draw the settings of the trials from a search space.
+
+    Every key of the space is a config key. Its value is either a list of the
+    values to choose from, or a mapping with the bounds low and high of a
+    uniform distribution, which is log-uniform if log is true. If both bounds are
+    integers, the values are rounded to integers.
+
+    Args:
+        space (Dict[str, Any]): The search space
+        num_trials (int): The number of trials
+        seed (int | None, optional): Seed of the random generator. Defaults to
+            None.
+
+    Returns:
+        List[Dict[str, Any]]: The value of every key, for every trial
+    """
+    rng = np.random.default_rng(seed)
+    trials = []
+    for _ in range(num_trials):
+        params = {}
+        for key, values in space.items():
+            if isinstance(values, Mapping):
+                low, high = values["low"], values["high"]
+                if values.get("log", False):
+                    value = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+                else:
+                    value = float(rng.uniform(low, high))
+                if isinstance(low, int) and isinstance(high, int):
+                    value = int(round(value))
+            else:
+                value = values[rng.integers(len(values))]
+            params[key] = value
+        trials.append(params)
+    return trials
+
+
+def rungs(min_epochs: int, max_epochs: int, reduction_factor: int) -> List[int]:
+    """The epochs at which the trials are compared.
+
+    Args:
+        min_epochs (int): The epochs every trial trains for
+        max_epochs (int): The epochs of the trials which are never stopped
+        reduction_factor (int): The ratio of two successive rungs
+
+    Returns:
+        List[int]: The rung epochs, below max_epochs
+    """
+    epochs = []
+    rung = min_epochs
+    while rung < max_epochs:
+        epochs.append(rung)
+        rung *= reduction_factor
+    return epochs
+
+
+class AsyncSuccessiveHalving:
+    """Decide whether trials go on at the end of every rung, from the metrics
+    reported at this rung so far.
+
+    The reported metrics are kept in results, under the lock. Both are plain
+    Python objects by default, and have to be shared with the workers, e.g. made
+    by a multiprocessing.Manager, when the trials run in other processes.
+    """
+
+    def __init__(
+        self,
+        rung_epochs: List[int],
+        reduction_factor: int,
+        mode: str = "min",
+        results: Any = None,
+        lock: Any = None,
+    ):
+        """
+        Args:
+            rung_epochs (List[int]): The rung epochs, see rungs
+            reduction_factor (int): One trial in reduction_factor goes on at
+                every rung
+            mode (str, optional): min if a lower metric is better, max
+                otherwise. Defaults to "min".
+            results (Any, optional): Mapping from the rung epochs to the metrics
+                reported there. Defaults to None, meaning a new dict.
+            lock (Any, optional): The lock of results. Defaults to None,
+                meaning a new threading.Lock.
+
+        Raises:
+            ValueError: If mode is not one of MODES
+        """
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode {mode}, use one of {MODES}")
+        self.rung_epochs = list(rung_epochs)
+        self.reduction_factor = reduction_factor
+        self.mode = mode
+        self.results = {} if results is None else results
+        self.lock = threading.Lock() if lock is None else lock
+
+    def report(self, epoch: int, value: float) -> bool:
+        """Record the metric of a trial after an epoch.
+
+        Args:
+            epoch (int): The number of epochs the trial trained for
+            value (float): The metric of the trial
+
+        Returns:
+            bool: Whether the trial goes on
+        """
+        if epoch not in self.rung_epochs:
+            return True
+        if not np.isfinite(value):
+            return False
+        with self.lock:
+            # Reassigned, as the lists of a managed dict are copies
+            values = list(self.results.get(epoch, [])) + [value]
+            self.results[epoch] = values
+        sign = 1 if self.mode == "min" else -1
+        cutoff = np.percentile(sign * np.asarray(values), 100 / self.reduction_factor)
+        return sign * value <= cutoff
+
+
+class ASHACallback(keras.callbacks.Callback):
+    """Report the metric of the trial at the end of every epoch, and stop the
+    training if the scheduler stops the trial."""
+
+    def __init__(self, scheduler: AsyncSuccessiveHalving, metric: str):
+        """
+        Args:
+            scheduler (AsyncSuccessiveHalving): The scheduler of the sweep
+            metric (str): The name of the metric in the logs
+        """
+        super().__init__()
+        self.scheduler = scheduler
+        self.metric = metric
+
+    def on_epoch_end(self, epoch: int, logs: Dict | None = None) -> None:
+        if not self.scheduler.report(epoch + 1, float(logs[self.metric])):
+            self.model.stop_training = True
+
+
+def run_trial(
+    trial: int,
+    params: Dict[str, Any],
+    cfg: Dict,
+    caches: Tuple[str, str],
+    scheduler: AsyncSuccessiveHalving,
+) -> Dict[str, Any]:
+    """Train the model of one trial until it is stopped or reaches max_epochs.
+
+    Args:
+        trial (int): The number of the trial
+        params (Dict[str, Any]): The settings sampled for the trial
+        cfg (Dict): The training settings of the trial, with params applied
+        caches (Tuple[str, str]): The tensor caches of the training and the
+            validation data
+        scheduler (AsyncSuccessiveHalving): The scheduler of the sweep
+
+    Returns:
+        Dict[str, Any]: The settings, the number of epochs, the last value of the
+            metric and the history of the trial
+    """
+    cfg = OmegaConf.create(cfg)
+    sweep = cfg.sweep
+    seed = sweep.seed + trial
+    keras.utils.set_random_seed(seed)
+    keylist = list(cfg.features.list)
+    batch_size = cfg.model.batch_size
+    train_dataset = tensor_cache.read_tensor_cache(
+        caches[0], batch_size, seed=seed, keylist=keylist
+    ).prefetch(tf.data.AUTOTUNE)
+    val_dataset = tensor_cache.read_tensor_cache(
+        caches[1], batch_size, shuffle=False, keylist=keylist
+    ).prefetch(tf.data.AUTOTUNE)
+
+    model = construct_baseline_model(cfg)
+    start = time.perf_counter()
+    history = model.fit(
+        train_dataset,
+        epochs=sweep.max_epochs,
+        validation_data=val_dataset,
+        class_weight=class_weights(),
+        # The curves are left out, but the average precisions can be the metric
+        callbacks=[
+            PRCurveCallback(curves_in_logs=False),
+            ASHACallback(scheduler, sweep.metric),
+        ],
+        verbose=0,
+    )
+    history = {
+        key: [float(value) for value in values]
+        for key, values in history.history.items()
+    }
+    return {
+        "trial": trial,
+        "params": params,
+        "epochs": len(history[sweep.metric]),
+        "metric": history[sweep.metric][-1],
+        "seconds": time.perf_counter() - start,
+        "history": history,
+    }
+
+
+def best_trial(results: List[Dict[str, Any]], mode: str) -> Dict[str, Any]:
+    """The best of the trials which trained for the most epochs.
+
+    Args:
+        results (List[Dict[str, Any]]): The results of run_trial
+        mode (str): min if a lower metric is better, max otherwise
+
+    Returns:
+        Dict[str, Any]: The result of the best trial
+    """
+    max_epochs = max(r["epochs"] for r in results)
+    finished = [r for r in results if r["epochs"] == max_epochs]
+    sign = 1 if mode == "min" else -1
+    return min(finished, key=lambda r: sign * r["metric"])
+
+
+def run_sweep(cfg: DictConfig) -> Dict[str, Any]:
+    """Run a sweep with the settings of cfg.training.sweep, and write its results
+    to a JSON file in their output_dir.
+
+    Args:
+        cfg (DictConfig): The whole config, to which the settings of every trial
+            are applied
+
+    Raises:
+        ValueError: If there is no tensor cache directory, or if a key of the
+            search space isn't in the config
+
+    Returns:
+        Dict[str, Any]: The result of the best trial, see run_trial
+    """
+    sweep = cfg.training.sweep
+    data = cfg.training.data
+    if not sweep.cache_dir:
+        raise ValueError(
+            "The trials share a tensor cache, set training.sweep.cache_dir"
+        )
+    space = OmegaConf.to_container(sweep.space, resolve=True)
+    trials = sample_trials(space, sweep.num_trials, sweep.seed)
+    trial_cfgs = []
+    missing = object()
+    for params in trials:
+        trial_cfg = copy.deepcopy(cfg)
+        for key, value in params.items():
+            if OmegaConf.select(trial_cfg, key, default=missing) is missing:
+                raise ValueError(
+                    f"The key {key} of the search space isn't in the config"
+                )
+            OmegaConf.update(trial_cfg, key, value, merge=False)
+        trial_cfgs.append(trial_cfg.training)
+
+    # One cache with the features of every trial
+    keylist = list(dict.fromkeys(k for c in trial_cfgs for k in c.features.list))
+    caches = tuple(
+        tensor_cache.build_tensor_cache(
+            parse_data.list_processed_files(reshard.data_dir(path, cfg.training)),
+            keylist,
+            os.path.join(sweep.cache_dir, os.path.basename(os.path.normpath(path))),
+        )
+        for path in [data.train_data, data.val_data]
+    )
+
+    rung_epochs = rungs(sweep.min_epochs, sweep.max_epochs, sweep.reduction_factor)
+    logger.info(
+        f"Running {len(trials)} trials with {sweep.num_workers} workers, compared at"
+        f" epochs {rung_epochs}"
+    )
+    start = time.perf_counter()
+    # TensorFlow is not fork-safe, so the workers have to be spawned
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager:
+        scheduler = AsyncSuccessiveHalving(
+            rung_epochs,
+            sweep.reduction_factor,
+            sweep.mode,
+            manager.dict(),
+            manager.Lock(),
+        )
+        with ProcessPoolExecutor(
+            max_workers=sweep.num_workers,
+            mp_context=context,
+            initializer=parse_data.limit_threads,
+            initargs=(sweep.threads_per_worker,),
+        ) as executor:
+            futures = [
+                executor.submit(
+                    run_trial,
+                    i,
+                    params,
+                    OmegaConf.to_container(trial_cfg, resolve=True),
+                    caches,
+                    scheduler,
+                )
+                for i, (params, trial_cfg) in enumerate(zip(trials, trial_cfgs))
+            ]
+            # This re-raises any exception from the workers
+            results = [
+                future.result()
+                for future in track(as_completed(futures), total=len(futures))
+            ]
+    seconds = time.perf_counter() - start
+    results.sort(key=lambda r: r["trial"])
+    best = best_trial(results, sweep.mode)
+
+    table = Table(title=f"Sweep of {len(results)} trials ({sweep.metric})")
+    for column in ["Trial", *space, "Epochs", sweep.metric]:
+        table.add_column(column)
+    for r in results:
+        table.add_row(
+            f"{r['trial']}{' (best)' if r is best else ''}",
+            *[str(r["params"][key]) for key in space],
+            str(r["epochs"]),
+            f"{r['metric']:.4f}",
+        )
+    Console().print(table)
+    epochs = sum(r["epochs"] for r in results)
+    logger.info(
+        f"Trained {epochs} epochs in {seconds:.0f} s, instead of"
+        f" {len(results) * sweep.max_epochs} without early stopping"
+    )
+
+    os.makedirs(sweep.output_dir, exist_ok=True)
+    output = os.path.join(
+        sweep.output_dir, f"sweep_{time.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    report = {
+        "settings": OmegaConf.to_container(sweep, resolve=True),
+        "rungs": rung_epochs,
+        "epochs": epochs,
+        "seconds": seconds,
+        "best": best,
+        "results": results,
+    }
+    with open(output, "w", encoding="utf-8") as fw:
+        json.dump(report, fw, indent=4)
+    logger.info(
+        f"Wrote the results to {output}, the best settings are {best['params']}"
+    )
+    return best
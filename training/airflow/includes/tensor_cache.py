@@ -0,0 +1,345 @@
+"""Contains routines to cache processed TFRecords as memory-mapped NumPy arrays.
+
+Parsing the protobuf TFRecords is the most expensive part of reading the
+processed data. The cache stores the decoded images of a set of processed
+files as one contiguous array of shape (N, IMG_DIM, IMG_DIM, N_FEATURES),
+along with the labels and, if available, the ids. The cache is keyed by the
+feature list and the hashes of the source files, so it is rebuilt whenever
+either of them changes. The hashes are taken from the manifests written with
+the processed files rather than computed again, and a directory of caches only
+keeps the latest one, so that the caches of older data don't pile up.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+import tensorflow as tf
+from rich.logging import RichHandler
+from rich.traceback import install
+from tensorflow.data import Dataset
+
+from . import parse_data, record_compression, reshard
+
+# Sets up the logger to work with rich
+logger = logging.getLogger(__name__)
+logger.addHandler(RichHandler(rich_tracebacks=True, markup=True))
+logger.setLevel("INFO")
+# Setup rich to get nice tracebacks
+install()
+
+MANIFEST_NAME = "manifest.json"
+IMAGES_NAME = "images.npy"
+LABELS_NAME = "labels.npy"
+IDS_NAME = "ids.npy"
+# Number of records to decode at once when building the cache
+BUILD_BATCH_SIZE = 1024
+
+
+def _digest(description: Dict) -> str:
+    return hashlib.sha256(
+        json.dumps(description, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def _recorded_hashes(data_path: str) -> Dict[str, str]:
+    """The hashes of the processed files of a directory, derived from the manifest
+    of process_data, or from the manifest of reshard_processed for balanced
+    shards. A processed file is fully determined by the hash of its raw shard and
+    the settings it was processed with, and a balanced shard by its sources."""
+    hashes = {}
+    for entry in parse_data.load_manifest(data_path).values():
+        if isinstance(entry, dict) and "output" in entry:
+            # The modification time of the raw shard doesn't change its content
+            hashes[entry["output"]] = _digest(
+                {key: value for key, value in entry.items() if key != "mtime"}
+            )
+    manifest_path = os.path.join(data_path, reshard.MANIFEST_NAME)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as fp:
+            manifest = json.load(fp)
+        sources = _digest(
+            {
+                "sources": {
+                    name: fingerprint["hash"]
+                    for name, fingerprint in manifest["sources"].items()
+                },
+                **{key: manifest.get(key) for key in ["target_records", "target_mb"]},
+                "compression": manifest.get("compression", ""),
+            }
+        )
+        for shard in manifest["shards"]:
+            hashes[shard["name"]] = _digest({"sources": sources, "shard": shard})
+    return hashes
+
+
+def source_hashes(filelist: List[str]) -> Dict[str, str]:
+    """The hashes identifying processed files, from the manifests of their
+    directories. Files which aren't in a manifest are hashed.
+
+    Args:
+        filelist (List[str]): The processed files
+
+    Returns:
+        Dict[str, str]: Keys are the names of the files, values are their hashes
+    """
+    recorded = {
+        data_path: _recorded_hashes(data_path)
+        for data_path in {os.path.dirname(f) for f in filelist}
+    }
+    hashes = {}
+    for file_name in sorted(filelist):
+        name = os.path.basename(file_name)
+        hashes[name] = recorded[os.path.dirname(file_name)].get(name)
+        if hashes[name] is None:
+            hashes[name] = parse_data.compute_hash(file_name)
+    return hashes
+
+
+def cache_key(source_hashes: Dict[str, str], keylist: List[str]) -> str:
+    """Compute the key identifying a cache.
+
+    Args:
+        source_hashes (Dict[str, str]): Keys are the names of the source files,
+            values are their hashes
+        keylist (List[str]): The features stored in the cache
+
+    Returns:
+        str: The hex representation of the key
+    """
+    description = json.dumps(
+        {"sources": source_hashes, "features": keylist}, sort_keys=True
+    )
+    return hashlib.sha256(description.encode("utf-8")).hexdigest()[:16]
+
+
+def features_key(keylist: List[str]) -> str:
+    """Compute the key identifying a feature list, which separates the caches of
+    models with the same name and different features, e.g. the baseline and the
+    NDVI models, so that they don't prune each other's caches.
+
+    Args:
+        keylist (List[str]): The features stored in the cache
+
+    Returns:
+        str: The hex representation of the key
+    """
+    return hashlib.sha256(json.dumps(list(keylist)).encode("utf-8")).hexdigest()[:16]
+
+
+def build_tensor_cache(
+    filelist: List[str],
+    keylist: List[str],
+    cache_root: str,
+    features: Dict[str, tf.io.FixedLenFeature] | None = None,
+) -> str:
+    """Build the cache for the given processed files and features, unless it
+    already exists, and delete the other caches of cache_root, which are of
+    older data. Every set of files therefore needs its own cache_root.
+
+    Args:
+        filelist (List[str]): The processed TFRecord files
+        keylist (List[str]): The features to store in the cache
+        cache_root (str): The directory of the caches of these files
+        features (Dict[str, tf.io.FixedLenFeature] | None, optional): Mapping of each
+            feature inside the files. If it contains "id", the ids are cached too.
+            Defaults to None.
+
+    Returns:
+        str: The directory of the cache
+    """
+    filelist = sorted(filelist)
+    hashes = source_hashes(filelist)
+    key = cache_key(hashes, list(keylist))
+    cache_dir = os.path.join(cache_root, key)
+    if os.path.isfile(os.path.join(cache_dir, MANIFEST_NAME)):
+        logger.info(f"Found existing tensor cache in {cache_dir}")
+        prune_tensor_caches(cache_root, cache_dir)
+        return cache_dir
+
+    logger.info(f"Building tensor cache in {cache_dir}")
+    # Counting the records doesn't require parsing them, so this is cheap
+    num_records = int(
+        record_compression.processed_record_dataset(filelist).reduce(
+            0, lambda count, _: count + 1
+        )
+    )
+    # Build everything in a temporary directory, so that an interrupted build
+    # never looks like a finished cache
+    tmp_dir = f"{cache_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    image_shape = (parse_data.IMG_DIM, parse_data.IMG_DIM, len(keylist))
+    images = np.lib.format.open_memmap(
+        os.path.join(tmp_dir, IMAGES_NAME),
+        mode="w+",
+        dtype=np.float32,
+        shape=(num_records, *image_shape),
+    )
+    labels = np.lib.format.open_memmap(
+        os.path.join(tmp_dir, LABELS_NAME),
+        mode="w+",
+        dtype=np.int8,
+        shape=(num_records,),
+    )
+    has_ids = features is not None and "id" in features
+    all_ids = []
+
+    dataset = parse_data.read_processed_tfrecord(
+        filelist, keylist=list(keylist), features=features
+    ).batch(BUILD_BATCH_SIZE)
+    start = 0
+    for batch in dataset:
+        end = start + batch[0].shape[0]
+        images[start:end] = batch[0].numpy()
+        labels[start:end] = np.argmax(batch[1].numpy(), axis=-1)
+        if has_ids:
+            all_ids.extend(batch[2].numpy())
+        start = end
+    images.flush()
+    labels.flush()
+    if has_ids:
+        np.save(os.path.join(tmp_dir, IDS_NAME), np.array(all_ids))
+
+    manifest = {
+        "key": key,
+        "features": list(keylist),
+        "sources": hashes,
+        "num_records": num_records,
+        "image_shape": list(image_shape),
+        "has_ids": has_ids,
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_NAME), "w", encoding="utf-8") as fw:
+        json.dump(manifest, fw, indent=4)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(tmp_dir, cache_dir)
+    prune_tensor_caches(cache_root, cache_dir)
+    return cache_dir
+
+
+def prune_tensor_caches(cache_root: str, keep: str) -> List[str]:
+    """Delete the finished caches of a directory, except one.
+
+    Args:
+        cache_root (str): The directory of the caches
+        keep (str): The directory of the cache to keep
+
+    Returns:
+        List[str]: The directories of the deleted caches
+    """
+    removed = []
+    for name in sorted(os.listdir(cache_root)):
+        cache_dir = os.path.join(cache_root, name)
+        if cache_dir != keep and os.path.isfile(os.path.join(cache_dir, MANIFEST_NAME)):
+            logger.info(f"Deleting the outdated tensor cache {cache_dir}")
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            removed.append(cache_dir)
+    return removed
+
+
+def load_tensor_cache(
+    cache_dir: str,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray | None, Dict]:
+    """Open a cache without reading it into memory.
+
+    Args:
+        cache_dir (str): The directory of the cache
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray | None, Dict]: The memory-mapped
+            images and labels, the ids (None if not cached) and the manifest
+    """
+    with open(os.path.join(cache_dir, MANIFEST_NAME), "r", encoding="utf-8") as fp:
+        manifest = json.load(fp)
+    images = np.load(os.path.join(cache_dir, IMAGES_NAME), mmap_mode="r")
+    labels = np.load(os.path.join(cache_dir, LABELS_NAME), mmap_mode="r")
+    ids = None
+    if manifest["has_ids"]:
+        ids = np.load(os.path.join(cache_dir, IDS_NAME))
+    return images, labels, ids, manifest
+
+
+def read_tensor_cache(
+    cache_dir: str,
+    batch_size: int,
+    shuffle: bool = True,
+    seed: int | None = None,
+    num_shards: int = 1,
+    shard_index: int = 0,
+    keylist: List[str] | None = None,
+) -> Dataset:
+    """Stream batches from a cache, in the same format as train.get_dataset.
+
+    If shuffle is True, every epoch draws a new random permutation of the whole
+    cache. Otherwise the batches are contiguous slices of the memory-mapped arrays.
+    With num_shards > 1, only every num_shards-th record of the order is read,
+    starting at shard_index. Shuffled shards need the same seed, so that they
+    draw the same permutations and never share a record. keylist selects some of
+    the cached features, so that one cache serves several feature lists, e.g. the
+    trials of a sweep.
+
+    Args:
+        cache_dir (str): The directory of the cache
+        batch_size (int): The batch size
+        shuffle (bool, optional): Determines if we shuffle the dataset.
+            Defaults to True.
+        seed (int | None, optional): Seed for the shuffling. Defaults to None.
+        num_shards (int, optional): The number of shards the records are split
+            into. Defaults to 1.
+        shard_index (int, optional): The shard to read. Defaults to 0.
+        keylist (List[str] | None, optional): The features to read, in this
+            order. Defaults to None, meaning all the cached features.
+
+    Raises:
+        ValueError: If shuffled shards are requested without a seed, or if a
+            feature isn't cached
+
+    Returns:
+        Dataset: Batches of images and one-hot encoded labels
+    """
+    if shuffle and num_shards > 1 and seed is None:
+        raise ValueError("Shuffled shards of a tensor cache need a seed")
+    images, labels, _, manifest = load_tensor_cache(cache_dir)
+    num_records = manifest["num_records"]
+    image_shape = manifest["image_shape"]
+    channels = None
+    if keylist is not None and list(keylist) != manifest["features"]:
+        missing = [k for k in keylist if k not in manifest["features"]]
+        if missing:
+            raise ValueError(f"The features {missing} are not in {cache_dir}")
+        channels = [manifest["features"].index(k) for k in keylist]
+        image_shape = [*image_shape[:-1], len(channels)]
+    rng = np.random.default_rng(seed)
+
+    def generate() -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        order = rng.permutation(num_records) if shuffle else None
+        if num_shards > 1:
+            if order is None:
+                order = np.arange(num_records)
+            order = order[shard_index::num_shards]
+        num_read = num_records if order is None else len(order)
+        for start in range(0, num_read, batch_size):
+            if order is None:
+                index = slice(start, start + batch_size)
+            else:
+                # Sorting keeps the reads as sequential as possible
+                index = np.sort(order[start : start + batch_size])
+            if channels is None:
+                yield images[index], labels[index]
+            else:
+                yield images[index][..., channels], labels[index]
+
+    dataset = Dataset.from_generator(
+        generate,
+        output_signature=(
+            tf.TensorSpec((None, *image_shape), tf.float32),
+            tf.TensorSpec((None,), tf.int8),
+        ),
+    )
+    return dataset.map(
+        lambda x, y: (x, tf.one_hot(tf.cast(y, tf.int32), parse_data.NUM_CLASSES))
+    )
@@ -3,26 +3,36 @@ of experiments with either WandB or MLFlow. See the configuration
 options in setup/conf/training
 """
 
-import glob
+import json
 import logging
 import os
 import sys
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Tuple
 
 import keras
 import mlflow
-import numpy as np
 import omegaconf
 import tensorflow as tf
 import wandb
 from hydra import compose, initialize_config_dir
-from keras import layers
 from omegaconf import DictConfig
 from rich.logging import RichHandler
 from rich.traceback import install
+from tensorflow.data import Dataset
 from wandb.integration.keras import WandbMetricsLogger
 
-from . import parse_data
+from . import (
+    checkpoint,
+    distributed,
+    input_pipeline,
+    optimize,
+    parse_data,
+    quantize,
+    reshard,
+    tensor_cache,
+)
+from .metrics import PRCurveCallback
+from .model import class_weights, construct_baseline_model, float32_model
 from .training_utils import (
     convert_model_to_onnx,
     generate_random_id,
@@ -30,8 +40,10 @@ from .training_utils import (
 )
 
 AUTOTUNE = tf.data.AUTOTUNE
+# Also the seed of the shuffling of shards, which has to be the same on every worker
+SEED = 23
 print(tf.__version__)
-tf.compat.v1.set_random_seed(23)
+tf.compat.v1.set_random_seed(SEED)
 
 CONFIG_PATH = "/usr/local/airflow/conf"
 
@@ -43,14 +55,15 @@ logger.setLevel("INFO")
 install()
 
 
-# default image side dimension (65 x 65 square)
-IMG_DIM = 65
-# 4 possible classes
-NUM_CLASSES = 4
-NUM_TRAIN = 500
-NUM_VAL = 320
-
 PROJECT_NAME = "droughtwatch_capstone"
+# The files which may be registered next to model.onnx, depending on the settings
+QUANTIZATION_REPORT_NAME = "quantization_report.json"
+FLOAT_MODEL_NAME = "model_float32.onnx"
+REGISTRY_FILES = (
+    QUANTIZATION_REPORT_NAME,
+    FLOAT_MODEL_NAME,
+    optimize.OPTIMIZED_MODEL_NAME,
+)
 
 
 def get_dataset(
@@ -59,6 +72,9 @@ def get_dataset(
     buffer_size: int,
     keylist: List[str] | None = None,
     shuffle: bool = True,
+    options: DictConfig | None = None,
+    num_shards: int = 1,
+    shard_index: int = 0,
 ):
     """Return a batched and shuffled dataset. The input should correspond
     to processed files.
@@ -69,6 +85,12 @@ def get_dataset(
         buffer_size (int): The buffer size for shuffling
         keylist (List[str], optional): The list of features to return.
         shuffle (bool, optional): Determines if we shuffle the dataset. Defaults to True.
+        options (DictConfig | None, optional): The settings of the input pipeline,
+            see setup/conf/training/data. Defaults to None, meaning the defaults of
+            input_pipeline.build_input_pipeline.
+        num_shards (int, optional): The number of shards the records are split
+            into, e.g. the number of workers. Defaults to 1.
+        shard_index (int, optional): The shard to return. Defaults to 0.
 
     Returns:
         tf.Dataset: The dataset ready for training/validation
@@ -76,86 +98,31 @@ def get_dataset(
     if keylist is None:
         # Use RGB bands as default
         keylist = ["B2", "B3", "B4"]
-    dataset = parse_data.read_processed_tfrecord(filelist, keylist=keylist)
-    if shuffle:
-        dataset = dataset.shuffle(buffer_size)
-    dataset = dataset.batch(batch_size)
-    return dataset
-
-
-def class_weights() -> Dict[int, float]:
-    """Define class weights to account for uneven distribution of classes
-    distribution of ground truth labels:
-    0: ~60%
-    1: ~15%
-    2: ~15%
-    3: ~10%
-
-    Returns:
-        Dict[int, float]: Class weights for evert class
-    """
-
-    class_weights_dict = {}
-    class_weights_dict[0] = 1.0
-    class_weights_dict[1] = 4.0
-    class_weights_dict[2] = 4.0
-    class_weights_dict[3] = 6.0
-    return class_weights_dict
-
-
-def construct_baseline_model(cfg: DictConfig) -> keras.Sequential:
-    """Construct a simple baseline CNN
-
-    Args:
-        cfg (DictConfig): The config object which holds learning parameters
-
-    Returns:
-        keras.Sequential: The compiled baseline model
-    """
-    num_bands = len(cfg.features.list)
-    lr = cfg.model.learning_rate
-    model = keras.Sequential(
-        [
-            keras.Input(shape=[IMG_DIM, IMG_DIM, num_bands]),
-            layers.Conv2D(32, kernel_size=(3, 3), activation="relu"),
-            layers.MaxPooling2D(pool_size=(2, 2)),
-            layers.Conv2D(32, kernel_size=(3, 3), activation="relu"),
-            layers.MaxPooling2D(pool_size=(2, 2)),
-            layers.Conv2D(64, kernel_size=(3, 3), activation="relu"),
-            layers.MaxPooling2D(pool_size=(2, 2)),
-            layers.Conv2D(128, kernel_size=(3, 3), activation="relu"),
-            layers.Conv2D(128, kernel_size=(3, 3), activation="relu"),
-            layers.MaxPooling2D(pool_size=(2, 2)),
-            layers.Dropout(0.2),
-            layers.Flatten(),
-            layers.Dense(units=50, activation="relu"),
-            layers.Dropout(0.2),
-            layers.Dense(NUM_CLASSES, activation="softmax"),
-        ]
-    )
-    ths = list(np.arange(0, 0.99, 0.01))
-    metrics = []
-    # Compute precision and recall at every epoch for every class
-    if cfg.logging.style == "wandb":
-        for i in range(NUM_CLASSES):
-            name1 = f"pr_{i}"
-            name2 = f"re_{i}"
-            m1 = keras.metrics.Precision(thresholds=ths, class_id=i, name=name1)
-            m2 = keras.metrics.Recall(thresholds=ths, class_id=i, name=name2)
-            metrics.append(m1)
-            metrics.append(m2)
-
-    # Also compute accuracy
-    metrics.append("accuracy")
-
-    model.compile(
-        loss="categorical_crossentropy",
-        optimizer=keras.optimizers.Adam(learning_rate=lr),
-        metrics=metrics,
+    if options is None:
+        return input_pipeline.build_input_pipeline(
+            filelist,
+            batch_size,
+            buffer_size,
+            keylist,
+            shuffle=shuffle,
+            num_shards=num_shards,
+            shard_index=shard_index,
+        )
+    return input_pipeline.build_input_pipeline(
+        filelist,
+        batch_size,
+        buffer_size,
+        keylist,
+        shuffle=shuffle,
+        cycle_length=options.cycle_length,
+        num_parallel_calls=options.num_parallel_calls,
+        prefetch=options.prefetch,
+        deterministic=options.deterministic,
+        cache=options.cache,
+        num_shards=num_shards,
+        shard_index=shard_index,
     )
 
-    return model
-
 
 def train_model(
     model_config: str = "default",
@@ -191,35 +158,126 @@ def train_model(
         ],
     )
 
-    train_cnn(cfg.training)
+    if cfg.training.distributed.enabled and distributed.TF_CONFIG not in os.environ:
+        # Without a cluster, the workers are processes of this host
+        distributed.launch_workers(
+            cfg.training.distributed.num_workers,
+            train_cnn,
+            (cfg.training,),
+            cfg.training.distributed.base_port,
+        )
+    else:
+        train_cnn(cfg.training)
 
 
-def train_cnn(cfg: DictConfig):
-    """Train a baseline CNN model.
-    For the possible settings see setup/conf/training/*
+def load_dataset(
+    data_path: str,
+    cfg: DictConfig,
+    shuffle: bool,
+    num_workers: int = 1,
+    worker_index: int = 0,
+) -> Dataset:
+    """Read the processed data through its tensor cache, if one is configured, or
+    else through the tf.data pipeline.
+
+    With several workers, every worker reads its own files if there are enough
+    of them. Otherwise every worker reads all the files, and keeps its share of
+    their records.
 
     Args:
+        data_path (str): The directory of the processed data
         cfg (DictConfig): All settings
+        shuffle (bool): Determines if we shuffle the dataset
+        num_workers (int, optional): The number of workers. Defaults to 1.
+        worker_index (int, optional): The index of this worker. Defaults to 0.
 
-    Raises:
-        NotImplementedError: If experiment tracking style is not supported
+    Returns:
+        Dataset: Batches of images and one-hot encoded labels
     """
-    # Model related settings
     keylist = cfg.features.list
     batch_size = cfg.model.batch_size
-    epochs = cfg.model.epochs
-    # Get logging style and options
-    logging_style = cfg.logging.style
+    filelist = parse_data.list_processed_files(reshard.data_dir(data_path, cfg))
+    if not cfg.data.cache_dir:
+        return get_dataset(
+            filelist,
+            batch_size,
+            cfg.data.input.shuffle_buffer,
+            keylist=keylist,
+            shuffle=shuffle,
+            options=cfg.data.input,
+            num_shards=num_workers,
+            shard_index=worker_index,
+        )
+
+    # Every model, feature list and dataset keeps its own latest cache
+    cache_root = os.path.join(
+        cfg.data.cache_dir,
+        cfg.model.name,
+        tensor_cache.features_key(keylist),
+        os.path.basename(os.path.normpath(data_path)),
+    )
+    shards = (1, 0)
+    if num_workers > 1:
+        # Workers on the same host must not build or prune the same caches
+        cache_root = os.path.join(cache_root, f"worker-{worker_index}")
+    if num_workers > 1 and len(filelist) < num_workers:
+        shards = (num_workers, worker_index)
+    elif num_workers > 1:
+        filelist = filelist[worker_index::num_workers]
+    cache = tensor_cache.build_tensor_cache(filelist, keylist, cache_root)
+    dataset = tensor_cache.read_tensor_cache(cache, batch_size, shuffle, SEED, *shards)
+    if cfg.data.input.prefetch:
+        dataset = dataset.prefetch(cfg.data.input.prefetch)
+    return dataset
+
+
+def num_records(data_path: str, cfg: DictConfig) -> int:
+    """The number of records of the processed data.
+
+    Args:
+        data_path (str): The directory of the processed data
+        cfg (DictConfig): All settings
+
+    Returns:
+        int: The number of records
+    """
+    filelist = parse_data.list_processed_files(reshard.data_dir(data_path, cfg))
+    return sum(parse_data.num_processed_records(f) for f in filelist)
+
+
+def add_class_weights(dataset: Dataset) -> Dataset:
+    """Add the class weight of every record as its sample weight, which is what
+    the class_weight argument of model.fit does. Keras can't do it for the
+    datasets of distributed.fit.
+
+    Args:
+        dataset (Dataset): Batches of images and one-hot encoded labels
+
+    Returns:
+        Dataset: Batches of images, labels and sample weights
+    """
+    weights = class_weights()
+    weights = tf.constant([weights[i] for i in range(len(weights))], tf.float32)
+    return dataset.map(
+        lambda x, y: (x, y, tf.gather(weights, tf.argmax(y, axis=-1))),
+        num_parallel_calls=AUTOTUNE,
+    )
+
+
+def start_run(cfg: DictConfig) -> Tuple[Any, List[keras.callbacks.Callback]]:
+    """Start the experiment tracking run of the training.
 
-    # load training data in TFRecord format
-    filelist = glob.glob(os.path.join(cfg.data.train_data, "processed_part*"))
-    train_dataset = get_dataset(filelist, batch_size, NUM_TRAIN, keylist=keylist)
+    Args:
+        cfg (DictConfig): All settings
 
-    # load validation data in TFRecord format
-    filelist = glob.glob(os.path.join(cfg.data.val_data, "processed_part*"))
-    val_dataset = get_dataset(filelist, batch_size, NUM_VAL, keylist=keylist)
+    Raises:
+        NotImplementedError: If experiment tracking style is not supported
 
-    model = construct_baseline_model(cfg)
+    Returns:
+        Tuple[Any, List[keras.callbacks.Callback]]: The run, and the callbacks
+            which log the training to it
+    """
+    logging_style = cfg.logging.style
     run_name = f"{cfg.model.name}_{generate_random_id()}"
     config = omegaconf.OmegaConf.to_container(cfg, resolve=True, throw_on_missing=True)
     config.pop("logging")
@@ -241,26 +299,47 @@ def train_cnn(cfg: DictConfig):
 
         wf_cfg = wandb.config
         wf_cfg.setdefaults(config)
-        callbacks = [WandbMetricsLogger()]
+        callbacks = [PRCurveCallback(), WandbMetricsLogger()]
 
     elif logging_style == "mlflow":
         # Do local MLFlow logging
         mlflow.set_tracking_uri("http://mlflow-server:5012")
         mlflow.set_experiment(PROJECT_NAME)
         run = mlflow.start_run(run_name=run_name)
-        callbacks = [mlflow.keras.callback.MlflowCallback(run)]
+        # MLFlow only takes scalar metrics, so the curves are saved as artifacts
+        callbacks = [
+            PRCurveCallback(
+                curves_in_logs=False,
+                on_curves=lambda epoch, curves: mlflow.log_dict(
+                    curves, f"pr_curves/epoch_{epoch + 1:03d}.json"
+                ),
+            ),
+            mlflow.keras.callback.MlflowCallback(run),
+        ]
     else:
         logger.critical(f"Logging style {logging_style} unknown! Exiting")
         raise NotImplementedError
+    return run, callbacks
 
-    if epochs > 0:
-        model.fit(
-            train_dataset,
-            epochs=epochs,
-            validation_data=val_dataset,
-            class_weight=class_weights(),
-            callbacks=callbacks,
-        )
+
+def finish_run(
+    model: keras.Model, run: Any, cfg: DictConfig, val_dataset: Dataset | None = None
+) -> None:
+    """Log the trained model to the experiment tracking run, register it if
+    configured, and end the run. The registered model is quantized if
+    configured, with the validation data to calibrate and compare it, and a copy
+    of it with an optimized graph is registered next to it if configured.
+
+    Args:
+        model (keras.Model): The trained model
+        run (Any): The run returned by start_run
+        cfg (DictConfig): All settings
+        val_dataset (Dataset | None, optional): The batched validation data,
+            needed for quantization. Defaults to None.
+    """
+    logging_style = cfg.logging.style
+    config = omegaconf.OmegaConf.to_container(cfg, resolve=True, throw_on_missing=True)
+    config.pop("logging")
     if logging_style == "mlflow":
         mlflow.keras.log_model(model, "artifacts")
         mlflow.log_params(config)
@@ -270,7 +349,26 @@ def train_cnn(cfg: DictConfig):
         # later use it in production.
 
         # Convert the trained model to ONNX
-        onnx_model = convert_model_to_onnx(model)
+        onnx_model = convert_model_to_onnx(float32_model(model, cfg))
+        report = None
+        files = {}
+        if cfg.quantization.mode != "none":
+            float_model = onnx_model
+            onnx_model, report = quantize.quantize_for_registry(
+                float_model, val_dataset, cfg.quantization, parse_data.NUM_CLASSES
+            )
+            if report is not None:
+                files = {
+                    QUANTIZATION_REPORT_NAME: json.dumps(report, indent=4),
+                    FLOAT_MODEL_NAME: float_model.SerializeToString(),
+                }
+        metadata = {}
+        if cfg.optimization.enabled:
+            optimized = optimize.optimize_model(onnx_model, cfg.optimization.level)
+            files[optimize.OPTIMIZED_MODEL_NAME] = optimized.SerializeToString()
+            metadata[optimize.OPTIMIZED_MODEL_NAME] = optimize.optimization_metadata(
+                cfg.optimization.level, onnx_model.SerializeToString()
+            )
 
         model_s3_path = f"s3://{cfg.model_registry_s3_bucket}/{cfg.model.name}"
         config_yaml = omegaconf.OmegaConf.to_yaml(cfg, resolve=True)
@@ -281,16 +379,32 @@ def train_cnn(cfg: DictConfig):
             mlflow.onnx.log_model(onnx_model, "artifacts-generic")
             # Record the S3 path
             mlflow.log_param("model_s3_path", model_s3_path)
+            if report is not None:
+                mlflow.log_dict(report, QUANTIZATION_REPORT_NAME)
             mlflow.end_run()
             # Upload the model to S3
             upload_model_to_s3(
-                onnx_model, cfg.model.name, cfg.model_registry_s3_bucket, config_yaml
+                onnx_model,
+                cfg.model.name,
+                cfg.model_registry_s3_bucket,
+                config_yaml,
+                files,
+                metadata,
+                REGISTRY_FILES,
             )
         elif logging_style == "wandb":
             # For WandB we upload the model first, then link it
             upload_model_to_s3(
-                onnx_model, cfg.model.name, cfg.model_registry_s3_bucket, config_yaml
+                onnx_model,
+                cfg.model.name,
+                cfg.model_registry_s3_bucket,
+                config_yaml,
+                files,
+                metadata,
+                REGISTRY_FILES,
             )
+            if report is not None:
+                run.summary["quantization"] = report
             model_artifact = wandb.Artifact(cfg.model.name, type="model")
             s3_path = f"s3://{cfg.model_registry_s3_bucket}/{cfg.model.name}/model.onnx"
             model_artifact.add_reference(s3_path)
@@ -302,6 +416,86 @@ def train_cnn(cfg: DictConfig):
             run.finish()
 
 
+def train_cnn(cfg: DictConfig):
+    """Train a baseline CNN model.
+    For the possible settings see setup/conf/training/*
+
+    With distributed training enabled, this runs on every worker. Only the chief,
+    worker 0, logs the experiment and registers the model.
+
+    Args:
+        cfg (DictConfig): All settings
+
+    Raises:
+        NotImplementedError: If experiment tracking style is not supported
+    """
+    # The strategy has to be created before TensorFlow runs anything
+    strategy = distributed.get_strategy(cfg.distributed)
+    num_workers, worker_index = (
+        distributed.worker_info() if cfg.distributed.enabled else (1, 0)
+    )
+    is_chief = worker_index == 0
+    # Model related settings
+    batch_size = cfg.model.batch_size
+    epochs = cfg.model.epochs
+
+    # load training and validation data in TFRecord format
+    train_dataset = load_dataset(
+        cfg.data.train_data, cfg, True, num_workers, worker_index
+    )
+    # The order doesn't matter for validation
+    val_dataset = load_dataset(cfg.data.val_data, cfg, False, num_workers, worker_index)
+
+    resume = cfg.callbacks.checkpoint.enabled and epochs > 0
+    state = None
+    with strategy.scope():
+        model = construct_baseline_model(cfg)
+        if resume:
+            state = checkpoint.restore_checkpoint(model, checkpoint.checkpoint_dir(cfg))
+    initial_epoch = state["epoch"] if state is not None else 0
+    callbacks = []
+    if is_chief:
+        run, callbacks = start_run(cfg)
+    # Placed before the metric loggers, so that these record the learning rate
+    callbacks = checkpoint.training_callbacks(cfg, state, is_chief) + callbacks
+    if epochs > 0 and cfg.data.input.profile_batches > 0:
+        # Placed first, so that the metric loggers record the step times
+        input_seconds = input_pipeline.time_input_pipeline(
+            train_dataset, cfg.data.input.profile_batches
+        )
+        callbacks.insert(0, input_pipeline.StepTimeCallback(input_seconds))
+    if epochs > 0 and num_workers > 1:
+        # The shards differ in size, but every worker has to run the same steps
+        distributed.fit(
+            model,
+            strategy,
+            add_class_weights(train_dataset).repeat(),
+            epochs,
+            distributed.steps_per_epoch(
+                num_records(cfg.data.train_data, cfg), batch_size, num_workers
+            ),
+            validation_data=val_dataset.repeat(),
+            validation_steps=distributed.steps_per_epoch(
+                num_records(cfg.data.val_data, cfg), batch_size, num_workers
+            ),
+            callbacks=callbacks,
+            initial_epoch=initial_epoch,
+        )
+    elif epochs > 0:
+        model.fit(
+            train_dataset,
+            epochs=epochs,
+            validation_data=val_dataset,
+            class_weight=class_weights(),
+            callbacks=callbacks,
+            initial_epoch=initial_epoch,
+        )
+    if is_chief:
+        finish_run(model, run, cfg, val_dataset)
+        if resume:
+            checkpoint.remove_checkpoint(checkpoint.checkpoint_dir(cfg))
+
+
 if __name__ == "__main__":
     train_model(
         model_config="default",
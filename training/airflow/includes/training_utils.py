@@ -1,6 +1,7 @@
 import secrets
 import string
 from sys import argv
+from typing import Dict, Iterable
 
 import boto3
 import omegaconf
@@ -26,8 +27,48 @@ def generate_random_id(N: int = 4) -> str:
     return res
 
 
-def upload_model_to_s3(model, model_name: str, bucket_name: str, config: str):
+def upload_model_to_s3(
+    model,
+    model_name: str,
+    bucket_name: str,
+    config: str,
+    files: Dict[str, bytes | str] | None = None,
+    metadata: Dict[str, Dict[str, str]] | None = None,
+    known_files: Iterable[str] = (),
+):
+    """Register a model and its configuration in the model registry bucket, with
+    the files published with it.
+
+    Args:
+        model (onnx.ModelProto): The model
+        model_name (str): The name of the model, the prefix of its objects
+        bucket_name (str): The model registry bucket
+        config (str): The configuration of the model, as YAML
+        files (Dict[str, bytes | str] | None, optional): The other files
+            published with the model by name. Defaults to None.
+        metadata (Dict[str, Dict[str, str]] | None, optional): The S3 object
+            metadata of some of the files by name. Defaults to None.
+        known_files (Iterable[str], optional): The names of all the files which
+            may be published with a model; those not in files are deleted.
+            Defaults to ().
+    """
     s3 = boto3.client("s3")
+    files = files or {}
+    # Any other files published with the model, e.g. the quantization report, with
+    # their S3 object metadata if any. They are uploaded before the model, so that
+    # the model never appears next to the files of an older one
+    metadata = metadata or {}
+    for name, body in files.items():
+        s3.put_object(
+            Body=body,
+            Bucket=bucket_name,
+            Key=f"{model_name}/{name}",
+            Metadata=metadata.get(name, {}),
+        )
+    # The known files which this model doesn't have were published with an older
+    # one, e.g. its optimized graph, and would be served in place of this model
+    for name in set(known_files) - set(files):
+        s3.delete_object(Bucket=bucket_name, Key=f"{model_name}/{name}")
     s3.put_object(Body=config, Bucket=bucket_name, Key=f"{model_name}/config.yaml")
     s3.put_object(
         Body=model.SerializeToString(),